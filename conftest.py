@@ -8,6 +8,8 @@ created: 2021-11-16 09:36:12 CET
 import pytest
 
 from django.contrib.auth import models as auth
+from django.core.cache import cache
+from urbanvitaliz.apps.geomatics import gazetteer
 
 
 @pytest.fixture(autouse=True, scope="function")
@@ -17,4 +19,10 @@ def fix_groups_permissions(db):
     g.permissions.add(p)
 
 
+@pytest.fixture(autouse=True, scope="function")
+def clear_cache():
+    cache.clear()
+    gazetteer.invalidate_gazetteer()
+
+
 # eof
@@ -1,5 +1,6 @@
 from django import forms
 from django.contrib import admin
+from django.utils import timezone
 
 from . import models
 from .sendinblue import SendInBlue
@@ -25,4 +26,18 @@ class EmailTemplateAdmin(admin.ModelAdmin):
     form = EmailTemplateForm
 
 
+@admin.register(models.OutboundEmail)
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = ["template_name", "status", "attempts", "created_on", "sent_on"]
+    list_filter = ["status", "template_name"]
+    readonly_fields = ["created_on", "sent_on", "last_error"]
+    actions = ["requeue"]
+
+    @admin.action(description="Renvoyer les courriels sélectionnés")
+    def requeue(self, request, queryset):
+        queryset.exclude(status=models.OutboundEmail.SENT).update(
+            status=models.OutboundEmail.PENDING, attempts=0, scheduled_on=timezone.now()
+        )
+
+
 # eof
@@ -7,32 +7,80 @@ Always use the send_email function that can be implemented as:
 
 - a debug version through the terminal
 - a production version through send in blue
+- a queued version storing emails to be sent by the sendemails worker
 
 
 authors: guillaume.libersat@beta.gouv.fr, raphael.marvie@beta.gouv.fr
 updated: 2022-02-03 16:19:24 CET
 """
 
+import threading
+import time
+
 from django.conf import settings
 from django.core.mail import mail_admins
 from django.core.mail import send_mail as django_send_mail
 
-from .models import EmailTemplate
-from .sendinblue import SendInBlue
+from .models import EmailTemplate, OutboundEmail
+from .sendinblue import get_client
+
+# seconds before the template name to sib id map is reloaded
+EMAIL_TEMPLATES_CACHE_TTL = 5 * 60
+
+_email_templates = {"ids": None, "loaded_on": 0}
+_email_templates_lock = threading.Lock()
+
+
+def load_email_templates():
+    """Load the map of lowercased template names to sendinblue ids"""
+    ids = {
+        name.lower(): sib_id
+        for name, sib_id in EmailTemplate.objects.values_list("name", "sib_id")
+    }
+    with _email_templates_lock:
+        _email_templates.update(ids=ids, loaded_on=time.monotonic())
+    return ids
+
+
+def reset_email_templates_cache():
+    """Forget loaded templates, e.g. when one was edited"""
+    with _email_templates_lock:
+        _email_templates.update(ids=None, loaded_on=0)
+
+
+def get_email_template_id(template_name):
+    """Return the sendinblue id of the given template name or None"""
+    ids = _email_templates["ids"]
+    expired = (
+        time.monotonic() - _email_templates["loaded_on"] > EMAIL_TEMPLATES_CACHE_TTL
+    )
+    if ids is None or expired or template_name.lower() not in ids:
+        ids = load_email_templates()
+    return ids.get(template_name.lower())
 
 
 def send_in_blue_email(template_name, recipients, params=None, test=False):
     """Uses sendinblue service to send an email using the given template and params"""
-    sib = SendInBlue()
-    try:
-        template = EmailTemplate.objects.get(name__iexact=template_name)
-    except EmailTemplate.DoesNotExist:
+    template_id = get_email_template_id(template_name)
+    if template_id is None:
+        mail_admins(
+            subject="Unable to send email", message=f"{template_name} was not found !"
+        )
+        return False
+
+    return get_client().send_email(template_id, recipients, params, test=test)
+
+
+def send_in_blue_email_batch(template_name, versions):
+    """Send template to every (recipients, params) version in one sendinblue call"""
+    template_id = get_email_template_id(template_name)
+    if template_id is None:
         mail_admins(
             subject="Unable to send email", message=f"{template_name} was not found !"
         )
         return False
 
-    return sib.send_email(template.sib_id, recipients, params, test=test)
+    return get_client().send_email_versions(template_id, versions)
 
 
 def send_debug_email(template_name, recipients, params=None, test=False):
@@ -60,9 +108,38 @@ def send_debug_email(template_name, recipients, params=None, test=False):
     return True
 
 
+def send_debug_email_batch(template_name, versions):
+    """Debug counterpart of send_in_blue_email_batch, one mail per version"""
+    for recipients, params in versions:
+        send_debug_email(template_name, recipients, params=params)
+    return True
+
+
+def queue_email(template_name, recipients, params=None, test=False):
+    """Store the email in the outbound queue, sent later by the sendemails worker"""
+    if test:
+        return deliver_email(template_name, recipients, params=params, test=test)
+
+    if type(recipients) is not list:
+        recipients = [recipients]
+
+    OutboundEmail.objects.create(
+        template_name=template_name, recipients=recipients, params=params
+    )
+    return True
+
+
+# deliver_email actually sends, send_email may only queue for later delivery
 if settings.DEBUG and getattr(settings, "SENDINBLUE_FORCE_DEBUG", False):
-    send_email = send_debug_email
+    deliver_email = send_debug_email
+    deliver_email_batch = send_debug_email_batch
+else:
+    deliver_email = send_in_blue_email
+    deliver_email_batch = send_in_blue_email_batch
+
+if getattr(settings, "SENDINBLUE_QUEUE_EMAILS", False):
+    send_email = queue_email
 else:
-    send_email = send_in_blue_email
+    send_email = deliver_email
 
 # eof
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class CommunicationConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "urbanvitaliz.apps.communication"
+
+    def ready(self):
+        import urbanvitaliz.apps.communication.signals  # noqa
@@ -0,0 +1,328 @@
+# encoding: utf-8
+
+"""
+benchmark of the digest pipeline on synthetic data
+
+Generates users, projects, tasks, notifications and reminders in bulk with
+skewed distributions close to production (a few busy projects, switchtenders
+following many of them), runs the digest engine against a fake sender and
+reports wall time, number of queries and peak python memory.
+
+Everything runs in a transaction that is rolled back, so the benchmark can be
+run against a copy of the production database:
+
+    ./manage.py benchdigests --users 2000 --notifications 50000
+"""
+
+import random
+import threading
+import time
+import tracemalloc
+import uuid
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from django.contrib.auth import models as auth_models
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from notifications import models as notifications_models
+from urbanvitaliz.apps.geomatics import models as geomatics_models
+from urbanvitaliz.apps.home import models as home_models
+from urbanvitaliz.apps.projects import models as projects_models
+from urbanvitaliz.apps.reminders import models as reminders_models
+
+from . import digests, engine
+
+# verb, action object kind, notified to members, notified to switchtenders
+VERBS = (
+    (engine.VERB_NEW_RECOMMENDATION, "task", True, True),
+    ("a commenté l'action", "followup", True, True),
+    ("est devenu·e aiguilleur·se sur le projet", "project", True, True),
+    ("a soumis pour modération le projet", "project", False, True),
+    (engine.VERB_NEW_SITE, "project", False, True),
+)
+VERB_WEIGHTS = (35, 30, 10, 15, 10)
+
+
+@dataclass
+class BenchmarkResult:
+    """Measures of a digest run"""
+
+    users: int
+    projects: int
+    notifications: int
+    reminders: int
+    digests: dict = field(default_factory=dict)
+    emails: int = 0
+    api_calls: int = 0
+    duration: float = 0
+    queries: int = 0
+    peak_memory: int = 0
+
+
+class FakeSender:
+    """Thread safe stand-in for deliver_email_batch counting what is sent"""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.emails = 0
+
+    def __call__(self, template_name, versions):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls += 1
+            self.emails += len(versions)
+        return True
+
+
+def run_digest_benchmark(
+    users=100,
+    projects=50,
+    notifications=1000,
+    reminders=100,
+    switchtender_ratio=0.1,
+    fragments=True,
+    latency=0,
+    seed=None,
+):
+    """Generate a dataset, run the digest engine on it and return measures"""
+    sender = FakeSender(latency=latency)
+
+    with transaction.atomic():
+        generate_digest_dataset(
+            users=users,
+            projects=projects,
+            notifications=notifications,
+            reminders=reminders,
+            switchtender_ratio=switchtender_ratio,
+            fragments=fragments,
+            seed=seed,
+        )
+
+        result = BenchmarkResult(
+            users=users,
+            projects=projects,
+            notifications=notifications,
+            reminders=reminders,
+        )
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            result.digests = engine.DigestEngine(send_batch=sender).run()
+        result.duration = time.perf_counter() - start
+        result.peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        result.queries = len(queries.captured_queries)
+        result.emails = sender.emails
+        result.api_calls = sender.calls
+
+        transaction.set_rollback(True)
+
+    return result
+
+
+########################################################################
+# synthetic data
+########################################################################
+
+
+def generate_digest_dataset(
+    users=100,
+    projects=50,
+    notifications=1000,
+    reminders=100,
+    switchtender_ratio=0.1,
+    fragments=True,
+    seed=None,
+):
+    """Create a synthetic dataset of pending notifications and due reminders"""
+    if users < 2 or projects < 1:
+        raise ValueError("at least two users and a project are needed")
+
+    rng = random.Random(seed)
+    tag = uuid.uuid4().hex[:8]
+    now = timezone.now()
+
+    # bulk created rows are fetched back as not every backend returns ids
+
+    # users, a share of them being switchtenders
+    auth_models.User.objects.bulk_create(
+        [
+            auth_models.User(
+                username=f"bench-{tag}-{idx}",
+                email=f"bench-{tag}-{idx}@example.com",
+                first_name=f"Prénom{idx}",
+                last_name=f"Nom{idx}",
+            )
+            for idx in range(users)
+        ]
+    )
+    all_users = list(
+        auth_models.User.objects.filter(username__startswith=f"bench-{tag}-").order_by(
+            "id"
+        )
+    )
+    home_models.UserProfile.objects.bulk_create(
+        [home_models.UserProfile(user=user) for user in all_users]
+    )
+    switchtender_count = max(1, int(users * switchtender_ratio))
+    switchtenders = all_users[:switchtender_count]
+    members = all_users[switchtender_count:] or switchtenders
+    group, _ = auth_models.Group.objects.get_or_create(name="switchtender")
+    group.user_set.add(*switchtenders)
+
+    # projects located in existing communes, or synthetic ones
+    communes = list(geomatics_models.Commune.objects.all()[:100])
+    if not communes:
+        region, _ = geomatics_models.Region.objects.get_or_create(
+            code="ZZ", defaults={"name": "Région de test"}
+        )
+        department, _ = geomatics_models.Department.objects.get_or_create(
+            code="ZZZ", defaults={"name": "Département de test", "region": region}
+        )
+        geomatics_models.Commune.objects.bulk_create(
+            [
+                geomatics_models.Commune(
+                    department=department,
+                    insee=f"ZZ{idx:03}",
+                    postal=f"ZZ{idx:03}",
+                    name=f"Commune {idx}",
+                )
+                for idx in range(10)
+            ]
+        )
+        communes = list(geomatics_models.Commune.objects.filter(department=department))
+
+    # projects with a few members and switchtenders each
+    projects_models.Project.objects.bulk_create(
+        [
+            projects_models.Project(
+                name=f"Projet {tag} {idx}",
+                location=f"Lieu {idx}",
+                commune=rng.choice(communes),
+                status=rng.choice(("READY", "IN_PROGRESS", "DONE")),
+            )
+            for idx in range(projects)
+        ]
+    )
+    all_projects = list(
+        projects_models.Project.objects.filter(
+            name__startswith=f"Projet {tag} "
+        ).order_by("id")
+    )
+    project_members = {}
+    project_switchtenders = {}
+    memberships = []
+    for project in all_projects:
+        project_members[project.id] = rng.sample(members, min(len(members), 3))[
+            : rng.randint(1, 3)
+        ]
+        project_switchtenders[project.id] = rng.sample(
+            switchtenders, min(len(switchtenders), rng.randint(1, 3))
+        )
+        memberships.extend(
+            projects_models.ProjectMember(
+                project=project, member=member, is_owner=not idx
+            )
+            for idx, member in enumerate(project_members[project.id])
+        )
+    projects_models.ProjectMember.objects.bulk_create(memberships)
+
+    # a few tasks per project, each with a followup
+    projects_models.Task.objects.bulk_create(
+        [
+            projects_models.Task(
+                project=project,
+                order=idx,
+                public=True,
+                created_by=rng.choice(project_switchtenders[project.id]),
+                intent=f"Action {idx} du projet {project.id}",
+                content="Contenu de l'action " * 5,
+            )
+            for project in all_projects
+            for idx in range(rng.randint(1, 5))
+        ]
+    )
+    all_tasks = list(
+        projects_models.Task.objects.filter(project__in=all_projects).order_by("id")
+    )
+    project_tasks = {}
+    for task in all_tasks:
+        project_tasks.setdefault(task.project_id, []).append(task)
+    projects_models.TaskFollowup.objects.bulk_create(
+        [
+            projects_models.TaskFollowup(
+                task=task,
+                who=rng.choice(project_members[task.project_id]),
+                comment="Un commentaire sur l'action",
+            )
+            for task in all_tasks
+        ]
+    )
+    task_followup = {
+        followup.task_id: followup
+        for followup in projects_models.TaskFollowup.objects.filter(task__in=all_tasks)
+    }
+
+    # notifications, concentrated on a few busy projects
+    popularity = [1 / (rank + 1) for rank in range(len(all_projects))]
+    rows = []
+    while len(rows) < notifications:
+        project = rng.choices(all_projects, weights=popularity)[0]
+        verb, kind, to_members, to_switchtenders = rng.choices(
+            VERBS, weights=VERB_WEIGHTS
+        )[0]
+        task = rng.choice(project_tasks[project.id])
+        action_object = {
+            "task": task,
+            "followup": task_followup[task.id],
+            "project": project,
+        }[kind]
+        actor = rng.choice(project_switchtenders[project.id])
+
+        recipients = (project_members[project.id] if to_members else []) + (
+            project_switchtenders[project.id] if to_switchtenders else []
+        )
+        event = [
+            notifications_models.Notification(
+                recipient=recipient,
+                actor=actor,
+                verb=verb,
+                action_object=action_object,
+                target=project,
+                timestamp=now - timedelta(minutes=rng.randint(0, 24 * 60)),
+            )
+            for recipient in recipients
+            if recipient != actor
+        ][: notifications - len(rows)]
+        if fragments and event:
+            fragment = digests.make_digest_fragment(event[0])
+            for notification in event:
+                notification.data = {"digest": fragment}
+        rows.extend(event)
+    notifications_models.Notification.objects.bulk_create(rows, batch_size=1000)
+
+    # reminders due today on tasks of projects members belong to
+    task_ct = ContentType.objects.get_for_model(projects_models.Task)
+    reminders_models.Reminder.objects.bulk_create(
+        [
+            reminders_models.Reminder(
+                recipient=rng.choice(project_members[task.project_id]).email,
+                deadline=now.date(),
+                content_type=task_ct,
+                object_id=task.id,
+            )
+            for task in rng.choices(all_tasks, k=reminders)
+        ],
+        batch_size=1000,
+    )
+
+
+# eof
@@ -7,6 +7,7 @@ authors: guillaume.libersat@beta.gouv.fr, raphael.marvie@beta.gouv.fr
 updated: 2022-02-03 16:16:37 CET
 """
 
+from collections import defaultdict
 from dataclasses import asdict, dataclass
 from datetime import timedelta
 from itertools import groupby
@@ -16,6 +17,7 @@ from django.contrib.contenttypes.models import ContentType
 from django.urls import reverse
 from django.utils import timezone
 from multimethod import multimethod
+from notifications import models as notifications_models
 from urbanvitaliz import utils
 from urbanvitaliz.apps.projects import models as projects_models
 from urbanvitaliz.apps.reminders import models as reminders_models
@@ -27,6 +29,10 @@ from .api import send_email
 ########################################################################
 
 
+# delay before a sent reminder is due again
+REMINDER_REARM_DELAY = timedelta(weeks=6)
+
+
 def send_digests_for_task_reminders_by_user(user):
     """
     Send a digest email per project with expired reminders
@@ -36,82 +42,101 @@ def send_digests_for_task_reminders_by_user(user):
     now = timezone.now()
 
     # Fetch all Task Reminders
-    reminders = reminders_models.Reminder.to_send.filter(
-        recipient=user.email, deadline__lte=now
-    ).filter(content_type=task_ct)
+    reminders = list(
+        reminders_models.Reminder.to_send.filter(
+            recipient=user.email, deadline__lte=now, content_type=task_ct
+        ).order_by("object_id")
+    )
 
-    if reminders.count() == 0:
+    if not reminders:
         return 0
 
-    skipped_reminders = send_reminder_digest_by_project_task(user, reminders)
+    tasks = load_reminded_tasks(reminders)
+    projects = projects_models.Project.objects.select_related("commune").in_bulk(
+        {task.project_id for task in tasks.values()}
+    )
+    by_project, skipped_reminders = group_reminders_by_project(
+        reminders, tasks, projects
+    )
 
-    # Rearm for the next alarm, in 6 weeks
-    for reminder in reminders.exclude(object_id__in=skipped_reminders):
-        reminders_models.Reminder.objects.create(
-            recipient=reminder.recipient,
-            deadline=now + timedelta(weeks=6),
-            origin=reminders_models.Reminder.SYSTEM,
-            content_type=reminder.content_type,
-            object_id=reminder.object_id,
+    for project_id, project_reminders in by_project.items():
+        digest = make_digest_of_reminders(
+            projects[project_id],
+            [tasks[reminder.object_id] for reminder in project_reminders],
+            user,
+        )
+        send_email(
+            "project_reminders_digest",
+            {"name": normalize_user_name(user), "email": user.email},
+            params=digest,
         )
 
-    # Mark as dispatched
-    reminders.exclude(object_id__in=skipped_reminders).update(sent_on=now)
+    sent_reminders = [r for reminders in by_project.values() for r in reminders]
+    rearm_reminders(sent_reminders, now)
+    delete_reminders(skipped_reminders)
 
-    # Delete the bogus ones
-    reminders.filter(object_id__in=skipped_reminders).delete()
+    return len(sent_reminders)
 
-    return reminders.exclude(object_id__in=skipped_reminders).count()
 
+def load_reminded_tasks(reminders):
+    """Return the tasks of task reminders by id, fetched in a single query"""
+    return projects_models.Task.objects.select_related(
+        "created_by__profile__organization", "resource"
+    ).in_bulk({reminder.object_id for reminder in reminders})
 
-def send_reminder_digest_by_project_task(user, reminders):
-    """Send an email per project/user containing its reminders."""
 
+def group_reminders_by_project(reminders, tasks, projects):
+    """
+    Return reminders partitioned by project id along with the ids of the
+    reminders whose task or project no longer exists
+    """
+    by_project = {}
     skipped_reminders = []
-    for project_id, project_reminders in groupby(
-        reminders, key=lambda x: x.related.project_id
-    ):
-        try:
-            project = projects_models.Project.objects.get(pk=project_id)
-        except projects_models.Project.DoesNotExist:
-            for reminder in project_reminders:
-                print(f"[W] Skipping reminder {reminder}")
-                skipped_reminders.append(reminder.pk)
+    for reminder in reminders:
+        task = tasks.get(reminder.object_id)
+        if not task or task.project_id not in projects:
+            print(f"[W] Skipping reminder {reminder}")
+            skipped_reminders.append(reminder.pk)
             continue
+        by_project.setdefault(task.project_id, []).append(reminder)
+    return by_project, skipped_reminders
+
+
+def rearm_reminders(reminders, now):
+    """Mark reminders as dispatched and rearm them for the next alarm"""
+    reminders_models.Reminder.objects.bulk_create(
+        [
+            reminders_models.Reminder(
+                recipient=reminder.recipient,
+                deadline=now + REMINDER_REARM_DELAY,
+                origin=reminders_models.Reminder.SYSTEM,
+                content_type_id=reminder.content_type_id,
+                object_id=reminder.object_id,
+            )
+            for reminder in reminders
+        ],
+        batch_size=500,
+    )
+    reminders_models.Reminder.objects.filter(
+        pk__in=[reminder.pk for reminder in reminders]
+    ).update(sent_on=now)
 
-        digest = make_digest_of_reminders(project, reminders, user)
-
-        send_email(
-            "project_reminders_digest",
-            {"name": normalize_user_name(user), "email": user.email},
-            params=digest,
-        )
 
-    return skipped_reminders
+def delete_reminders(reminder_ids):
+    """Delete the given reminders"""
+    if reminder_ids:
+        reminders_models.Reminder.objects.filter(pk__in=reminder_ids).delete()
 
 
-def make_digest_of_reminders(project, reminders, user):
-    """Return digest for reminders of a project to be sent to user"""
-    task_digest = make_reminders_task_digest(reminders, user)
-    project_digest = make_project_digest(project, user)
+def make_digest_of_reminders(project, tasks, user):
+    """Return digest for reminded tasks of a project to be sent to user"""
     return {
-        "notification_count": len(reminders),
-        "project": project_digest,
-        "recos": task_digest,
+        "notification_count": len(tasks),
+        "project": make_project_digest(project, user),
+        "recos": [make_action_digest(task, user) for task in tasks],
     }
 
 
-def make_reminders_task_digest(reminders, user):
-    """Return a digest of all reminders tasks"""
-    tasks = []
-
-    for reminder in reminders:
-        recommendation = make_action_digest(reminder.related, user)
-        tasks.append(recommendation)
-
-    return tasks
-
-
 ########################################################################
 # reco digests
 ########################################################################
@@ -201,18 +226,13 @@ def make_project_digest(project, user=None):
     }
 
 
-def make_action_digest(action, user):
+def make_action_digest(action, user, url=True):
     """Return digest of action"""
 
     if not action:
         return
 
-    action_link = utils.build_absolute_url(
-        reverse("projects-project-detail-actions", args=[action.project_id])
-        + f"#action-{action.id}",
-        auto_login_user=user,
-    )
-    return {
+    digest = {
         "created_by": {
             "first_name": action.created_by.first_name,
             "last_name": action.created_by.last_name,
@@ -229,9 +249,17 @@ def make_action_digest(action, user):
         "resource": {
             "title": action.resource and action.resource.title or "",
         },
-        "url": action_link,
     }
 
+    if url:
+        digest["url"] = utils.build_absolute_url(
+            reverse("projects-project-detail-actions", args=[action.project_id])
+            + f"#action-{action.id}",
+            auto_login_user=user,
+        )
+
+    return digest
+
 
 ########################################################################
 # new site digests
@@ -405,9 +433,137 @@ def make_project_notifications_digest(project_id, notifications, user):
 
 
 def make_notifications_digest(notifications):
-    """Return digest of given notifications"""
+    """Return digest of given notifications, pre-rendered ones when available"""
+    notifications = list(notifications)
     formatter = NotificationFormatter()
-    return [asdict(formatter.format(notification)) for notification in notifications]
+    formatter.prefetch([n for n in notifications if not get_digest_fragment(n)])
+
+    digest = []
+    for notification in notifications:
+        fragment = get_digest_fragment(notification)
+        if fragment:
+            digest.append(fragment["notification"])
+        else:
+            digest.append(asdict(formatter.format(notification)))
+    return digest
+
+
+########################################################################
+# pre-rendered digest fragments
+########################################################################
+
+
+def store_digest_fragments(notify_results):
+    """
+    Pre-render the digest fragment of freshly created notifications
+
+    Takes the result of notify.send: all the notifications of a single send
+    share actor, verb, action object and target, hence the same fragment,
+    which is computed once and stored in their data.
+    """
+    notifications = [
+        notification
+        for _, created in notify_results
+        if isinstance(created, list)
+        for notification in created
+    ]
+    if not notifications:
+        return None
+
+    fragment = make_digest_fragment(notifications[0])
+    notifications_models.Notification.objects.filter(
+        pk__in=[notification.pk for notification in notifications]
+    ).update(data={"digest": fragment})
+    return fragment
+
+
+def get_digest_fragment(notification):
+    """Return the pre-rendered fragment of notification, if any"""
+    return (notification.data or {}).get("digest")
+
+
+def make_digest_fragment(notification):
+    """
+    Return everything a digest needs to know about notification
+
+    Fragments are user agnostic: urls are stored as paths and only completed
+    with the auto login of the recipient when the digest is assembled.
+    """
+    fragment = {
+        "notification": asdict(NotificationFormatter().format(notification)),
+        "project": None,
+        "action": None,
+    }
+
+    project = notification.target
+    if isinstance(project, projects_models.Project):
+        fragment["project"] = make_project_fragment(project)
+
+    action = notification.action_object
+    if isinstance(action, projects_models.Task):
+        fragment["action"] = make_action_fragment(action)
+
+    return fragment
+
+
+def make_project_fragment(project):
+    """Return user agnostic information about project"""
+    commune = project.commune
+    department = commune and commune.department
+    return {
+        "name": project.name,
+        "org_name": project.org_name,
+        "path": reverse("projects-project-detail", args=[project.id]),
+        "commune": {
+            "postal": commune and commune.postal or "",
+            "name": commune and commune.name or "",
+            "department": {
+                "code": department and department.code or "",
+                "name": department and department.name or "",
+            },
+        },
+    }
+
+
+def make_action_fragment(action):
+    """Return user agnostic digest of action"""
+    digest = make_action_digest(action, user=None, url=False)
+    digest["path"] = (
+        reverse("projects-project-detail-actions", args=[action.project_id])
+        + f"#action-{action.id}"
+    )
+    return digest
+
+
+def project_digest_from_fragment(fragment, user):
+    """Return the project digest of make_project_digest from its fragment"""
+    return {
+        "name": fragment["name"],
+        "url": utils.build_absolute_url(fragment["path"], auto_login_user=user),
+        "commune": {
+            "postal": fragment["commune"]["postal"],
+            "name": fragment["commune"]["name"],
+        },
+    }
+
+
+def new_site_digest_from_fragment(fragment, user):
+    """Return the digest of make_digest_for_new_site from a project fragment"""
+    return {
+        "project": {
+            "name": fragment["name"],
+            "org_name": fragment["org_name"],
+            "url": utils.build_absolute_url(fragment["path"], auto_login_user=user),
+            "commune": fragment["commune"],
+        },
+    }
+
+
+def action_digest_from_fragment(fragment, user):
+    """Return the digest of make_action_digest from its fragment"""
+    digest = {key: value for key, value in fragment.items() if key != "path"}
+    digest["url"] = utils.build_absolute_url(fragment["path"], auto_login_user=user)
+    return digest
 
 
 ########################################################################
@@ -430,9 +586,60 @@ class FormattedNotification:
 
 
 class NotificationFormatter:
+    # relations followed when formatting objects of each model
+    RELATED_FOR_MODEL = {
+        "auth.user": ("profile__organization",),
+        "projects.project": ("commune",),
+        "projects.task": ("resource",),
+        "projects.taskfollowup": ("task__resource",),
+    }
+
     def format(self, notification):
         return self.format_for_actor(notification.actor, notification)
 
+    def format_many(self, notifications):
+        """Format notifications, resolving their related objects in bulk"""
+        notifications = list(notifications)
+        self.prefetch(notifications)
+        return [self.format(notification) for notification in notifications]
+
+    def prefetch(self, notifications):
+        """
+        Resolve actors and action objects of notifications in bulk
+
+        Generic relations are grouped by content type and fetched with a
+        single query per type, following the relations used by formatters,
+        then stored in the generic relation cache of each notification.
+        """
+        for relation in ("actor", "action_object"):
+            field = notifications_models.Notification._meta.get_field(relation)
+            ct_attname = field.model._meta.get_field(field.ct_field).get_attname()
+
+            by_type = defaultdict(list)
+            for notification in notifications:
+                if field.is_cached(notification):
+                    continue
+                ct_id = getattr(notification, ct_attname)
+                if ct_id is not None:
+                    by_type[ct_id].append(notification)
+
+            for ct_id, ct_notifications in by_type.items():
+                model = ContentType.objects.get_for_id(ct_id).model_class()
+                pk_field = model._meta.pk
+                object_ids = {
+                    pk_field.to_python(getattr(n, field.fk_field))
+                    for n in ct_notifications
+                }
+                objects = model._base_manager.select_related(
+                    *self.RELATED_FOR_MODEL.get(model._meta.label_lower, ())
+                ).in_bulk(object_ids)
+                for notification in ct_notifications:
+                    obj = objects.get(
+                        pk_field.to_python(getattr(notification, field.fk_field))
+                    )
+                    if obj is not None:
+                        field.set_cached_value(notification, obj)
+
     def _format_or_default(self, dispatch_table, notification):
         """
         Try formatting the notification by the dispatch table or
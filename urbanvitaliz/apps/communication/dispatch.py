@@ -0,0 +1,219 @@
+# encoding: utf-8
+
+"""
+parallel and rate limited dispatching of emails
+
+The dispatcher sends emails from a bounded pool of worker threads sharing the
+same sendinblue client (and thus its http connection pool).  Sends are
+throttled to a maximum number of requests per second and retried with an
+exponential backoff when the remote service fails or asks us to slow down.
+"""
+
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import urllib3
+from django.conf import settings
+from django.db import connections
+from sib_api_v3_sdk.rest import ApiException
+
+from . import api
+
+logger = logging.getLogger(__name__)
+
+# http status for which retrying later can succeed
+RETRYABLE_STATUSES = (0, 429, 500, 502, 503, 504)
+
+
+class RateLimiter:
+    """Thread safe token bucket allowing rate calls per second"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated_on = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a call is allowed"""
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.rate, self.tokens + (now - self.updated_on) * self.rate
+                )
+                self.updated_on = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+def is_retryable(error):
+    """Return true if sending again may succeed"""
+    if isinstance(error, ApiException):
+        return (error.status or 0) in RETRYABLE_STATUSES
+    return isinstance(error, urllib3.exceptions.HTTPError)
+
+
+class EmailDispatcher:
+    """Send emails from a pool of workers, throttled and retried"""
+
+    def __init__(
+        self,
+        send=None,
+        send_batch=None,
+        max_workers=None,
+        rate_limit=None,
+        max_retries=None,
+        backoff=None,
+    ):
+        self.send = send or api.deliver_email
+        self.send_batch = send_batch or api.deliver_email_batch
+        self.max_workers = max_workers or getattr(
+            settings, "SENDINBLUE_DISPATCH_WORKERS", 4
+        )
+        self.max_retries = (
+            max_retries
+            if max_retries is not None
+            else getattr(settings, "SENDINBLUE_DISPATCH_MAX_RETRIES", 3)
+        )
+        self.backoff = (
+            backoff
+            if backoff is not None
+            else getattr(settings, "SENDINBLUE_DISPATCH_BACKOFF", 1.0)
+        )
+        self.limiter = RateLimiter(
+            rate_limit
+            if rate_limit is not None
+            else getattr(settings, "SENDINBLUE_DISPATCH_RATE_LIMIT", 10)
+        )
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="email-dispatch"
+        )
+        self.futures = []
+
+        # resolve templates once from the calling thread, workers only do http
+        api.load_email_templates()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, template_name, recipients, params=None):
+        """Queue an email for sending and return its future"""
+        return self.submit_call(
+            template_name, self.send, template_name, recipients, params=params
+        )
+
+    def submit_batch(self, template_name, versions):
+        """
+        Queue template for every (recipients, params) version in one call
+
+        The future returns the indexes of the versions that could not be sent,
+        see send_batch_or_split.
+        """
+        future = self.executor.submit(self.send_batch_or_split, template_name, versions)
+        self.futures.append(future)
+        return future
+
+    def send_batch_or_split(self, template_name, versions):
+        """
+        Send versions in one call, one by one if the call is rejected
+
+        A single invalid recipient makes sendinblue reject the whole call, the
+        other versions are then sent on their own.  Return the indexes of the
+        versions that could not be sent.
+        """
+        try:
+            self.send_with_retry(
+                template_name, self.send_batch, template_name, versions
+            )
+            return []
+        except ApiException as error:
+            if error.status != 400 or len(versions) == 1:
+                raise
+
+        failed = []
+        for index, version in enumerate(versions):
+            try:
+                self.send_with_retry(
+                    template_name, self.send_batch, template_name, [version]
+                )
+            except Exception:
+                failed.append(index)
+        return failed
+
+    def submit_call(self, template_name, send, *args, **kwargs):
+        """Queue a call to send in the worker pool and return its future"""
+        future = self.executor.submit(
+            self.send_with_retry, template_name, send, *args, **kwargs
+        )
+        self.futures.append(future)
+        return future
+
+    def send_with_retry(self, template_name, send, *args, **kwargs):
+        """Send an email, retrying with backoff on transient failures"""
+        try:
+            attempt = 0
+            while True:
+                self.limiter.acquire()
+                try:
+                    return send(*args, **kwargs)
+                except Exception as error:
+                    if attempt >= self.max_retries or not is_retryable(error):
+                        logger.error(f"Unable to send {template_name}: {error}")
+                        raise
+                    time.sleep(self.backoff * 2**attempt)
+                    attempt += 1
+        finally:
+            # a template cache miss opens a connection of the worker thread,
+            # nothing else would ever close it
+            connections.close_all()
+
+    def wait(self):
+        """Wait for all submitted emails and return the number of failures"""
+        failures = 0
+        for future in self.futures:
+            if future.exception() is not None:
+                failures += 1
+        self.futures = []
+        return failures
+
+    def close(self):
+        """Wait for pending emails and release workers"""
+        failures = self.wait()
+        self.executor.shutdown(wait=True)
+        return failures
+
+
+def batch_by_template(emails, max_batch_size=None):
+    """Group (template_name, recipients, params, ...) emails in batches per template
+
+    Yield (template_name, emails) with at most max_batch_size emails each,
+    so they can be sent with a single call using message versions.  Emails
+    are consumed lazily, a batch being yielded as soon as it is full.
+    """
+    max_batch_size = max_batch_size or getattr(
+        settings, "SENDINBLUE_BATCH_MAX_SIZE", 50
+    )
+    by_template = defaultdict(list)
+    for email in emails:
+        batch = by_template[email[0]]
+        batch.append(email)
+        if len(batch) == max_batch_size:
+            yield email[0], by_template.pop(email[0])
+
+    for template_name, batch in by_template.items():
+        yield template_name, batch
+
+
+# eof
@@ -0,0 +1,564 @@
+# encoding: utf-8
+
+"""
+set based engine sending all pending digests in a single run
+
+Instead of walking through every user and re-querying their notifications and
+reminders, the engine loads all unsent notifications and due reminders with a
+handful of bulk queries, partitions them in memory by recipient, project and
+verb, builds every digest payload and finally marks everything as sent using
+bulk updates.
+
+A run can be split across processes with shards, users being partitioned by
+id, and records a checkpoint per (user, digest kind) fully sent, together with
+the flagging of its notifications and reminders.  Resuming a run skips the
+checkpointed pairs so an interrupted run can be restarted safely.
+"""
+
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from itertools import groupby
+
+from django.contrib.auth import models as auth_models
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from notifications import models as notifications_models
+from urbanvitaliz import utils
+from urbanvitaliz.apps.projects import models as projects_models
+from urbanvitaliz.apps.reminders import models as reminders_models
+
+from . import digests, models
+from .api import deliver_email_batch
+from .dispatch import EmailDispatcher, batch_by_template
+
+VERB_NEW_RECOMMENDATION = "a recommandé l'action"
+VERB_NEW_SITE = "a déposé le projet"
+
+# max number of ids per bulk update/delete statement
+BULK_CHUNK_SIZE = 500
+
+
+@dataclass
+class Digest:
+    """A digest email ready to be sent to a user"""
+
+    kind: str
+    template_name: str
+    user: auth_models.User
+    params: dict
+    notification_ids: list = field(default_factory=list)
+    reminders: list = field(default_factory=list)
+
+
+class DigestEngine:
+    """Build and send every pending digest using bulk queries"""
+
+    def __init__(
+        self,
+        now=None,
+        shard=None,
+        run=None,
+        resume=False,
+        send_batch=None,
+        user_ids=None,
+    ):
+        self.now = now or timezone.now()
+        self.send_batch = send_batch or deliver_email_batch
+        # (index, count) of the users partition handled, index from 0
+        self.shard = shard
+        # only handle the given users when set
+        self.user_ids = set(user_ids) if user_ids is not None else None
+        self.run_id = run or self.now.date().isoformat()
+        self.resume = resume
+        self.checkpoints = set()
+        self.project_ct = ContentType.objects.get_for_model(projects_models.Project)
+        self.task_ct = ContentType.objects.get_for_model(projects_models.Task)
+
+        self.users = {}
+        self.switchtender_ids = set()
+        self.member_ids = set()
+        self.projects = {}
+        self.tasks = {}
+        self.notifications = defaultdict(list)
+        self.reminders = defaultdict(list)
+        self.skipped_reminder_ids = []
+        self.discarded_notification_ids = []
+
+    ####################################################################
+    # run
+    ####################################################################
+
+    def run(self):
+        """Send all pending digests and return the number sent by kind"""
+        # every link of a user shares the same auto login token during the run
+        with utils.cached_links():
+            return self.send()
+
+    def send(self):
+        """Load, build and send digests, flagging what was sent"""
+        self.load()
+
+        counts = defaultdict(int)
+        digests_to_send = [
+            digest
+            for digest in self.build()
+            if (digest.user.id, digest.kind) not in self.checkpoints
+        ]
+        # digests still to be sent per (user, kind) before checkpointing it
+        self.remaining = Counter((d.user.id, d.kind) for d in digests_to_send)
+
+        emails = (
+            (digest.template_name, self.recipient(digest.user), digest.params, digest)
+            for digest in digests_to_send
+        )
+        with EmailDispatcher(send_batch=self.send_batch) as dispatcher:
+            submitted = []
+            for template_name, batch in batch_by_template(emails):
+                future = dispatcher.submit_batch(
+                    template_name,
+                    [(recipient, params) for _, recipient, params, _ in batch],
+                )
+                submitted.append((future, [digest for *_, digest in batch]))
+
+            # only flag what was actually sent, batch by batch as they complete
+            for future, batch in submitted:
+                if future.exception() is None:
+                    failed = set(future.result())
+                    batch = [d for i, d in enumerate(batch) if i not in failed]
+                    self.complete(batch)
+                    for digest in batch:
+                        counts[digest.kind] += 1
+
+        self.mark_notifications_as_sent(self.discarded_notification_ids)
+        self.delete_skipped_reminders()
+
+        return dict(counts)
+
+    def complete(self, batch):
+        """Flag notifications and reminders of sent digests and checkpoint them"""
+        checkpoints = []
+        for digest in batch:
+            pair = (digest.user.id, digest.kind)
+            self.remaining[pair] -= 1
+            if not self.remaining[pair]:
+                checkpoints.append(
+                    models.DigestCheckpoint(
+                        run=self.run_id, user_id=digest.user.id, kind=digest.kind
+                    )
+                )
+
+        with transaction.atomic():
+            self.mark_notifications_as_sent(
+                [id for digest in batch for id in digest.notification_ids]
+            )
+            self.rearm_reminders(
+                [reminder for digest in batch for reminder in digest.reminders]
+            )
+            models.DigestCheckpoint.objects.bulk_create(
+                checkpoints, ignore_conflicts=True
+            )
+
+    def is_handled(self, user_id):
+        """Return true if user belongs to the users handled by this run"""
+        if self.user_ids is not None and user_id not in self.user_ids:
+            return False
+        if not self.shard:
+            return True
+        index, count = self.shard
+        return user_id % count == index
+
+    def recipient(self, user):
+        """Return the email recipient for user"""
+        return {"name": digests.normalize_user_name(user), "email": user.email}
+
+    ####################################################################
+    # loading
+    ####################################################################
+
+    def load(self):
+        """Fetch everything needed to build the digests in bulk"""
+        self.load_notifications()
+        self.load_reminders()
+        self.load_users()
+        self.load_projects_and_tasks()
+        self.load_checkpoints()
+
+    def load_notifications(self):
+        """Fetch all unsent notifications, partitioned by recipient"""
+        notifications = (
+            notifications_models.Notification.objects.unsent()
+            .select_related("recipient")
+            .order_by("recipient_id", "target_object_id", "-timestamp")
+        )
+        if self.user_ids is not None:
+            notifications = notifications.filter(recipient_id__in=self.user_ids)
+        if self.shard:
+            index, count = self.shard
+            notifications = notifications.annotate(
+                shard=F("recipient_id") % count
+            ).filter(shard=index)
+
+        legacy = []
+        for notification in notifications:
+            self.users[notification.recipient_id] = notification.recipient
+            self.notifications[notification.recipient_id].append(notification)
+            if not digests.get_digest_fragment(notification):
+                legacy.append(notification)
+
+        # only notifications without pre-rendered fragment need their objects
+        digests.NotificationFormatter().prefetch(legacy)
+
+    def load_reminders(self):
+        """Fetch all due task reminders, partitioned by recipient email"""
+        reminders = reminders_models.Reminder.to_send.filter(
+            content_type=self.task_ct, deadline__lte=self.now
+        ).order_by("recipient", "object_id")
+        if self.user_ids is not None:
+            reminders = reminders.filter(
+                recipient__in=auth_models.User.objects.filter(
+                    pk__in=self.user_ids
+                ).values("email")
+            )
+        for reminder in reminders:
+            self.reminders[reminder.recipient].append(reminder)
+
+    def load_users(self):
+        """Fetch reminder recipients and the groups users belong to"""
+        emails = self.reminders.keys()
+        for user in auth_models.User.objects.filter(is_active=True, email__in=emails):
+            self.users.setdefault(user.id, user)
+
+        user_ids = self.users.keys()
+        self.switchtender_ids = set(
+            auth_models.User.objects.filter(
+                pk__in=user_ids, groups__name="switchtender"
+            ).values_list("id", flat=True)
+        )
+        self.member_ids = set(
+            projects_models.ProjectMember.objects.filter(
+                member_id__in=user_ids, project__deleted=None
+            ).values_list("member_id", flat=True)
+        )
+
+    def load_checkpoints(self):
+        """Fetch the (user, kind) pairs already sent when resuming a run"""
+        if not self.resume:
+            return
+        self.checkpoints = set(
+            models.DigestCheckpoint.objects.filter(run=self.run_id).values_list(
+                "user_id", "kind"
+            )
+        )
+
+    def load_projects_and_tasks(self):
+        """Fetch the tasks and projects referenced by notifications and reminders"""
+        task_ids = set()
+        for reminders in self.reminders.values():
+            task_ids.update(reminder.object_id for reminder in reminders)
+        for notifications in self.notifications.values():
+            task_ids.update(
+                int(n.action_object_object_id)
+                for n in notifications
+                if n.action_object_content_type_id == self.task_ct.id
+                and not digests.get_digest_fragment(n)
+            )
+        self.tasks = projects_models.Task.objects.select_related(
+            "created_by__profile__organization", "resource"
+        ).in_bulk(task_ids)
+
+        project_ids = {task.project_id for task in self.tasks.values()}
+        for notifications in self.notifications.values():
+            project_ids.update(
+                int(n.target_object_id)
+                for n in notifications
+                if n.target_content_type_id == self.project_ct.id
+            )
+        self.projects = projects_models.Project.objects.select_related(
+            "commune__department"
+        ).in_bulk(project_ids)
+
+    ####################################################################
+    # building
+    ####################################################################
+
+    def build(self):
+        """Yield every digest to be sent, in the historical sending order"""
+        for user in self.reminder_recipients():
+            yield from self.build_reminder_digests(user)
+
+        # notifications consumed by a previous digest of the run
+        consumed = set()
+
+        for user_id in sorted(self.member_ids):
+            yield from self.build_new_recommendation_digests(
+                self.users[user_id], consumed
+            )
+
+        for user_id in sorted(self.notifications):
+            if user_id in self.switchtender_ids:
+                continue
+            digest = self.build_general_digest(
+                self.users[user_id], "digest_for_non_switchtender", consumed
+            )
+            if digest:
+                yield digest
+
+        for user_id in sorted(self.switchtender_ids):
+            user = self.users[user_id]
+            yield from self.build_new_site_digests(user, consumed)
+            digest = self.build_general_digest(
+                user, "digest_for_switchtender", consumed
+            )
+            if digest:
+                yield digest
+
+    def reminder_recipients(self):
+        """Return active users having due reminders, one per email"""
+        recipients = {}
+        for user in sorted(self.users.values(), key=lambda u: u.id):
+            if user.is_active and user.email in self.reminders:
+                recipients.setdefault(user.email, user)
+        return [user for user in recipients.values() if self.is_handled(user.id)]
+
+    def build_reminder_digests(self, user):
+        """Yield a reminder digest per project of user having due reminders"""
+        by_project, skipped = digests.group_reminders_by_project(
+            self.reminders[user.email], self.tasks, self.projects
+        )
+        self.skipped_reminder_ids.extend(skipped)
+
+        for project_id, reminders in by_project.items():
+            tasks = [self.tasks[reminder.object_id] for reminder in reminders]
+            yield Digest(
+                kind="reminders",
+                template_name="project_reminders_digest",
+                user=user,
+                params=digests.make_digest_of_reminders(
+                    self.projects[project_id], tasks, user
+                ),
+                reminders=reminders,
+            )
+
+    def build_new_recommendation_digests(self, user, consumed):
+        """Yield a digest per project with new recommendations for member"""
+        notifications = [
+            n
+            for n in self.notifications[user.id]
+            if n.target_content_type_id == self.project_ct.id
+            and n.verb == VERB_NEW_RECOMMENDATION
+        ]
+        consumed.update(n.id for n in notifications)
+
+        for project_id, project_notifications in groupby(
+            notifications, key=lambda n: int(n.target_object_id)
+        ):
+            project_notifications = list(project_notifications)
+            project = self.projects.get(project_id)
+            if not project:
+                self.discarded_notification_ids.extend(
+                    n.id for n in project_notifications
+                )
+                continue
+            recommendations = [
+                self.action_digest(n, user) for n in project_notifications
+            ]
+            yield Digest(
+                kind="new_recommendations",
+                template_name="new_recommendations_digest",
+                user=user,
+                params={
+                    "notification_count": len(recommendations),
+                    "project": self.project_digest(
+                        project_notifications[0], project, user
+                    ),
+                    "recos": recommendations,
+                },
+                notification_ids=[n.id for n in project_notifications],
+            )
+
+    def build_new_site_digests(self, user, consumed):
+        """Yield a digest per new site notified to switchtender"""
+        for notification in self.notifications[user.id]:
+            if (
+                notification.target_content_type_id != self.project_ct.id
+                or notification.verb != VERB_NEW_SITE
+            ):
+                continue
+            consumed.add(notification.id)
+            project = self.projects.get(int(notification.target_object_id))
+            if not project:
+                self.discarded_notification_ids.append(notification.id)
+                continue
+            fragment = digests.get_digest_fragment(notification)
+            if fragment and fragment["project"]:
+                params = digests.new_site_digest_from_fragment(
+                    fragment["project"], user
+                )
+            else:
+                notification.action_object = project
+                params = digests.make_digest_for_new_site(notification, user)
+            yield Digest(
+                kind="new_sites",
+                template_name="new_site_for_switchtender",
+                user=user,
+                params=params,
+                notification_ids=[notification.id],
+            )
+
+    def build_general_digest(self, user, template_name, consumed):
+        """Return the digest of remaining notifications of user, if any"""
+        is_switchtender = user.id in self.switchtender_ids
+        notifications = []
+        for notification in self.notifications[user.id]:
+            if notification.id in consumed:
+                continue
+            if notification.verb == VERB_NEW_RECOMMENDATION and (
+                is_switchtender
+                or notification.target_content_type_id == self.project_ct.id
+            ):
+                continue
+            notifications.append(notification)
+
+        if not notifications:
+            return None
+
+        projects_digest = []
+        for project_id, project_notifications in groupby(
+            notifications, key=lambda n: n.target_object_id
+        ):
+            project_notifications = list(project_notifications)
+            project = self.get_project(project_notifications[0])
+            if not project:
+                continue
+            project_digest = self.project_digest(
+                project_notifications[0], project, user
+            )
+            notifications_digest = digests.make_notifications_digest(
+                project_notifications
+            )
+            project_digest.update(
+                {
+                    "notifications": notifications_digest,
+                    "notification_count": len(notifications_digest),
+                }
+            )
+            projects_digest.append(project_digest)
+
+        return Digest(
+            kind=template_name,
+            template_name=template_name,
+            user=user,
+            params={
+                "projects": projects_digest,
+                "notification_count": len(notifications),
+            },
+            notification_ids=[n.id for n in notifications],
+        )
+
+    def project_digest(self, notification, project, user):
+        """Return the digest of project, from notification fragment if any"""
+        fragment = digests.get_digest_fragment(notification)
+        if fragment and fragment["project"]:
+            return digests.project_digest_from_fragment(fragment["project"], user)
+        return digests.make_project_digest(project, user)
+
+    def action_digest(self, notification, user):
+        """Return the digest of notified action, from its fragment if any"""
+        fragment = digests.get_digest_fragment(notification)
+        if fragment and fragment["action"]:
+            return digests.action_digest_from_fragment(fragment["action"], user)
+        return digests.make_action_digest(self.get_task(notification), user)
+
+    def get_task(self, notification):
+        """Return the task that is the action object of notification"""
+        if notification.action_object_content_type_id != self.task_ct.id:
+            return None
+        return self.tasks.get(int(notification.action_object_object_id))
+
+    def get_project(self, notification):
+        """Return the project that is the target of notification"""
+        if notification.target_content_type_id != self.project_ct.id:
+            return None
+        return self.projects.get(int(notification.target_object_id))
+
+    ####################################################################
+    # bulk updates
+    ####################################################################
+
+    def mark_notifications_as_sent(self, notification_ids):
+        """Flag all the given notifications as emailed"""
+        for ids in chunks(notification_ids):
+            notifications_models.Notification.objects.filter(pk__in=ids).update(
+                emailed=True
+            )
+
+    def rearm_reminders(self, reminders):
+        """Mark sent reminders as dispatched and rearm them"""
+        for chunk in chunks(reminders):
+            digests.rearm_reminders(chunk, self.now)
+
+    def delete_skipped_reminders(self):
+        """Drop reminders of tasks or projects that no longer exist"""
+        for ids in chunks(self.skipped_reminder_ids):
+            digests.delete_reminders(ids)
+
+
+def chunks(items, size=BULK_CHUNK_SIZE):
+    """Split items in lists of at most size elements"""
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def preview_digests(user_ids=None, chunk_size=BULK_CHUNK_SIZE):
+    """
+    Yield the digests that would be sent to users, as json ready dicts
+
+    Users are handled by chunks so previewing the whole user base never loads
+    everything at once.  Nothing is sent nor flagged, and links are built
+    without auto login tokens.
+    """
+    if user_ids is None:
+        user_ids = pending_digest_user_ids()
+
+    with utils.cached_links(auto_login=False):
+        for ids in chunks(sorted(user_ids), chunk_size):
+            digest_engine = DigestEngine(user_ids=ids)
+            digest_engine.load()
+            for digest in digest_engine.build():
+                yield {
+                    "user": digest.user.id,
+                    "email": digest.user.email,
+                    "kind": digest.kind,
+                    "template_name": digest.template_name,
+                    "params": digest.params,
+                    "notification_ids": digest.notification_ids,
+                }
+
+
+def pending_digest_user_ids():
+    """Return ids of users having unsent notifications or due reminders"""
+    user_ids = set(
+        notifications_models.Notification.objects.unsent().values_list(
+            "recipient_id", flat=True
+        )
+    )
+    emails = reminders_models.Reminder.to_send.filter(
+        deadline__lte=timezone.now()
+    ).values("recipient")
+    user_ids.update(
+        auth_models.User.objects.filter(is_active=True, email__in=emails).values_list(
+            "id", flat=True
+        )
+    )
+    return user_ids
+
+
+def send_all_digests(shard=None, run=None, resume=False):
+    """Send every pending digest and return the number sent by kind"""
+    return DigestEngine(shard=shard, run=run, resume=resume).run()
+
+
+# eof
@@ -0,0 +1,88 @@
+# encoding: utf-8
+
+"""
+local fake of the sendinblue transactional email api
+
+Used by the test suite to exercise the real http client without network and
+to benchmark email dispatching offline:
+
+    with FakeSendInBlueServer() as server:
+        sib = SendInBlue(host=server.url)
+        ...
+        assert len(server.emails) == 1
+"""
+
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeSendInBlueHandler(BaseHTTPRequestHandler):
+    """Answer the transactional email endpoint like sendinblue would"""
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or "{}")
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        with server.lock:
+            server.requests.append((self.path, payload))
+            throttled = server.failures_to_inject > 0
+            if throttled:
+                server.failures_to_inject -= 1
+            else:
+                server.emails.append(payload)
+
+        if throttled:
+            self.respond(429, {"code": "too_many_requests"})
+        elif self.path.endswith("/smtp/email"):
+            self.respond(201, {"messageId": f"<{uuid.uuid4()}@fake-sendinblue>"})
+        else:
+            self.respond(204, None)
+
+    def respond(self, status, body):
+        content = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):  # pragma: nocover
+        pass
+
+
+class FakeSendInBlueServer(ThreadingHTTPServer):
+    """Threaded http server recording the emails it was asked to send"""
+
+    daemon_threads = True
+
+    def __init__(self, latency=0, failures=0):
+        super().__init__(("127.0.0.1", 0), FakeSendInBlueHandler)
+        self.latency = latency
+        self.failures_to_inject = failures
+        self.lock = threading.Lock()
+        self.requests = []
+        self.emails = []
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f"http://{host}:{port}/v3"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+# eof
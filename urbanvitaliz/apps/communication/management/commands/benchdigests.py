@@ -0,0 +1,62 @@
+# encoding: utf-8
+
+"""
+Management command benchmarking the digest pipeline on synthetic data
+"""
+
+from django.core.management.base import BaseCommand
+from urbanvitaliz.apps.communication import benchmark
+
+
+class Command(BaseCommand):
+    help = "Benchmark digest sending on a rolled back synthetic dataset"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--projects", type=int, default=200)
+        parser.add_argument("--notifications", type=int, default=10000)
+        parser.add_argument("--reminders", type=int, default=500)
+        parser.add_argument(
+            "--switchtender-ratio",
+            type=float,
+            default=0.1,
+            help="Share of users being switchtenders",
+        )
+        parser.add_argument(
+            "--no-fragments",
+            action="store_true",
+            help="Do not pre-render digest fragments of notifications",
+        )
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0,
+            help="Seconds taken by each fake sendinblue call",
+        )
+        parser.add_argument("--seed", type=int, help="Seed of the data generator")
+
+    def handle(self, *args, **options):
+        result = benchmark.run_digest_benchmark(
+            users=options["users"],
+            projects=options["projects"],
+            notifications=options["notifications"],
+            reminders=options["reminders"],
+            switchtender_ratio=options["switchtender_ratio"],
+            fragments=not options["no_fragments"],
+            latency=options["latency"],
+            seed=options["seed"],
+        )
+
+        print(
+            f"** Digests of {result.users} users, {result.projects} projects, "
+            f"{result.notifications} notifications, {result.reminders} reminders **"
+        )
+        for kind, count in sorted(result.digests.items()):
+            print(f"{kind}: {count}")
+        print(f"emails: {result.emails} in {result.api_calls} api call(s)")
+        print(f"wall time: {result.duration:.3f}s")
+        print(f"queries: {result.queries}")
+        print(f"peak memory: {result.peak_memory / 1024 / 1024:.1f} MiB")
+
+
+# eof
@@ -0,0 +1,28 @@
+# encoding: utf-8
+
+"""
+Management command printing the digests that would be sent, without sending
+"""
+
+from django.core.management.base import BaseCommand
+from urbanvitaliz.apps.communication import engine, views
+
+
+class Command(BaseCommand):
+    help = "Print as ndjson the digests that would be sent to users"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "user_ids",
+            nargs="*",
+            type=int,
+            help="Users to preview, all users with pending digests by default",
+        )
+
+    def handle(self, *args, **options):
+        user_ids = options["user_ids"] or None
+        for line in views.as_ndjson(engine.preview_digests(user_ids)):
+            self.stdout.write(line, ending="")
+
+
+# eof
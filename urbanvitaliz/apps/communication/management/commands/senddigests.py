@@ -7,50 +7,47 @@ authors: raphael.marvie@beta.gouv.fr, guillaume.libersat@beta.gouv.fr
 created: 2022-01-24 22:39:27 CEST
 """
 
-
-from django.contrib.auth import models as auth_models
-from django.core.management.base import BaseCommand
-from urbanvitaliz.apps.communication import digests
-from urbanvitaliz.apps.projects import models as project_models
+from django.core.management.base import BaseCommand, CommandError
+from urbanvitaliz.apps.communication import engine
 
 
 class Command(BaseCommand):
     help = "Send pending notifications as email digests"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--shard",
+            help="only handle users of partition N out of M, given as N/M",
+        )
+        parser.add_argument(
+            "--run",
+            help="identifier of the run for checkpoints, defaults to today",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="skip digests already sent by a previous attempt of the run",
+        )
+
     def handle(self, *args, **options):
-        self.send_email_digests()
-
-    def send_email_digests(self):
-        print("** Sending Reminders **")
-        # Send reminders
-        for user in auth_models.User.objects.filter(is_active=True):
-            if digests.send_digests_for_task_reminders_by_user(user):
-                print(f"Sent reminder digests for {user}")
-
-        # Send project collaborators new recommendations
-        print("** Sending new recommendations digests **")
-        for project in project_models.Project.objects.all():
-            for user in project.members.all():
-                if digests.send_digests_for_new_recommendations_by_user(user):
-                    print(f"Sent new reco digests for {user} on {project.name}")
-
-        # Get all switchtenders
-        sw_group = auth_models.Group.objects.get(name="switchtender")
-
-        # Digests for non switchtenders
-        print("** Sending general digests **")
-        for user in auth_models.User.objects.exclude(groups__in=[sw_group]):
-            if digests.send_digest_for_non_switchtender_by_user(user):
-                print(f"Sent general digest for {user})")
-
-        # Digests for switchtenders
-        print("** Sending general switchtender digests **")
-        for user in auth_models.User.objects.filter(groups__in=[sw_group]):
-            if digests.send_digests_for_new_sites_by_user(user):
-                print(f"* Sent new site digests for {user}")
-
-            if digests.send_digest_for_switchtender_by_user(user):
-                print(f"* Sent general digest for switchtender (to {user})")
+        shard = self.parse_shard(options["shard"]) if options["shard"] else None
+        self.send_email_digests(shard, options["run"], options["resume"])
+
+    def parse_shard(self, value):
+        """Return (index, count) from a 1 based N/M shard specification"""
+        try:
+            number, count = (int(part) for part in value.split("/"))
+        except ValueError:
+            raise CommandError(f"Invalid shard '{value}', expected N/M")
+        if not 1 <= number <= count:
+            raise CommandError(f"Invalid shard '{value}', expected 1 <= N <= M")
+        return number - 1, count
+
+    def send_email_digests(self, shard=None, run=None, resume=False):
+        print("** Sending digests **")
+        counts = engine.send_all_digests(shard=shard, run=run, resume=resume)
+        for kind, count in sorted(counts.items()):
+            print(f"Sent {count} {kind} digest(s)")
 
 
 # eof
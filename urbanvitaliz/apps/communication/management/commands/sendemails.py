@@ -0,0 +1,40 @@
+# encoding: utf-8
+
+"""
+Management command draining the outbound email queue
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+from urbanvitaliz.apps.communication import outbox
+
+
+class Command(BaseCommand):
+    help = "Send queued outbound emails"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=50, help="Emails claimed per batch"
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep polling the queue instead of exiting once empty",
+        )
+        parser.add_argument(
+            "--sleep", type=float, default=5, help="Seconds between empty polls"
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = outbox.drain_outbound_emails(options["batch_size"])
+            if sent or failed:
+                print(f"Sent {sent} email(s), {failed} failure(s)")
+                continue
+            if not options["loop"]:
+                break
+            time.sleep(options["sleep"])
+
+
+# eof
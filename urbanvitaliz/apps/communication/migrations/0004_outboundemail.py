@@ -0,0 +1,56 @@
+# Generated by Django 3.2.14 on 2026-10-18 09:00
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("communication", "0003_alter_emailtemplate_name"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OutboundEmail",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("template_name", models.CharField(max_length=40)),
+                ("recipients", models.JSONField()),
+                ("params", models.JSONField(blank=True, null=True)),
+                (
+                    "status",
+                    models.IntegerField(
+                        choices=[(0, "en attente"), (1, "envoyé"), (2, "abandonné")],
+                        default=0,
+                    ),
+                ),
+                ("attempts", models.PositiveIntegerField(default=0)),
+                ("last_error", models.TextField(blank=True, default="")),
+                ("created_on", models.DateTimeField(default=django.utils.timezone.now)),
+                (
+                    "scheduled_on",
+                    models.DateTimeField(default=django.utils.timezone.now),
+                ),
+                ("sent_on", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "verbose_name": "courriel sortant",
+                "verbose_name_plural": "courriels sortants",
+            },
+        ),
+        migrations.AddIndex(
+            model_name="outboundemail",
+            index=models.Index(
+                fields=["status", "scheduled_on"], name="communicati_status_7543ba_idx"
+            ),
+        ),
+    ]
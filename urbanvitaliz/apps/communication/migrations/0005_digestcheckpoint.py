@@ -0,0 +1,47 @@
+# Generated by Django 3.2.14 on 2026-10-18 09:09
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("communication", "0004_outboundemail"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DigestCheckpoint",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("run", models.CharField(max_length=32)),
+                ("kind", models.CharField(max_length=40)),
+                ("created_on", models.DateTimeField(default=django.utils.timezone.now)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "point de reprise des résumés",
+                "verbose_name_plural": "points de reprise des résumés",
+                "unique_together": {("run", "user", "kind")},
+            },
+        ),
+    ]
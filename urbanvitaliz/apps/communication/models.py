@@ -7,7 +7,9 @@ author  : raphael.marvie@beta.gouv.fr, guillaume.libersat@beta.gouv.fr
 created : 2021-12-21 12:40:54 CEST
 """
 
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
 
 
 class EmailTemplate(models.Model):
@@ -18,4 +20,72 @@ class EmailTemplate(models.Model):
         return f"{self.name} - {self.sib_id}"
 
 
+class PendingOutboundEmailManager(models.Manager):
+    """Manager for queued emails due for sending"""
+
+    def get_queryset(self):
+        return (
+            super()
+            .get_queryset()
+            .filter(status=OutboundEmail.PENDING, scheduled_on__lte=timezone.now())
+            .order_by("scheduled_on", "id")
+        )
+
+
+class OutboundEmail(models.Model):
+    """An email queued for sending by the outbound email worker"""
+
+    PENDING = 0
+    SENT = 1
+    DEAD = 2
+
+    STATUS_CHOICES = (
+        (PENDING, "en attente"),
+        (SENT, "envoyé"),
+        (DEAD, "abandonné"),
+    )
+
+    objects = models.Manager()
+    pending = PendingOutboundEmailManager()
+
+    template_name = models.CharField(max_length=40)
+    recipients = models.JSONField()
+    params = models.JSONField(null=True, blank=True)
+
+    status = models.IntegerField(choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(default="", blank=True)
+
+    created_on = models.DateTimeField(default=timezone.now)
+    scheduled_on = models.DateTimeField(default=timezone.now)
+    sent_on = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "courriel sortant"
+        verbose_name_plural = "courriels sortants"
+        indexes = [models.Index(fields=["status", "scheduled_on"])]
+
+    def __str__(self):  # pragma: nocover
+        return f"{self.template_name} - {self.get_status_display()}"
+
+
+class DigestCheckpoint(models.Model):
+    """A kind of digest fully sent to a user during a digest run"""
+
+    run = models.CharField(max_length=32)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="+"
+    )
+    kind = models.CharField(max_length=40)
+    created_on = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = "point de reprise des résumés"
+        verbose_name_plural = "points de reprise des résumés"
+        unique_together = ("run", "user", "kind")
+
+    def __str__(self):  # pragma: nocover
+        return f"{self.run} - {self.user_id} - {self.kind}"
+
+
 # eof
@@ -0,0 +1,105 @@
+# encoding: utf-8
+
+"""
+draining of the outbound email queue
+
+Several workers can drain the queue concurrently: each batch is claimed with a
+SELECT ... FOR UPDATE SKIP LOCKED in a short transaction that leases its emails,
+pushing back their schedule and counting the attempt, so a queued email is
+only handled by one of them.  Emails are then sent outside of any transaction
+and their outcome recorded in a second one.  Emails of a worker dying while
+sending are due again once their lease expires.
+
+Failed emails are retried later with an exponential backoff and dead-lettered
+once they reach the maximum number of attempts.
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import api
+from .dispatch import EmailDispatcher
+from .models import OutboundEmail
+
+# delay before the first retry, doubled for each new attempt
+RETRY_DELAY = timedelta(minutes=1)
+
+
+def drain_outbound_emails(batch_size=50, max_attempts=None):
+    """Send one batch of due queued emails, return (sent, failed) counts"""
+    max_attempts = max_attempts or getattr(settings, "SENDINBLUE_QUEUE_MAX_ATTEMPTS", 5)
+
+    emails, failed = claim_outbound_emails(batch_size, max_attempts)
+    if not emails:
+        return 0, len(failed)
+
+    # retries are handled by the queue itself, not the dispatcher
+    with EmailDispatcher(send=api.deliver_email, max_retries=0) as dispatcher:
+        futures = [
+            dispatcher.submit(email.template_name, email.recipients, email.params)
+            for email in emails
+        ]
+
+    now = timezone.now()
+    sent = []
+    for email, future in zip(emails, futures):
+        error = future.exception()
+        if error is None and future.result() is False:
+            error = "email template not found"
+        if error is None:
+            email.status = OutboundEmail.SENT
+            email.sent_on = now
+            sent.append(email)
+        else:
+            record_failure(email, error, now, max_attempts)
+            failed.append(email)
+
+    with transaction.atomic():
+        OutboundEmail.objects.bulk_update(
+            emails, ["status", "sent_on", "last_error", "scheduled_on"]
+        )
+
+    return len(sent), len(failed)
+
+
+def claim_outbound_emails(batch_size, max_attempts):
+    """
+    Lease a batch of due emails to this worker, return (claimed, dead) emails,
+    dead ones being those left by crashed workers with no attempt left
+    """
+    lease = timedelta(seconds=getattr(settings, "SENDINBLUE_QUEUE_LEASE", 600))
+
+    with transaction.atomic():
+        emails = list(
+            OutboundEmail.pending.select_for_update(skip_locked=True)[:batch_size]
+        )
+        now = timezone.now()
+        claimed, dead = [], []
+        for email in emails:
+            if email.attempts >= max_attempts:
+                email.status = OutboundEmail.DEAD
+                dead.append(email)
+            else:
+                email.attempts += 1
+                email.scheduled_on = now + lease
+                claimed.append(email)
+        OutboundEmail.objects.bulk_update(
+            emails, ["status", "attempts", "scheduled_on"]
+        )
+
+    return claimed, dead
+
+
+def record_failure(email, error, now, max_attempts):
+    """Schedule a new attempt for email or dead-letter it"""
+    email.last_error = str(error)
+    if email.attempts >= max_attempts:
+        email.status = OutboundEmail.DEAD
+    else:
+        email.scheduled_on = now + RETRY_DELAY * 2 ** (email.attempts - 1)
+
+
+# eof
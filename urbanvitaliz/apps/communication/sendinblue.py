@@ -1,11 +1,18 @@
+import functools
+
 import sib_api_v3_sdk
 from django.conf import settings
 
 
 class SendInBlue:
-    def __init__(self):
+    def __init__(self, api_key=None, host=None, pool_size=None):
         self.configuration = sib_api_v3_sdk.Configuration()
-        self.configuration.api_key["api-key"] = settings.SENDINBLUE_API_KEY
+        self.configuration.api_key["api-key"] = api_key or settings.SENDINBLUE_API_KEY
+        host = host or getattr(settings, "SENDINBLUE_API_HOST", None)
+        if host:
+            self.configuration.host = host
+        if pool_size:
+            self.configuration.connection_pool_maxsize = pool_size
         self.api_instance = sib_api_v3_sdk.TransactionalEmailsApi(
             sib_api_v3_sdk.ApiClient(self.configuration)
         )
@@ -29,13 +36,7 @@ class SendInBlue:
                 template_id, send_test_email
             )
         else:
-            send_to = [
-                sib_api_v3_sdk.SendSmtpEmailTo(
-                    name=recipient.get("name", "Utilisateur UrbanVitaliz"),
-                    email=recipient["email"],
-                )
-                for recipient in recipients
-            ]
+            send_to = make_recipients(recipients, sib_api_v3_sdk.SendSmtpEmailTo)
 
             send_smtp_email = sib_api_v3_sdk.SendSmtpEmail(
                 template_id=template_id, to=send_to, params=params
@@ -43,3 +44,43 @@ class SendInBlue:
             response = self.api_instance.send_transac_email(send_smtp_email)
 
         return response
+
+    def send_email_versions(self, template_id, versions):
+        """Send template to each (recipients, params) version in a single call"""
+        all_params = [params for _, params in versions]
+        identical = all(params == all_params[0] for params in all_params)
+
+        message_versions = [
+            sib_api_v3_sdk.SendSmtpEmailMessageVersions(
+                to=make_recipients(recipients, sib_api_v3_sdk.SendSmtpEmailTo1),
+                params=None if identical else params,
+            )
+            for recipients, params in versions
+        ]
+
+        send_smtp_email = sib_api_v3_sdk.SendSmtpEmail(
+            template_id=template_id,
+            params=all_params[0] if identical else None,
+            message_versions=message_versions,
+        )
+        return self.api_instance.send_transac_email(send_smtp_email)
+
+
+def make_recipients(recipients, model):
+    """Return the sendinblue representation of recipients"""
+    if type(recipients) is not list:
+        recipients = [recipients]
+
+    return [
+        model(
+            name=recipient.get("name", "Utilisateur UrbanVitaliz"),
+            email=recipient["email"],
+        )
+        for recipient in recipients
+    ]
+
+
+@functools.lru_cache(maxsize=None)
+def get_client():
+    """Return the process wide client, sharing its http connection pool"""
+    return SendInBlue(pool_size=getattr(settings, "SENDINBLUE_DISPATCH_WORKERS", None))
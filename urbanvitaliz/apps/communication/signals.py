@@ -0,0 +1,15 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import api, models
+
+
+@receiver(post_save, sender=models.EmailTemplate, dispatch_uid="email_template_saved")
+@receiver(
+    post_delete, sender=models.EmailTemplate, dispatch_uid="email_template_deleted"
+)
+def reset_email_templates_cache(sender, **kwargs):
+    api.reset_email_templates_cache()
+
+
+# eof
@@ -0,0 +1,60 @@
+# encoding: utf-8
+
+"""
+tests for the digest pipeline benchmark
+"""
+
+import pytest
+from django.contrib.auth import models as auth
+from django.core.management import call_command
+from notifications import models as notifications_models
+
+from . import benchmark
+
+
+@pytest.mark.django_db
+def test_benchmark_sends_digests_and_rolls_back():
+    result = benchmark.run_digest_benchmark(
+        users=20, projects=5, notifications=100, reminders=10, seed=1
+    )
+
+    assert result.emails == sum(result.digests.values())
+    assert result.digests["reminders"] > 0
+    assert result.queries > 0
+    assert result.peak_memory > 0
+    assert auth.User.objects.count() == 0
+    assert notifications_models.Notification.objects.count() == 0
+
+
+@pytest.mark.django_db
+def test_benchmark_queries_do_not_grow_with_notifications():
+    small = benchmark.run_digest_benchmark(
+        users=20, projects=5, notifications=100, reminders=10, seed=1
+    )
+    large = benchmark.run_digest_benchmark(
+        users=20, projects=5, notifications=400, reminders=10, seed=1
+    )
+
+    assert large.queries <= small.queries + 5
+
+
+@pytest.mark.django_db
+def test_benchdigests_command_reports_measures(capsys):
+    call_command(
+        "benchdigests",
+        "--users",
+        "10",
+        "--projects",
+        "3",
+        "--notifications",
+        "30",
+        "--reminders",
+        "3",
+    )
+
+    out = capsys.readouterr().out
+    assert "wall time" in out
+    assert "queries" in out
+
+
+# eof
@@ -7,7 +7,11 @@ authors: guillaume.libersat@beta.gouv.fr, raphael.marvie@beta.gouv.fr
 created: 2022-02-03 16:14:54 CET
 """
 
+import datetime
+
 from django.contrib.auth import models as auth
+from django.urls import reverse
+from django.utils import timezone
 from model_bakery import baker
 from model_bakery.recipe import Recipe
 from notifications import models as notifications_models
@@ -16,11 +20,64 @@ from urbanvitaliz.apps.addressbook import models as addressbook_models
 from urbanvitaliz.apps.geomatics import models as geomatics_models
 from urbanvitaliz.apps.projects import models as projects_models
 from urbanvitaliz.apps.projects import signals as projects_signals
+from urbanvitaliz.apps.reminders import models as reminders_models
 from urbanvitaliz.apps.resources import models as resources_models
 
 from . import digests
 from .digests import NotificationFormatter
 
+########################################################################
+# reminder digests
+########################################################################
+
+
+def test_send_digests_for_task_reminders_by_user(mocker):
+    send_email = mocker.patch("urbanvitaliz.apps.communication.digests.send_email")
+    user = baker.make(auth.User, email="owner@example.org")
+    today = datetime.date.today()
+    tasks = baker.make(projects_models.Task, _quantity=2)
+    tasks.append(baker.make(projects_models.Task, project=tasks[0].project))
+    for task in tasks:
+        baker.make(
+            reminders_models.Reminder,
+            recipient=user.email,
+            deadline=today,
+            related=task,
+        )
+    deleted = baker.make(projects_models.Task)
+    baker.make(
+        reminders_models.Reminder, recipient=user.email, deadline=today, related=deleted
+    )
+    deleted.project.deleted = timezone.now()
+    deleted.project.save()
+
+    assert digests.send_digests_for_task_reminders_by_user(user) == 3
+
+    assert send_email.call_count == 2
+    counts = sorted(
+        call.kwargs["params"]["notification_count"]
+        for call in send_email.call_args_list
+    )
+    assert counts == [1, 2]
+    assert reminders_models.Reminder.sent.count() == 3
+    assert (
+        reminders_models.Reminder.to_send.filter(
+            deadline=today + datetime.timedelta(weeks=6)
+        ).count()
+        == 3
+    )
+    assert reminders_models.Reminder.objects.count() == 6
+
+
+def test_send_digests_for_task_reminders_by_user_without_reminders(mocker):
+    send_email = mocker.patch("urbanvitaliz.apps.communication.digests.send_email")
+    user = baker.make(auth.User, email="owner@example.org")
+
+    assert digests.send_digests_for_task_reminders_by_user(user) == 0
+
+    send_email.assert_not_called()
+
+
 ########################################################################
 # new reco digests
 ########################################################################
@@ -61,6 +118,51 @@ def test_send_digests_for_new_reco_empty(client):
     assert membership.member.notifications.unsent().count() == 0
 
 
+########################################################################
+# pre-rendered digest fragments
+########################################################################
+
+
+def test_new_reco_notification_stores_digest_fragment(client):
+    membership = baker.make(projects_models.ProjectMember, is_owner=True)
+    switchtender = Recipe(auth.User, email="switchtender@example.com").make()
+    project = baker.make(
+        projects_models.Project, status="DONE", projectmember_set=[membership]
+    )
+    task = projects_models.Task.objects.create(
+        project=project, created_by=switchtender, intent="Do it", public=True
+    )
+
+    projects_signals.action_created.send(
+        sender=test_new_reco_notification_stores_digest_fragment,
+        task=task,
+        project=project,
+        user=switchtender,
+    )
+
+    notification = membership.member.notifications.unsent().get()
+    fragment = digests.get_digest_fragment(notification)
+    assert fragment["project"]["name"] == project.name
+    assert fragment["project"]["path"] == reverse(
+        "projects-project-detail", args=[project.id]
+    )
+    assert fragment["action"]["intent"] == "Do it"
+    assert "url" not in fragment["action"]
+    assert fragment["notification"]["summary"]
+
+
+def test_action_digest_from_fragment_adds_recipient_url(client):
+    user = baker.make(auth.User)
+    fragment = {"intent": "Do it", "path": "/projects/1/actions#action-2"}
+
+    digest = digests.action_digest_from_fragment(fragment, user)
+
+    assert digest["intent"] == "Do it"
+    assert "path" not in digest
+    assert "/projects/1/actions" in digest["url"]
+    assert "sesame" in digest["url"]
+
+
 ########################################################################
 # new sites digests
 ########################################################################
@@ -269,4 +371,45 @@ def test_notification_formatter():
         assert tests[idx][2][1] == fmt_reco.excerpt
 
 
+def test_notification_formatter_format_many_resolves_objects_in_bulk(
+    django_assert_max_num_queries,
+):
+    recipient = Recipe(auth.User).make()
+    organization = Recipe(addressbook_models.Organization, name="DuckCorp").make()
+    resource = Recipe(resources_models.Resource, title="Belle Ressource").make()
+    project = Recipe(projects_models.Project, name="Nice Project").make()
+    for idx in range(5):
+        user = Recipe(auth.User, first_name=f"Bob{idx}", last_name="Joe").make()
+        user.profile.organization = organization
+        user.profile.save()
+        task = Recipe(projects_models.Task, resource=resource).make()
+        followup = Recipe(projects_models.TaskFollowup, task=task).make()
+        for verb, action_object in (
+            ("a recommandé l'action", task),
+            ("a commenté l'action", followup),
+            ("a déposé le projet", project),
+        ):
+            notify.send(
+                sender=user,
+                recipient=recipient,
+                verb=verb,
+                action_object=action_object,
+                target=project,
+            )
+
+    formatter = NotificationFormatter()
+    expected = [
+        formatter.format(notification)
+        for notification in notifications_models.Notification.objects.all()
+    ]
+
+    notifications = list(notifications_models.Notification.objects.all())
+    # one query per content type of actors and action objects
+    with django_assert_max_num_queries(4):
+        formatted = formatter.format_many(notifications)
+
+    assert len(formatted) == 15
+    assert formatted == expected
+
+
 # eof
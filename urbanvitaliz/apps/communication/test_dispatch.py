@@ -0,0 +1,174 @@
+# encoding: utf-8
+
+"""
+tests for parallel email dispatching
+"""
+
+import time
+
+import pytest
+from model_bakery import baker
+from sib_api_v3_sdk.rest import ApiException
+
+from . import api, models
+from .dispatch import EmailDispatcher, RateLimiter, batch_by_template
+from .fake_sendinblue import FakeSendInBlueServer
+from .sendinblue import SendInBlue
+
+########################################################################
+# template cache
+########################################################################
+
+
+@pytest.mark.django_db
+def test_email_template_id_is_cached(django_assert_num_queries):
+    baker.make(models.EmailTemplate, name="hello", sib_id=12)
+    api.reset_email_templates_cache()
+
+    assert api.get_email_template_id("HELLO") == 12
+    with django_assert_num_queries(0):
+        assert api.get_email_template_id("hello") == 12
+
+
+@pytest.mark.django_db
+def test_email_template_cache_is_reset_on_update():
+    template = baker.make(models.EmailTemplate, name="hello", sib_id=12)
+    assert api.get_email_template_id("hello") == 12
+
+    template.sib_id = 13
+    template.save()
+
+    assert api.get_email_template_id("hello") == 13
+
+
+########################################################################
+# dispatcher
+########################################################################
+
+
+def test_rate_limiter_throttles_calls():
+    limiter = RateLimiter(rate=20)
+    start = time.monotonic()
+    for _ in range(30):
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.4
+
+
+@pytest.mark.django_db
+def test_dispatcher_sends_all_emails():
+    sent = []
+
+    def send(template_name, recipients, params=None):
+        sent.append((template_name, recipients["email"]))
+        return True
+
+    with EmailDispatcher(send=send, max_workers=3, rate_limit=0) as dispatcher:
+        for idx in range(10):
+            dispatcher.submit("hello", {"email": f"{idx}@example.com"})
+
+    assert len(sent) == 10
+
+
+@pytest.mark.django_db
+def test_dispatcher_retries_transient_failures():
+    calls = []
+
+    def send(template_name, recipients, params=None):
+        calls.append(template_name)
+        if len(calls) < 3:
+            raise ApiException(status=429, reason="Too Many Requests")
+        return True
+
+    dispatcher = EmailDispatcher(send=send, rate_limit=0, max_retries=3, backoff=0)
+    future = dispatcher.submit("hello", {"email": "bob@example.com"})
+
+    assert future.result() is True
+    assert len(calls) == 3
+    assert dispatcher.close() == 0
+
+
+@pytest.mark.django_db
+def test_dispatcher_does_not_retry_client_errors():
+    calls = []
+
+    def send(template_name, recipients, params=None):
+        calls.append(template_name)
+        raise ApiException(status=400, reason="Bad Request")
+
+    dispatcher = EmailDispatcher(send=send, rate_limit=0, max_retries=3, backoff=0)
+    dispatcher.submit("hello", {"email": "bob@example.com"})
+
+    assert dispatcher.close() == 1
+    assert len(calls) == 1
+
+
+@pytest.mark.django_db
+def test_dispatcher_splits_rejected_batches():
+    calls = []
+
+    def send_batch(template_name, versions):
+        calls.append(len(versions))
+        if any(recipient["email"] == "bad" for recipient, _ in versions):
+            raise ApiException(status=400, reason="Bad Request")
+        return True
+
+    versions = [({"email": email}, {}) for email in ("a@x.org", "bad", "c@x.org")]
+    with EmailDispatcher(send_batch=send_batch, rate_limit=0, backoff=0) as dispatcher:
+        future = dispatcher.submit_batch("hello", versions)
+
+    assert future.result() == [1]
+    assert calls == [3, 1, 1, 1]
+
+
+def test_batch_by_template_yields_full_batches_lazily():
+    def emails():
+        yield ("a", 1)
+        yield ("b", 2)
+        yield ("a", 3)
+        raise AssertionError("read past the first full batch")
+
+    batches = batch_by_template(emails(), max_batch_size=2)
+
+    assert next(batches) == ("a", [("a", 1), ("a", 3)])
+
+
+def test_batch_by_template_flushes_partial_batches():
+    emails = [("a", 1), ("b", 2), ("a", 3), ("a", 4)]
+
+    assert list(batch_by_template(emails, max_batch_size=2)) == [
+        ("a", [("a", 1), ("a", 3)]),
+        ("b", [("b", 2)]),
+        ("a", [("a", 4)]),
+    ]
+
+
+########################################################################
+# against the fake sendinblue server
+########################################################################
+
+
+@pytest.mark.django_db
+def test_dispatcher_throughput_against_fake_sendinblue():
+    baker.make(models.EmailTemplate, name="digest", sib_id=1)
+
+    with FakeSendInBlueServer(latency=0.01, failures=2) as server:
+        sib = SendInBlue(host=server.url, pool_size=4)
+
+        def send(template_name, recipients, params=None):
+            template_id = api.get_email_template_id(template_name)
+            return sib.send_email(template_id, recipients, params)
+
+        with EmailDispatcher(
+            send=send, max_workers=4, rate_limit=0, backoff=0
+        ) as dispatcher:
+            for idx in range(40):
+                dispatcher.submit(
+                    "digest", {"email": f"{idx}@example.com"}, params={"idx": idx}
+                )
+
+    assert len(server.emails) == 40
+    assert len(server.requests) == 42
+    assert server.emails[0]["templateId"] == 1
+
+
+# eof
@@ -0,0 +1,429 @@
+# encoding: utf-8
+
+"""
+tests for the set based digest engine
+"""
+
+import datetime
+import json
+
+import pytest
+from django.contrib.auth import models as auth
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.urls import reverse
+from django.utils import timezone
+from model_bakery import baker
+from model_bakery.recipe import Recipe
+from sib_api_v3_sdk.rest import ApiException
+from urbanvitaliz.apps.geomatics import models as geomatics_models
+from urbanvitaliz.apps.projects import models as projects_models
+from urbanvitaliz.apps.projects import signals as projects_signals
+from urbanvitaliz.apps.reminders import models as reminders_models
+from urbanvitaliz.utils import login
+
+from . import digests, engine, models
+
+
+@pytest.fixture
+def sent_emails(mocker):
+    """Collect (template_name, recipient, params) of each email sent by the engine"""
+    sent = []
+
+    def send_batch(template_name, versions):
+        sent.extend(
+            (template_name, recipient, params) for recipient, params in versions
+        )
+        return True
+
+    mocker.patch(
+        "urbanvitaliz.apps.communication.engine.deliver_email_batch",
+        side_effect=send_batch,
+    )
+    return sent
+
+
+########################################################################
+# new reco digests
+########################################################################
+
+
+@pytest.mark.django_db
+def test_engine_sends_new_reco_digest_to_members(sent_emails):
+    membership = baker.make(projects_models.ProjectMember, is_owner=True)
+    switchtender = Recipe(auth.User, email="switchtender@example.com").make()
+    project = baker.make(
+        projects_models.Project, status="DONE", projectmember_set=[membership]
+    )
+
+    projects_signals.action_created.send(
+        sender=test_engine_sends_new_reco_digest_to_members,
+        task=projects_models.Task.objects.create(
+            project=project, created_by=switchtender, public=True
+        ),
+        project=project,
+        user=switchtender,
+    )
+
+    counts = engine.send_all_digests()
+
+    assert counts["new_recommendations"] == 1
+    template_name, recipient, params = sent_emails[0]
+    assert template_name == "new_recommendations_digest"
+    assert recipient["email"] == membership.member.email
+    assert params["notification_count"] == 1
+    assert params["project"]["name"] == project.name
+    assert membership.member.notifications.unsent().count() == 0
+
+
+@pytest.mark.django_db
+def test_engine_builds_new_reco_digest_from_fragments(sent_emails, mocker):
+    membership = baker.make(projects_models.ProjectMember, is_owner=True)
+    switchtender = Recipe(auth.User, email="switchtender@example.com").make()
+    project = baker.make(
+        projects_models.Project, status="DONE", projectmember_set=[membership]
+    )
+    projects_signals.action_created.send(
+        sender=test_engine_builds_new_reco_digest_from_fragments,
+        task=projects_models.Task.objects.create(
+            project=project, created_by=switchtender, intent="Do it", public=True
+        ),
+        project=project,
+        user=switchtender,
+    )
+    make_action_digest = mocker.spy(digests, "make_action_digest")
+    make_project_digest = mocker.spy(digests, "make_project_digest")
+
+    engine.send_all_digests()
+
+    _, _, params = sent_emails[0]
+    assert params["recos"][0]["intent"] == "Do it"
+    assert "sesame" in params["recos"][0]["url"]
+    assert params["project"]["name"] == project.name
+    make_action_digest.assert_not_called()
+    make_project_digest.assert_not_called()
+
+
+@pytest.mark.django_db
+def test_engine_sends_nothing_without_pending_notifications(sent_emails):
+    membership = baker.make(projects_models.ProjectMember)
+    baker.make(projects_models.Project, status="DONE", projectmember_set=[membership])
+
+    assert engine.send_all_digests() == {}
+
+    assert sent_emails == []
+
+
+########################################################################
+# switchtender digests
+########################################################################
+
+
+@pytest.mark.django_db
+def test_engine_sends_new_site_and_general_digests_to_switchtenders(sent_emails):
+    st_group = auth.Group.objects.get(name="switchtender")
+
+    dpt_nord = Recipe(geomatics_models.Department, code=59, name="Nord").make()
+    commune = Recipe(
+        geomatics_models.Commune, name="Lille", postal="59000", department=dpt_nord
+    ).make()
+    regional_actor = Recipe(auth.User).make()
+    regional_actor.groups.add(st_group)
+    regional_actor.profile.departments.add(dpt_nord)
+
+    membership = baker.make(projects_models.ProjectMember, is_owner=True)
+    project = baker.make(
+        projects_models.Project,
+        projectmember_set=[membership],
+        commune=commune,
+        status="READY",
+    )
+
+    projects_signals.project_validated.send(
+        sender=projects_models.Project, moderator=regional_actor, project=project
+    )
+    other_actor = Recipe(auth.User).make()
+    other_actor.groups.add(st_group)
+    projects_signals.project_switchtender_joined.send(
+        sender=other_actor, project=project
+    )
+
+    assert regional_actor.notifications.unsent().count() == 2
+
+    counts = engine.send_all_digests()
+
+    assert counts["new_sites"] == 1
+    assert counts["digest_for_switchtender"] == 1
+    assert counts["digest_for_non_switchtender"] == 1
+    sent = {template_name: params for template_name, _, params in sent_emails}
+    general = sent["digest_for_switchtender"]
+    assert general["notification_count"] == 1
+    assert general["projects"][0]["name"] == project.name
+    assert regional_actor.notifications.unsent().count() == 0
+    assert membership.member.notifications.unsent().count() == 0
+
+
+########################################################################
+# reminders
+########################################################################
+
+
+@pytest.mark.django_db
+def test_engine_sends_and_rearms_due_reminders(sent_emails):
+    today = datetime.date.today()
+    user = baker.make(auth.User, email="owner@example.org")
+    task = baker.make(projects_models.Task)
+    reminder = baker.make(
+        reminders_models.Reminder, recipient=user.email, deadline=today, related=task
+    )
+
+    counts = engine.send_all_digests()
+
+    assert counts["reminders"] == 1
+    _, _, params = sent_emails[0]
+    assert params["project"]["name"] == task.project.name
+    assert len(params["recos"]) == 1
+    rearmed = reminders_models.Reminder.to_send.get()
+    assert rearmed.deadline == today + datetime.timedelta(weeks=6)
+    assert reminders_models.Reminder.sent.get().id == reminder.id
+
+
+@pytest.mark.django_db
+def test_engine_drops_reminders_of_deleted_projects(sent_emails):
+    user = baker.make(auth.User, email="owner@example.org")
+    task = baker.make(projects_models.Task)
+    baker.make(
+        reminders_models.Reminder,
+        recipient=user.email,
+        deadline=datetime.date.today(),
+        related=task,
+    )
+    task.project.deleted = timezone.now()
+    task.project.save()
+
+    engine.send_all_digests()
+
+    assert sent_emails == []
+    assert reminders_models.Reminder.objects.count() == 0
+
+
+########################################################################
+# command
+########################################################################
+
+
+@pytest.mark.django_db
+def test_senddigests_command_uses_engine(mocker):
+    mocker.patch(
+        "urbanvitaliz.apps.communication.engine.send_all_digests", return_value={}
+    )
+
+    call_command("senddigests")
+
+    engine.send_all_digests.assert_called_once()
+
+
+@pytest.mark.django_db
+def test_engine_batches_digests_sharing_a_template(mocker, settings):
+    settings.SENDINBLUE_BATCH_MAX_SIZE = 2
+    send_batch = mocker.patch(
+        "urbanvitaliz.apps.communication.engine.deliver_email_batch"
+    )
+    task = baker.make(projects_models.Task)
+    for idx in range(5):
+        user = baker.make(auth.User, email=f"owner{idx}@example.org")
+        baker.make(
+            reminders_models.Reminder,
+            recipient=user.email,
+            deadline=datetime.date.today(),
+            related=task,
+        )
+
+    counts = engine.send_all_digests()
+
+    assert counts["reminders"] == 5
+    assert send_batch.call_count == 3
+    assert [len(call.args[1]) for call in send_batch.call_args_list] == [2, 2, 1]
+
+
+@pytest.mark.django_db
+def test_engine_only_flags_digests_of_accepted_recipients(mocker):
+    def send_batch(template_name, versions):
+        if any(recipient["email"] == "bad@example.org" for recipient, _ in versions):
+            raise ApiException(status=400, reason="Bad Request")
+        return True
+
+    mocker.patch(
+        "urbanvitaliz.apps.communication.engine.deliver_email_batch",
+        side_effect=send_batch,
+    )
+    task = baker.make(projects_models.Task)
+    for email in ("good@example.org", "bad@example.org"):
+        baker.make(
+            reminders_models.Reminder,
+            recipient=baker.make(auth.User, email=email).email,
+            deadline=datetime.date.today(),
+            related=task,
+        )
+
+    assert engine.send_all_digests() == {"reminders": 1}
+
+    assert reminders_models.Reminder.sent.get().recipient == "good@example.org"
+
+
+########################################################################
+# sharding and checkpoints
+########################################################################
+
+
+def make_due_reminder(user):
+    baker.make(
+        reminders_models.Reminder,
+        recipient=user.email,
+        deadline=datetime.date.today(),
+        related=baker.make(projects_models.Task),
+    )
+
+
+@pytest.mark.django_db
+def test_engine_only_sends_digests_of_its_shard(sent_emails):
+    users = [baker.make(auth.User, email=f"owner{idx}@example.org") for idx in range(4)]
+    for user in users:
+        make_due_reminder(user)
+
+    counts = engine.send_all_digests(shard=(1, 2))
+
+    assert counts["reminders"] == 2
+    expected = {user.email for user in users if user.id % 2 == 1}
+    assert {recipient["email"] for _, recipient, _ in sent_emails} == expected
+    assert (
+        reminders_models.Reminder.to_send.filter(
+            recipient__in=[user.email for user in users if user.id % 2 == 0]
+        ).count()
+        == 2
+    )
+
+
+@pytest.mark.django_db
+def test_engine_checkpoints_sent_digests(sent_emails):
+    user = baker.make(auth.User, email="owner@example.org")
+    make_due_reminder(user)
+
+    engine.send_all_digests(run="run-1")
+
+    checkpoint = models.DigestCheckpoint.objects.get()
+    assert (checkpoint.run, checkpoint.user, checkpoint.kind) == (
+        "run-1",
+        user,
+        "reminders",
+    )
+
+
+@pytest.mark.django_db
+def test_engine_resume_skips_checkpointed_digests(sent_emails):
+    user = baker.make(auth.User, email="owner@example.org")
+    make_due_reminder(user)
+    baker.make(models.DigestCheckpoint, run="run-1", user=user, kind="reminders")
+
+    assert engine.send_all_digests(run="run-1", resume=True) == {}
+    assert sent_emails == []
+
+    assert engine.send_all_digests(run="run-2", resume=True) == {"reminders": 1}
+
+
+@pytest.mark.django_db
+def test_engine_does_not_flag_digests_that_failed(mocker):
+    mocker.patch(
+        "urbanvitaliz.apps.communication.engine.deliver_email_batch",
+        side_effect=RuntimeError("boom"),
+    )
+    make_due_reminder(baker.make(auth.User, email="owner@example.org"))
+
+    assert engine.send_all_digests() == {}
+
+    assert reminders_models.Reminder.to_send.count() == 1
+    assert models.DigestCheckpoint.objects.count() == 0
+
+
+@pytest.mark.django_db
+def test_senddigests_command_passes_shard_and_resume(mocker):
+    mocker.patch(
+        "urbanvitaliz.apps.communication.engine.send_all_digests", return_value={}
+    )
+
+    call_command("senddigests", "--shard", "2/3", "--run", "r", "--resume")
+
+    engine.send_all_digests.assert_called_once_with(shard=(1, 3), run="r", resume=True)
+
+
+def test_senddigests_command_rejects_invalid_shard():
+    with pytest.raises(CommandError):
+        call_command("senddigests", "--shard", "4/3")
+
+
+########################################################################
+# preview
+########################################################################
+
+
+@pytest.mark.django_db
+def test_preview_digests_sends_and_flags_nothing(sent_emails):
+    user = baker.make(auth.User, email="owner@example.org")
+    make_due_reminder(user)
+    make_due_reminder(baker.make(auth.User, email="other@example.org"))
+
+    previews = list(engine.preview_digests([user.id]))
+
+    assert [(p["user"], p["kind"]) for p in previews] == [(user.id, "reminders")]
+    assert "sesame" not in previews[0]["params"]["project"]["url"]
+    assert sent_emails == []
+    assert reminders_models.Reminder.to_send.count() == 2
+
+
+@pytest.mark.django_db
+def test_preview_digests_defaults_to_users_with_pending_digests(sent_emails):
+    for idx in range(3):
+        make_due_reminder(baker.make(auth.User, email=f"owner{idx}@example.org"))
+    baker.make(auth.User, email="idle@example.org")
+
+    previews = list(engine.preview_digests(chunk_size=2))
+
+    assert len(previews) == 3
+
+
+@pytest.mark.django_db
+def test_digests_preview_not_available_for_non_staff(client):
+    with login(client):
+        response = client.get(reverse("communication-digests-preview"))
+
+    assert response.status_code == 302
+
+
+@pytest.mark.django_db
+def test_digests_preview_streams_ndjson_for_staff(client):
+    user = baker.make(auth.User, email="owner@example.org")
+    make_due_reminder(user)
+
+    with login(client, is_staff=True):
+        response = client.get(
+            reverse("communication-digests-preview"), {"users": str(user.id)}
+        )
+
+    assert response.status_code == 200
+    assert response["Content-Type"] == "application/x-ndjson"
+    lines = b"".join(response.streaming_content).decode().splitlines()
+    assert [json.loads(line)["kind"] for line in lines] == ["reminders"]
+
+
+@pytest.mark.django_db
+def test_previewdigests_command_prints_ndjson(capsys):
+    user = baker.make(auth.User, email="owner@example.org")
+    make_due_reminder(user)
+
+    call_command("previewdigests", str(user.id))
+
+    lines = capsys.readouterr().out.splitlines()
+    assert json.loads(lines[0])["email"] == user.email
+
+
+# eof
@@ -0,0 +1,126 @@
+# encoding: utf-8
+
+"""
+tests for the outbound email queue
+"""
+
+import pytest
+from django.core.management import call_command
+from model_bakery import baker
+
+from . import api, outbox
+from .models import OutboundEmail
+
+
+@pytest.fixture
+def delivered(mocker):
+    return mocker.patch(
+        "urbanvitaliz.apps.communication.api.deliver_email", return_value=True
+    )
+
+
+@pytest.mark.django_db
+def test_queue_email_stores_email_without_sending(delivered):
+    api.queue_email("sharing invitation", {"email": "bob@example.com"}, {"p": 1})
+
+    email = OutboundEmail.pending.get()
+    assert email.template_name == "sharing invitation"
+    assert email.recipients == [{"email": "bob@example.com"}]
+    assert email.params == {"p": 1}
+    delivered.assert_not_called()
+
+
+@pytest.mark.django_db
+def test_drain_sends_pending_emails(delivered):
+    baker.make(OutboundEmail, template_name="hello", recipients=[], _quantity=3)
+
+    assert outbox.drain_outbound_emails(batch_size=2) == (2, 0)
+    assert outbox.drain_outbound_emails(batch_size=2) == (1, 0)
+    assert outbox.drain_outbound_emails(batch_size=2) == (0, 0)
+
+    assert delivered.call_count == 3
+    assert OutboundEmail.objects.filter(status=OutboundEmail.SENT).count() == 3
+
+
+@pytest.mark.django_db
+def test_drain_reschedules_failed_emails(mocker):
+    mocker.patch(
+        "urbanvitaliz.apps.communication.api.deliver_email",
+        side_effect=RuntimeError("boom"),
+    )
+    email = baker.make(OutboundEmail, template_name="hello", recipients=[])
+
+    assert outbox.drain_outbound_emails() == (0, 1)
+
+    email.refresh_from_db()
+    assert email.status == OutboundEmail.PENDING
+    assert email.attempts == 1
+    assert email.last_error == "boom"
+    assert email.scheduled_on > email.created_on
+    assert OutboundEmail.pending.count() == 0
+
+
+@pytest.mark.django_db
+def test_drain_dead_letters_after_max_attempts(mocker):
+    mocker.patch(
+        "urbanvitaliz.apps.communication.api.deliver_email", return_value=False
+    )
+    email = baker.make(
+        OutboundEmail, template_name="unknown", recipients=[], attempts=4
+    )
+
+    assert outbox.drain_outbound_emails(max_attempts=5) == (0, 1)
+
+    email.refresh_from_db()
+    assert email.status == OutboundEmail.DEAD
+    assert email.last_error == "email template not found"
+
+
+@pytest.mark.django_db
+def test_claimed_emails_are_leased_to_the_worker():
+    baker.make(OutboundEmail, template_name="hello", recipients=[], _quantity=2)
+
+    claimed, dead = outbox.claim_outbound_emails(batch_size=10, max_attempts=5)
+
+    assert (len(claimed), dead) == (2, [])
+    assert OutboundEmail.pending.count() == 0
+    assert {email.attempts for email in OutboundEmail.objects.all()} == {1}
+
+
+@pytest.mark.django_db
+def test_emails_of_crashed_workers_are_due_again_after_lease(settings, delivered):
+    settings.SENDINBLUE_QUEUE_LEASE = 0
+    email = baker.make(OutboundEmail, template_name="hello", recipients=[])
+
+    outbox.claim_outbound_emails(batch_size=10, max_attempts=5)
+
+    assert outbox.drain_outbound_emails() == (1, 0)
+    email.refresh_from_db()
+    assert (email.status, email.attempts) == (OutboundEmail.SENT, 2)
+
+
+@pytest.mark.django_db
+def test_emails_of_crashed_workers_are_dead_lettered_after_max_attempts(
+    settings, delivered
+):
+    settings.SENDINBLUE_QUEUE_LEASE = 0
+    email = baker.make(OutboundEmail, template_name="hello", recipients=[], attempts=5)
+
+    assert outbox.drain_outbound_emails(max_attempts=5) == (0, 1)
+
+    email.refresh_from_db()
+    assert email.status == OutboundEmail.DEAD
+    delivered.assert_not_called()
+
+
+@pytest.mark.django_db
+def test_sendemails_command_drains_queue(delivered):
+    baker.make(OutboundEmail, template_name="hello", recipients=[], _quantity=3)
+
+    call_command("sendemails", "--batch-size", "2")
+
+    assert OutboundEmail.pending.count() == 0
+    assert delivered.call_count == 3
+
+
+# eof
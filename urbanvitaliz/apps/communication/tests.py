@@ -54,3 +54,44 @@ def test_sib_send_test_email(mocker, client):
     )
 
     sib.api_instance.send_test_template.assert_called_once()
+
+
+def test_sib_send_email_versions_shares_identical_params(mocker, client):
+    sib = SendInBlue()
+
+    mocker.patch("sib_api_v3_sdk.TransactionalEmailsApi.send_transac_email")
+
+    sib.send_email_versions(
+        template_id=1,
+        versions=[
+            ({"name": "Bob", "email": "bob@example.com"}, {"p1": "v1"}),
+            ({"name": "Ana", "email": "ana@example.com"}, {"p1": "v1"}),
+        ],
+    )
+
+    sib.api_instance.send_transac_email.assert_called_once()
+    email = sib.api_instance.send_transac_email.call_args.args[0]
+    assert email.params == {"p1": "v1"}
+    assert [v.to[0].email for v in email.message_versions] == [
+        "bob@example.com",
+        "ana@example.com",
+    ]
+    assert all(v.params is None for v in email.message_versions)
+
+
+def test_sib_send_email_versions_with_distinct_params(mocker, client):
+    sib = SendInBlue()
+
+    mocker.patch("sib_api_v3_sdk.TransactionalEmailsApi.send_transac_email")
+
+    sib.send_email_versions(
+        template_id=1,
+        versions=[
+            ({"name": "Bob", "email": "bob@example.com"}, {"p1": "v1"}),
+            ({"name": "Ana", "email": "ana@example.com"}, {"p1": "v2"}),
+        ],
+    )
+
+    email = sib.api_instance.send_transac_email.call_args.args[0]
+    assert email.params is None
+    assert [v.params for v in email.message_versions] == [{"p1": "v1"}, {"p1": "v2"}]
@@ -0,0 +1,20 @@
+# encoding: utf-8
+
+"""
+Urls for communication application
+
+author  : raphael.marvie@beta.gouv.fr,guillaume.libersat@beta.gouv.fr
+created : 2022-06-27 10:21:44 CEST
+"""
+
+from django.urls import path
+
+from . import views
+
+urlpatterns = [
+    path(
+        r"communication/digests/preview/",
+        views.digests_preview,
+        name="communication-digests-preview",
+    ),
+]
@@ -0,0 +1,38 @@
+# encoding: utf-8
+
+"""
+Views for communication application
+"""
+
+import json
+
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponseBadRequest, StreamingHttpResponse
+
+from . import engine
+
+
+@staff_member_required
+def digests_preview(request):
+    """Stream as ndjson the digests that would be sent to given or all users"""
+    user_ids = None
+    if request.GET.get("users"):
+        try:
+            user_ids = [int(id) for id in request.GET["users"].split(",")]
+        except ValueError:
+            return HttpResponseBadRequest("users must be a list of user ids")
+
+    return StreamingHttpResponse(
+        as_ndjson(engine.preview_digests(user_ids)),
+        content_type="application/x-ndjson",
+    )
+
+
+def as_ndjson(items):
+    """Yield each item as a line of json"""
+    for item in items:
+        yield json.dumps(item, cls=DjangoJSONEncoder) + "\n"
+
+
+# eof
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class GeomaticsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "urbanvitaliz.apps.geomatics"
+
+    def ready(self):
+        import urbanvitaliz.apps.geomatics.signals  # noqa
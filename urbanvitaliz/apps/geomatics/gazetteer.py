@@ -0,0 +1,259 @@
+# encoding: utf-8
+
+"""
+In memory gazetteer of the communes
+
+Communes are static reference data, looked up on the public onboarding path.
+They are loaded once per process into compact columns, with sorted indexes
+searched by bisection on postal code, insee code and accent insensitive name
+prefixes, so that lookups and autocompletion do not hit the database.
+
+Each process checks every GAZETTEER_CHECK_INTERVAL seconds the version of the
+communes, read from the database, and reloads its gazetteer if it is outdated,
+so that changes made by other processes, such as the loadcommunes command,
+show up in every process.
+"""
+
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db.models import Count, Max
+
+from . import models
+
+
+class Gazetteer:
+    """Communes stored as columns with prefix indexes on their codes and name"""
+
+    def __init__(self, communes, departments, version=None):
+        """
+        Build the gazetteer from communes, a sequence of (id, insee, postal,
+        name, department code, latitude, longitude), and departments, a mapping
+        of department code to name
+        """
+        self.version = version
+
+        self.department_codes = sorted(departments)
+        self.department_names = [departments[c] for c in self.department_codes]
+        department_index = {c: i for i, c in enumerate(self.department_codes)}
+
+        self.ids = array("q")
+        self.insee = []
+        self.postal = []
+        self.names = []
+        self.departments = array("H")
+        self.latitudes = array("d")
+        self.longitudes = array("d")
+        for id, insee, postal, name, department, latitude, longitude in communes:
+            self.ids.append(id)
+            self.insee.append(insee)
+            self.postal.append(postal)
+            self.names.append(name)
+            self.departments.append(department_index[department])
+            self.latitudes.append(latitude)
+            self.longitudes.append(longitude)
+
+        self.insee_index = self.build_index(
+            (insee, 0, row) for row, insee in enumerate(self.insee)
+        )
+        self.postal_index = self.build_index(
+            (postal, 0, row) for row, postal in enumerate(self.postal)
+        )
+        # every word of a name starts a key, so that "clemenciat" finds
+        # "L'Abergement-Clémenciat", after names starting with the same key
+        self.name_index = self.build_index(
+            (key, rank, row)
+            for row, name in enumerate(self.names)
+            for rank, key in enumerate(name_keys(name))
+        )
+
+    def build_index(self, entries):
+        """
+        Return the sorted keys of (key, rank, row) entries and their rows,
+        ties ordered with whole names first then by commune id
+        """
+        entries = sorted(
+            entries, key=lambda entry: (entry[0], entry[1] > 0, self.ids[entry[2]])
+        )
+        return [key for key, _, _ in entries], array("l", [r for _, _, r in entries])
+
+    @classmethod
+    def load(cls, version=None):
+        """Build a gazetteer of the communes of the database"""
+        communes = models.Commune.objects.order_by().values_list(
+            "id", "insee", "postal", "name", "department_id", "latitude", "longitude"
+        )
+        departments = models.Department.objects.order_by().values_list("code", "name")
+        return cls(communes.iterator(), dict(departments), version=version)
+
+    def __len__(self):
+        return len(self.ids)
+
+    # -- lookups
+
+    def get_by_insee(self, code):
+        """Return the first commune with given insee code or None"""
+        return next(self.exact(self.insee_index, code), None)
+
+    def get_by_postal(self, code):
+        """Return the first commune with given postal code or None"""
+        return next(self.exact(self.postal_index, code), None)
+
+    def filter_postal(self, code):
+        """Return the communes sharing given postal code"""
+        return list(self.exact(self.postal_index, code))
+
+    def count_postal(self, code):
+        """Return the number of communes sharing given postal code"""
+        keys, _ = self.postal_index
+        start = bisect_left(keys, code)
+        end = start
+        while end < len(keys) and keys[end] == code:
+            end += 1
+        return end - start
+
+    def autocomplete(self, query, limit=10):
+        """
+        Return up to limit communes matching query, a prefix of their postal
+        or insee code when made of digits, of a word of their name otherwise
+        """
+        query = query.strip()
+        if not query or limit <= 0:
+            return []
+
+        if query.isdigit():
+            indexes = (self.postal_index, self.insee_index)
+            prefix = query
+        else:
+            indexes = (self.name_index,)
+            prefix = normalize_name(query)
+            if not prefix:
+                return []
+
+        seen = set()
+        found = []
+        for index in indexes:
+            for row in self.prefixed_rows(index, prefix):
+                if row not in seen:
+                    seen.add(row)
+                    found.append(row)
+                    if len(found) == limit:
+                        return [self.commune(row) for row in found]
+        return [self.commune(row) for row in found]
+
+    # -- helpers
+
+    def exact(self, index, key):
+        keys, rows = index
+        position = bisect_left(keys, key)
+        while position < len(keys) and keys[position] == key:
+            yield self.commune(rows[position])
+            position += 1
+
+    def prefixed_rows(self, index, prefix):
+        keys, rows = index
+        position = bisect_left(keys, prefix)
+        while position < len(keys) and keys[position].startswith(prefix):
+            yield rows[position]
+            position += 1
+
+    def commune(self, row):
+        """Return an unsaved commune instance for row, department included"""
+        department_index = self.departments[row]
+        department = models.Department(
+            code=self.department_codes[department_index],
+            name=self.department_names[department_index],
+        )
+        commune = models.Commune(
+            id=self.ids[row],
+            department=department,
+            insee=self.insee[row],
+            postal=self.postal[row],
+            name=self.names[row],
+            latitude=self.latitudes[row],
+            longitude=self.longitudes[row],
+        )
+        # loaded from the database, even if not through the orm
+        commune._state.adding = False
+        return commune
+
+
+########################################################################
+# name normalization
+########################################################################
+
+
+def normalize_name(name):
+    """Return name lower cased, without accents and punctuation"""
+    decomposed = unicodedata.normalize("NFKD", name)
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(re.findall(r"[a-z0-9]+", stripped.lower()))
+
+
+def name_keys(name):
+    """Return the normalized name starting at each of its words"""
+    normalized = normalize_name(name)
+    keys = [normalized]
+    for match in re.finditer(" ", normalized):
+        keys.append(normalized[match.end() :])
+    return keys
+
+
+########################################################################
+# process wide gazetteer
+########################################################################
+
+_lock = threading.Lock()
+_gazetteer = None
+_checked_on = 0
+
+
+def get_gazetteer():
+    """
+    Return the gazetteer of the process, loaded on first use and reloaded
+    when the version of the communes changed since it was checked last
+    """
+    global _gazetteer, _checked_on
+
+    interval = getattr(settings, "GAZETTEER_CHECK_INTERVAL", 60)
+    gazetteer = _gazetteer
+    if gazetteer is not None and time.monotonic() - _checked_on < interval:
+        return gazetteer
+
+    version = get_communes_version()
+    with _lock:
+        if _gazetteer is None or _gazetteer.version != version:
+            _gazetteer = Gazetteer.load(version=version)
+        _checked_on = time.monotonic()
+        return _gazetteer
+
+
+def get_communes_version():
+    """
+    Return the version of the communes and departments in the database, their
+    count, last id and last update, changed by insertions, deletions, saves
+    and the loadcommunes command, whatever the process
+    """
+    communes = models.Commune.objects.order_by().aggregate(
+        Count("id"), Max("id"), Max("updated_on")
+    )
+    departments = models.Department.objects.order_by().aggregate(
+        Count("code"), Max("updated_on")
+    )
+    return tuple(communes.values()), tuple(departments.values())
+
+
+def invalidate_gazetteer():
+    """Drop the gazetteer of this process, reloaded on next use"""
+    global _gazetteer
+
+    with _lock:
+        _gazetteer = None
+
+
+# eof
@@ -9,18 +9,33 @@ available from the following url:
 
 https://www.data.gouv.fr/fr/datasets/r/dbe8a621-a9c4-4bc3-9cae-be1699c5ff25
 
+The file is streamed and loaded by batches, each in its own short transaction:
+the communes of a batch are fetched in one query, then new ones are bulk
+created and changed ones bulk updated. Rows repeating an already loaded
+(insee, postal) pair are skipped, the first one wins.
+
 
 authors: raphael.marvie@beta.gouv.fr, guillaume.libersat@beta.gouv.fr
 created: 2021-07-13 09:08:25 CEST
 """
 
 import csv
+from collections import Counter
+from itertools import islice
 
+from django.core.management.base import BaseCommand
 from django.db import transaction
+from django.utils import timezone
+from urbanvitaliz.apps.geomatics import gazetteer, models, proximity
 
-from django.core.management.base import BaseCommand
+BATCH_SIZE = 1000
+
+# commune fields refreshed from the file
+COMMUNE_FIELDS = ("department_id", "name", "latitude", "longitude", "grid_cell")
 
-from urbanvitaliz.apps.geomatics import models
+# set by touch on bulk updates, which do not set auto_now fields, so that the
+# version of the gazetteer changes
+UPDATED_ON = ("updated_on",)
 
 
 class Command(BaseCommand):
@@ -28,61 +43,170 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("filename", type=str)
+        parser.add_argument(
+            "--batch-size", type=int, default=BATCH_SIZE, help="Rows loaded per batch"
+        )
 
     def handle(self, *args, **options):
-        filename = options["filename"]
-        load_communes_from_csv(filename)
-
-
-@transaction.atomic
-def load_communes_from_csv(filename):
-    with open(filename) as the_file:
+        counts = load_communes_from_csv(
+            options["filename"], batch_size=options["batch_size"]
+        )
+        self.stdout.write(
+            "Communes: {inserted} inserted, {updated} updated, "
+            "{unchanged} unchanged, {skipped} skipped".format(**counts)
+        )
+
+
+def load_communes_from_csv(filename, batch_size=BATCH_SIZE):
+    """Load the communes of the csv file by batches, return the counts"""
+    loader = CommuneLoader()
+    counts = Counter(inserted=0, updated=0, unchanged=0, skipped=0)
+    with open(filename, newline="") as the_file:
         reader = csv.DictReader(the_file)
-        for row in reader:
-            load_commune(row)
-
-
-def load_commune(row):
-    """Create commune department region from row if unknown"""
-    region = get_region(row["code_region"], row["nom_region"])
-    department = get_department(region, row["code_departement"], row["nom_departement"])
-    commune, _ = models.Commune.objects.get_or_create(
-        department=department,
+        while True:
+            rows = list(islice(reader, batch_size))
+            if not rows:
+                break
+            with transaction.atomic():
+                counts.update(loader.load(rows))
+    # bulk operations do not send the signals reloading the gazetteer of this
+    # process, other processes notice the new version of the communes
+    gazetteer.invalidate_gazetteer()
+    return counts
+
+
+class CommuneLoader:
+    """
+    Upsert communes with their department and region, batch after batch
+
+    Regions and departments are few, they are read once and kept in memory.
+    """
+
+    def __init__(self):
+        self.regions = None
+        self.departments = None
+        self.seen = set()
+
+    def load(self, rows):
+        """Upsert the communes of rows, return the counts of the batch"""
+        self.load_areas(rows)
+
+        counts = Counter()
+        communes = {}
+        for row in rows:
+            key = (row["code_commune_INSEE"], row["code_postal"])
+            if key in self.seen:
+                counts["skipped"] += 1
+                continue
+            self.seen.add(key)
+            communes[key] = commune_from_row(row)
+
+        existing = {
+            (commune.insee, commune.postal): commune
+            for commune in models.Commune.objects.filter(
+                insee__in={insee for insee, _ in communes}
+            )
+        }
+
+        created, updated = [], []
+        for key, commune in communes.items():
+            current = existing.get(key)
+            if current is None:
+                created.append(commune)
+            elif update_fields(current, commune, COMMUNE_FIELDS):
+                updated.append(current)
+            else:
+                counts["unchanged"] += 1
+
+        models.Commune.objects.bulk_create(created)
+        models.Commune.objects.bulk_update(touch(updated), COMMUNE_FIELDS + UPDATED_ON)
+
+        counts["inserted"] += len(created)
+        counts["updated"] += len(updated)
+        return counts
+
+    def load_areas(self, rows):
+        """Upsert the regions and departments rows refer to"""
+        if self.regions is None:
+            self.regions = {r.code: r for r in models.Region.objects.all()}
+            self.departments = {d.code: d for d in models.Department.objects.all()}
+
+        regions = {
+            row["code_region"]: models.Region(
+                code=row["code_region"], name=row["nom_region"]
+            )
+            for row in rows
+        }
+        self.upsert(models.Region, self.regions, regions, ("name",))
+
+        departments = {
+            row["code_departement"]: models.Department(
+                code=row["code_departement"],
+                name=row["nom_departement"],
+                region_id=row["code_region"],
+            )
+            for row in rows
+        }
+        self.upsert(
+            models.Department,
+            self.departments,
+            departments,
+            ("name", "region_id"),
+            touched=True,
+        )
+
+    @staticmethod
+    def upsert(model, known, loaded, fields, touched=False):
+        """
+        Create or update the loaded objects missing from or differing in known,
+        setting the update date of updated ones when touched
+        """
+        created = [obj for code, obj in loaded.items() if code not in known]
+        updated = [
+            known[code]
+            for code, obj in loaded.items()
+            if code in known and update_fields(known[code], obj, fields)
+        ]
+        model.objects.bulk_create(created)
+        if touched:
+            model.objects.bulk_update(touch(updated), fields + UPDATED_ON)
+        else:
+            model.objects.bulk_update(updated, fields)
+        known.update((obj.pk, obj) for obj in created)
+
+
+def commune_from_row(row):
+    """Return an unsaved commune built from a csv row"""
+    latitude = float(row["latitude"] or 0.0)
+    longitude = float(row["longitude"] or 0.0)
+    return models.Commune(
+        department_id=row["code_departement"],
         insee=row["code_commune_INSEE"],
         postal=row["code_postal"],
-        defaults={
-            "name": row["nom_commune_postal"],
-            "latitude": row["latitude"] or 0.0,
-            "longitude": row["longitude"] or 0.0,
-        },
+        name=row["nom_commune_postal"],
+        latitude=latitude,
+        longitude=longitude,
+        grid_cell=proximity.grid_cell(latitude, longitude),
     )
-    return commune
-
-
-def memoize(function):
-    """Memoize departments and regions to reduce db queries"""
-    memory = {}
 
-    def wrapper(*args, **kwargs):
-        if args not in memory:
-            memory[args] = function(*args)
-        return memory[args]
 
-    return wrapper
+def touch(objects):
+    """Set the update date of objects, left alone by bulk updates, return them"""
+    now = timezone.now()
+    for obj in objects:
+        obj.updated_on = now
+    return objects
 
 
-@memoize
-def get_region(code, name):
-    region, _ = models.Region.objects.get_or_create(code=code, defaults={"name": name})
-    return region
-
-
-@memoize
-def get_department(region, code, name):
-    departement, _ = models.Department.objects.get_or_create(
-        region=region, code=code, defaults={"name": name}
-    )
-    return departement
+def update_fields(current, loaded, fields):
+    """Copy fields of loaded differing in current, return True if any did"""
+    changed = False
+    for name in fields:
+        value = getattr(loaded, name)
+        if getattr(current, name) != value:
+            setattr(current, name, value)
+            changed = True
+    return changed
 
 
 # eof
@@ -0,0 +1,48 @@
+# Generated by Django 3.2.14 on 2026-10-18 09:46
+
+from django.db import migrations, models
+import django.db.models.functions.text
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("geomatics", "0003_alter_department_code"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="commune",
+            name="updated_on",
+            field=models.DateTimeField(
+                auto_now=True, default=django.utils.timezone.now
+            ),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="department",
+            name="updated_on",
+            field=models.DateTimeField(
+                auto_now=True, default=django.utils.timezone.now
+            ),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name="commune",
+            index=models.Index(
+                fields=["postal", "insee"], name="geomatics_c_postal_98cea3_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="commune",
+            index=models.Index(fields=["insee"], name="geomatics_c_insee_172746_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="commune",
+            index=models.Index(
+                django.db.models.functions.text.Lower("name"),
+                name="geomatics_commune_lower_name",
+            ),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.2.14 on 2026-10-18 09:47
+
+from django.db import migrations, models
+
+# frozen copy of the grid of geomatics.proximity: cells of a tenth of a degree
+GRID_CELL_DEGREES = 0.1
+GRID_ROWS = 1800
+GRID_COLUMNS = 3600
+
+
+def grid_cell(latitude, longitude):
+    if latitude is None or longitude is None or (not latitude and not longitude):
+        return None
+    row = min(int((latitude + 90) / GRID_CELL_DEGREES), GRID_ROWS - 1)
+    column = min(int((longitude + 180) / GRID_CELL_DEGREES), GRID_COLUMNS - 1)
+    return row * GRID_COLUMNS + column
+
+
+def set_grid_cells(apps, schema_editor):
+    Commune = apps.get_model("geomatics", "Commune")
+    communes = list(Commune.objects.only("id", "latitude", "longitude"))
+    for commune in communes:
+        commune.grid_cell = grid_cell(commune.latitude, commune.longitude)
+    Commune.objects.bulk_update(communes, ["grid_cell"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("geomatics", "0004_commune_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="commune",
+            name="grid_cell",
+            field=models.IntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(set_grid_cells, migrations.RunPython.noop),
+    ]
@@ -7,8 +7,8 @@ authors: guillaume.libersat@beta.gouv.fr, raphael.marvie@beta.gouv.fr
 created: 2021-07-12 12:05:28 CEST
 """
 
-
 from django.db import models
+from django.db.models.functions import Lower
 
 
 class Region(models.Model):
@@ -40,6 +40,9 @@ class Department(models.Model):
     code = models.CharField(max_length=3, primary_key=True)
     name = models.CharField(max_length=64)
 
+    # part of the version of the gazetteer, see gazetteer.get_communes_version
+    updated_on = models.DateTimeField(auto_now=True)
+
     class Meta:
         verbose_name = "département"
         verbose_name_plural = "départements"
@@ -48,9 +51,33 @@ class Department(models.Model):
         return self.name
 
 
+class CommuneManager(models.Manager):
+    def resolve(self, postal=None, insee=None, name=None):
+        """
+        Return the first commune matching all given postal code, insee code
+        and case insensitive name, or None, in a single indexed query
+        """
+        if not (postal or insee or name):
+            return None
+
+        communes = self.get_queryset()
+        if postal:
+            communes = communes.filter(postal=postal)
+        if insee:
+            communes = communes.filter(insee=insee)
+        if name:
+            # matches the lower cased name index, unlike name__iexact
+            communes = communes.alias(lower_name=Lower("name")).filter(
+                lower_name=name.lower()
+            )
+        return communes.order_by("id").first()
+
+
 class Commune(models.Model):
     """Represents a Commune"""
 
+    objects = CommuneManager()
+
     department = models.ForeignKey("Department", on_delete=models.CASCADE)
 
     insee = models.CharField(max_length=5)
@@ -60,28 +87,43 @@ class Commune(models.Model):
     longitude = models.FloatField(default=0.0)
     latitude = models.FloatField(default=0.0)
 
+    # cell of the proximity grid, set from coordinates when saved
+    grid_cell = models.IntegerField(null=True, blank=True, db_index=True)
+
+    # part of the version of the gazetteer, see gazetteer.get_communes_version
+    updated_on = models.DateTimeField(auto_now=True)
+
     class Meta:
         verbose_name = "commune"
         verbose_name_plural = "communes"
+        indexes = [
+            models.Index(fields=["postal", "insee"]),
+            models.Index(fields=["insee"]),
+            models.Index(Lower("name"), name="geomatics_commune_lower_name"),
+        ]
 
     def __str__(self):  # pragma: nocover
         return self.name
 
     @classmethod
     def get_by_postal_code(cls, code):
-        """Return first commune matching given postal code or None"""
-        try:
-            return cls.objects.filter(postal=code)[0]
-        except IndexError:
-            return
+        """
+        Return first commune matching given postal code or None, read from the
+        database when not yet in the gazetteer
+        """
+        from .gazetteer import get_gazetteer  # gazetteer relies on models
+
+        return get_gazetteer().get_by_postal(code) or cls.objects.resolve(postal=code)
 
     @classmethod
     def get_by_insee_code(cls, code):
-        """Return commune matching the given insee code or None"""
-        try:
-            return cls.objects.filter(insee=code).first()
-        except IndexError:
-            return
+        """
+        Return commune matching the given insee code or None, read from the
+        database when not yet in the gazetteer
+        """
+        from .gazetteer import get_gazetteer  # gazetteer relies on models
+
+        return get_gazetteer().get_by_insee(code) or cls.objects.resolve(insee=code)
 
 
 # eof
@@ -0,0 +1,142 @@
+# encoding: utf-8
+
+"""
+Proximity queries on communes and projects
+
+Each commune with known coordinates is stored with the cell of a fixed degree
+grid it falls into.  Candidates around a point are the communes of the cells
+covering the bounding box of the search radius, read with an indexed query,
+then ranked by their great circle distance.
+"""
+
+import math
+
+from . import models
+
+EARTH_RADIUS_KM = 6371.0088
+
+# a tenth of a degree is about 11 km of latitude and 7 km of longitude in France
+GRID_CELL_DEGREES = 0.1
+GRID_ROWS = round(180 / GRID_CELL_DEGREES)
+GRID_COLUMNS = round(360 / GRID_CELL_DEGREES)
+
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+########################################################################
+# grid
+########################################################################
+
+
+def grid_cell(latitude, longitude):
+    """Return the grid cell of a point, None when coordinates are unknown"""
+    if latitude is None or longitude is None or (not latitude and not longitude):
+        return None
+    return grid_row(latitude) * GRID_COLUMNS + grid_column(longitude)
+
+
+def grid_row(latitude):
+    return min(int((latitude + 90) / GRID_CELL_DEGREES), GRID_ROWS - 1)
+
+
+def grid_column(longitude):
+    return min(int((longitude + 180) / GRID_CELL_DEGREES), GRID_COLUMNS - 1)
+
+
+def grid_cells_around(latitude, longitude, radius_km):
+    """Return the grid cells covering the bounding box of a circle"""
+    delta_latitude = radius_km / KM_PER_DEGREE
+    south = max(latitude - delta_latitude, -90)
+    north = min(latitude + delta_latitude, 90)
+
+    # meridians get closer towards the poles, the box spans the most
+    # degrees of longitude on its side nearest to a pole
+    narrowest = math.cos(math.radians(max(abs(south), abs(north))))
+    if narrowest < 1e-6:
+        west, east = -180, 180
+    else:
+        delta_longitude = min(radius_km / (KM_PER_DEGREE * narrowest), 180)
+        west = max(longitude - delta_longitude, -180)
+        east = min(longitude + delta_longitude, 180)
+
+    return [
+        row * GRID_COLUMNS + column
+        for row in range(grid_row(south), grid_row(north) + 1)
+        for column in range(grid_column(west), grid_column(east) + 1)
+    ]
+
+
+########################################################################
+# distances
+########################################################################
+
+
+def haversine_km(latitude, longitude, latitudes, longitudes):
+    """Return the distances in km from a point to each of the given points"""
+    lat1 = math.radians(latitude)
+    distances = []
+    for other_latitude, other_longitude in zip(latitudes, longitudes):
+        lat2 = math.radians(other_latitude)
+        dlat = lat2 - lat1
+        dlon = math.radians(other_longitude - longitude)
+        a = (
+            math.sin(dlat / 2) ** 2
+            + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
+        )
+        distances.append(2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1))))
+    return distances
+
+
+def communes_within(latitude, longitude, radius_km):
+    """Return {commune id: distance in km} of the communes within radius"""
+    candidates = list(
+        models.Commune.objects.filter(
+            grid_cell__in=grid_cells_around(latitude, longitude, radius_km)
+        ).values_list("id", "latitude", "longitude")
+    )
+    if not candidates:
+        return {}
+
+    ids, latitudes, longitudes = zip(*candidates)
+    distances = haversine_km(latitude, longitude, latitudes, longitudes)
+    return {
+        id: distance for id, distance in zip(ids, distances) if distance <= radius_km
+    }
+
+
+########################################################################
+# nearest communes and projects
+########################################################################
+
+
+def nearest_communes(latitude, longitude, radius_km=20, limit=20):
+    """
+    Return up to limit communes within radius of a point, nearest first, each
+    with its distance in km
+    """
+    distances = communes_within(latitude, longitude, radius_km)
+    nearest = sorted(distances, key=lambda id: (distances[id], id))[:limit]
+
+    communes = models.Commune.objects.select_related("department").in_bulk(nearest)
+    for id in nearest:
+        communes[id].distance = distances[id]
+    return [communes[id] for id in nearest]
+
+
+def nearest_projects(projects, latitude, longitude, radius_km=20, limit=20):
+    """
+    Return up to limit projects of the queryset located in a commune within
+    radius of a point, nearest first, each with its distance in km
+    """
+    distances = communes_within(latitude, longitude, radius_km)
+    if not distances:
+        return []
+
+    found = list(projects.filter(commune_id__in=list(distances)))
+    for project in found:
+        project.distance = distances[project.commune_id]
+    found.sort(key=lambda project: (project.distance, project.id))
+    return found[:limit]
+
+
+# eof
@@ -9,9 +9,21 @@ created : 2021-05-26 15:56:20 CEST
 
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import viewsets
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from urbanvitaliz.utils import CursorPagination
 
-from . import models
-from .serializers import CommuneSerializer, DepartmentSerializer
+from . import models, proximity
+from .gazetteer import get_gazetteer
+from .serializers import (
+    CommuneSerializer,
+    DepartmentSerializer,
+    NearbyCommuneSerializer,
+)
+
+# bounds of the radius (km) and number of results of proximity queries
+MAX_NEARBY_RADIUS = 100
+MAX_NEARBY_LIMIT = 100
 
 
 ########################################################################
@@ -28,17 +40,88 @@ class DepartmentViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = DepartmentSerializer
 
 
+class CommunePagination(CursorPagination):
+    ordering = ("name", "id")
+    required = True
+
+
 class CommuneViewSet(viewsets.ReadOnlyModelViewSet):
     """
     API endpoint that allows Commune to be viewed or edited.
     """
 
     def get_queryset(self):
-        return models.Commune.objects.all().order_by("name")
+        return models.Commune.objects.select_related("department").order_by("name")
 
     serializer_class = CommuneSerializer
+    pagination_class = CommunePagination
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ["postal"]
 
+    def list(self, request, *args, **kwargs):
+        """
+        List the communes, those of the postal parameter are read from the in
+        memory gazetteer when they fit in the first page
+        """
+        postal = request.query_params.get("postal")
+        paginator = self.paginator
+        if postal and paginator.cursor_query_param not in request.query_params:
+            communes = get_gazetteer().filter_postal(postal)
+            if len(communes) <= paginator.get_page_size(request):
+                communes.sort(key=lambda commune: (commune.name, commune.id))
+                serializer = self.get_serializer(communes, many=True)
+                return Response(
+                    {"next": None, "previous": None, "results": serializer.data}
+                )
+        return super().list(request, *args, **kwargs)
+
+    @action(detail=False, pagination_class=None, filter_backends=[])
+    def autocomplete(self, request):
+        """
+        Return the communes whose postal or insee code, or a word of the name,
+        starts with the q parameter, looked up in the in memory gazetteer
+        """
+        try:
+            limit = min(int(request.query_params.get("limit", 10)), 50)
+        except ValueError:
+            limit = 10
+        communes = get_gazetteer().autocomplete(
+            request.query_params.get("q", ""), limit=limit
+        )
+        serializer = self.get_serializer(communes, many=True)
+        return Response(serializer.data)
+
+    @action(detail=True, pagination_class=None, filter_backends=[])
+    def nearby(self, request, pk=None):
+        """Return the nearest other communes within the radius parameter"""
+        commune = self.get_object()
+        radius, limit = get_nearby_params(request)
+        communes = []
+        if commune.grid_cell is not None:
+            communes = proximity.nearest_communes(
+                commune.latitude, commune.longitude, radius, limit + 1
+            )
+        communes = [c for c in communes if c.id != commune.id][:limit]
+        serializer = NearbyCommuneSerializer(
+            communes, many=True, context=self.get_serializer_context()
+        )
+        return Response(serializer.data)
+
+
+def get_nearby_params(request):
+    """Return the radius in km and the limit of a proximity query"""
+    try:
+        radius = float(request.query_params.get("radius", 20))
+    except ValueError:
+        radius = 20
+    try:
+        limit = int(request.query_params.get("limit", 20))
+    except ValueError:
+        limit = 20
+    return (
+        max(0, min(radius, MAX_NEARBY_RADIUS)),
+        max(0, min(limit, MAX_NEARBY_LIMIT)),
+    )
+
 
 # eof
@@ -1,4 +1,5 @@
 from rest_framework import serializers
+from urbanvitaliz.utils import SparseFieldsetMixin
 
 from .models import Commune, Department
 
@@ -10,10 +11,17 @@ class DepartmentSerializer(serializers.HyperlinkedModelSerializer):
         fields = ["name", "code"]
 
 
-class CommuneSerializer(serializers.HyperlinkedModelSerializer):
+class CommuneSerializer(SparseFieldsetMixin, serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Commune
 
         fields = ["name", "insee", "postal", "department"]
 
     department = DepartmentSerializer(read_only=True)
+
+
+class NearbyCommuneSerializer(CommuneSerializer):
+    class Meta(CommuneSerializer.Meta):
+        fields = CommuneSerializer.Meta.fields + ["distance"]
+
+    distance = serializers.FloatField(read_only=True)
@@ -0,0 +1,33 @@
+# encoding: utf-8
+
+"""
+Signals for geomatics application
+"""
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import gazetteer, models, proximity
+
+
+@receiver(pre_save, sender=models.Commune)
+def set_commune_grid_cell(sender, instance, **kwargs):
+    """Keep the proximity grid cell of the commune in line with its coordinates"""
+    instance.grid_cell = proximity.grid_cell(instance.latitude, instance.longitude)
+
+
+@receiver(post_save, sender=models.Commune)
+@receiver(post_delete, sender=models.Commune)
+@receiver(post_save, sender=models.Department)
+@receiver(post_delete, sender=models.Department)
+def invalidate_gazetteer_on_change(sender, **kwargs):
+    """
+    Reload the gazetteer of this process now and once committed, other ones
+    pick the change up on their next version check
+    """
+    gazetteer.invalidate_gazetteer()
+    transaction.on_commit(gazetteer.invalidate_gazetteer)
+
+
+# eof
@@ -13,8 +13,10 @@ import pytest
 
 from django.core.management.base import CommandError
 from django.core.management import call_command
+from django.urls import reverse
+from model_bakery import baker
 
-from . import models
+from . import gazetteer, models, proximity
 
 
 def test_load_communes_fails_when_no_file_provided():
@@ -47,8 +49,369 @@ def test_load_file_create_region_department_and_commune():
     assert commune.postal == "1400"
 
 
+@pytest.mark.django_db
+def test_load_file_upserts_communes_and_reports_counts(tmp_path, capsys):
+    region = baker.make(models.Region, code="84", name="Auvergne")
+    department = baker.make(models.Department, code="1", name="Ain", region=region)
+    baker.make(
+        models.Commune,
+        department=department,
+        insee="1001",
+        postal="1400",
+        name="ABERGEMENT",
+    )
+    baker.make(
+        models.Commune,
+        department=department,
+        insee="1002",
+        postal="1640",
+        name="L ABERGEMENT DE VAREY",
+        latitude=46.0,
+        longitude=5.4,
+    )
+    filename = tmp_path / "communes.csv"
+    filename.write_text(CSV + CSV_MORE_ROWS)
+
+    call_command("loadcommunes", str(filename), "--batch-size", "2")
+
+    assert capsys.readouterr().out.strip() == (
+        "Communes: 1 inserted, 1 updated, 1 unchanged, 1 skipped"
+    )
+    assert models.Region.objects.get().name == "Auvergne-Rhône-Alpes"
+    assert models.Commune.objects.count() == 3
+    assert models.Commune.objects.get(insee="1001").name == "L ABERGEMENT CLEMENCIAT"
+    assert models.Commune.objects.get(insee="1004").postal == "1500"
+
+
+@pytest.mark.django_db
+def test_load_file_queries_by_batch(tmp_path, django_assert_num_queries):
+    filename = tmp_path / "communes.csv"
+    filename.write_text(CSV + CSV_MORE_ROWS)
+
+    # regions and departments read then created once, and per batch a
+    # savepoint, the communes lookup, their creation and the release
+    with django_assert_num_queries(2 + 2 + 2 * 4):
+        call_command("loadcommunes", str(filename), "--batch-size", "2")
+
+    assert models.Commune.objects.count() == 3
+
+
+@pytest.mark.django_db
+def test_load_file_reloads_gazetteer(tmp_path):
+    assert gazetteer.get_gazetteer().get_by_insee("1001") is None
+    filename = tmp_path / "communes.csv"
+    filename.write_text(CSV)
+
+    call_command("loadcommunes", str(filename))
+
+    assert gazetteer.get_gazetteer().get_by_insee("1001").name == (
+        "L ABERGEMENT CLEMENCIAT"
+    )
+
+
+########################################################################
+# commune resolution
+########################################################################
+
+
+@pytest.mark.django_db
+def test_resolve_commune_matches_all_given_criteria():
+    lille = baker.make(models.Commune, insee="59350", postal="59000", name="Lille")
+    baker.make(models.Commune, insee="59646", postal="59000", name="Saint-André")
+
+    assert models.Commune.objects.resolve(postal="59000", name="LILLE") == lille
+    assert models.Commune.objects.resolve(insee="59350") == lille
+    assert models.Commune.objects.resolve(postal="59000", insee="59646").insee == (
+        "59646"
+    )
+    assert models.Commune.objects.resolve(postal="59000", name="Lens") is None
+
+
+@pytest.mark.django_db
+def test_resolve_commune_needs_a_criteria(django_assert_num_queries):
+    baker.make(models.Commune)
+
+    with django_assert_num_queries(0):
+        assert models.Commune.objects.resolve() is None
+
+
+@pytest.mark.django_db
+def test_resolve_commune_runs_a_single_query(django_assert_num_queries):
+    baker.make(models.Commune, insee="59350", postal="59000", name="Lille")
+
+    with django_assert_num_queries(1):
+        models.Commune.objects.resolve(postal="59000", insee="59350", name="lille")
+
+
+@pytest.mark.django_db
+def test_commune_lookups_resolve_communes_missing_from_gazetteer():
+    department = baker.make(models.Department)
+    gazetteer.get_gazetteer()
+
+    # not in the gazetteer of this process until its next version check
+    models.Commune.objects.bulk_create(
+        [models.Commune(department=department, insee="59350", postal="59000")]
+    )
+
+    assert models.Commune.get_by_postal_code("59000").insee == "59350"
+    assert models.Commune.get_by_insee_code("59350").postal == "59000"
+    assert models.Commune.get_by_insee_code("00000") is None
+
+
+########################################################################
+# gazetteer
+########################################################################
+
+
+def make_gazetteer():
+    return gazetteer.Gazetteer(
+        [
+            (3, "59350", "59000", "Lille", "59", 50.6, 3.0),
+            (1, "59646", "59000", "Saint-André-lez-Lille", "59", 50.6, 3.0),
+            (2, "01001", "01400", "L'Abergement-Clémenciat", "1", 46.1, 4.9),
+            (4, "59599", "59800", "Lille", "59", 50.6, 3.1),
+        ],
+        {"59": "Nord", "1": "Ain"},
+    )
+
+
+def test_gazetteer_looks_up_codes():
+    communes = make_gazetteer()
+
+    assert communes.get_by_insee("01001").name == "L'Abergement-Clémenciat"
+    assert communes.get_by_insee("00000") is None
+    assert communes.get_by_postal("59000").id == 1
+    assert communes.count_postal("59000") == 2
+    assert communes.count_postal("5900") == 0
+    assert [c.id for c in communes.filter_postal("59000")] == [1, 3]
+    assert communes.get_by_postal("59800").department.name == "Nord"
+
+
+def test_gazetteer_autocompletes_on_name_words_without_accents():
+    communes = make_gazetteer()
+
+    assert [c.id for c in communes.autocomplete("lil")] == [3, 4, 1]
+    assert [c.id for c in communes.autocomplete("saint andre")] == [1]
+    assert [c.id for c in communes.autocomplete("CLÉMEN")] == [2]
+    assert [c.id for c in communes.autocomplete("lil", limit=1)] == [3]
+    assert communes.autocomplete("  ") == []
+
+
+def test_gazetteer_autocompletes_on_code_prefixes():
+    communes = make_gazetteer()
+
+    assert [c.id for c in communes.autocomplete("59")] == [1, 3, 4]
+    assert [c.id for c in communes.autocomplete("010")] == [2]
+
+
+@pytest.mark.django_db
+def test_gazetteer_reloads_when_communes_change():
+    assert len(gazetteer.get_gazetteer()) == 0
+
+    commune = baker.make(models.Commune, insee="59350", postal="59000")
+
+    assert gazetteer.get_gazetteer().get_by_insee("59350").id == commune.id
+    assert models.Commune.get_by_postal_code("59000").id == commune.id
+
+
+@pytest.mark.django_db
+def test_gazetteer_reloads_communes_changed_by_other_processes(settings):
+    department = baker.make(models.Department)
+    gazetteer.get_gazetteer()
+
+    # bulk operations, like those of another process, send no signal
+    models.Commune.objects.bulk_create(
+        [models.Commune(department=department, insee="59350", postal="59000")]
+    )
+    assert gazetteer.get_gazetteer().get_by_insee("59350") is None
+
+    settings.GAZETTEER_CHECK_INTERVAL = 0
+    assert gazetteer.get_gazetteer().get_by_insee("59350").postal == "59000"
+
+
+@pytest.mark.django_db
+def test_communes_version_follows_updates_of_loadcommunes(tmp_path):
+    filename = tmp_path / "communes.csv"
+    filename.write_text(CSV)
+    call_command("loadcommunes", str(filename))
+    version = gazetteer.get_communes_version()
+
+    filename.write_text(CSV.replace("L ABERGEMENT CLEMENCIAT", "L ABERGEMENT"))
+    call_command("loadcommunes", str(filename))
+
+    assert gazetteer.get_communes_version() != version
+
+
+@pytest.mark.django_db
+def test_gazetteer_lookups_do_not_query_once_loaded(django_assert_num_queries):
+    baker.make(models.Commune, insee="59350", postal="59000")
+    gazetteer.get_gazetteer()
+
+    with django_assert_num_queries(0):
+        assert models.Commune.get_by_insee_code("59350").postal == "59000"
+
+
+########################################################################
+# proximity
+########################################################################
+
+LILLE = (50.6292, 3.0573)
+ROUBAIX = (50.6942, 3.1746)
+PARIS = (48.8566, 2.3522)
+
+
+def test_grid_cell_is_unknown_without_coordinates():
+    assert proximity.grid_cell(0.0, 0.0) is None
+    assert proximity.grid_cell(None, 3.0) is None
+    assert proximity.grid_cell(*LILLE) != proximity.grid_cell(*PARIS)
+
+
+def test_grid_cells_around_cover_the_radius():
+    cells = proximity.grid_cells_around(*LILLE, 20)
+
+    assert proximity.grid_cell(*LILLE) in cells
+    assert proximity.grid_cell(*ROUBAIX) in cells
+    assert proximity.grid_cell(*PARIS) not in cells
+
+
+def test_haversine_computes_great_circle_distances():
+    distances = proximity.haversine_km(
+        *LILLE, [PARIS[0], LILLE[0]], [PARIS[1], LILLE[1]]
+    )
+
+    assert 203 < distances[0] < 205
+    assert distances[1] == 0
+
+
+@pytest.mark.django_db
+def test_commune_grid_cell_follows_coordinates():
+    commune = baker.make(models.Commune, latitude=LILLE[0], longitude=LILLE[1])
+    assert commune.grid_cell == proximity.grid_cell(*LILLE)
+
+    commune.latitude, commune.longitude = PARIS
+    commune.save()
+
+    assert models.Commune.objects.get().grid_cell == proximity.grid_cell(*PARIS)
+
+
+@pytest.mark.django_db
+def test_nearest_communes_are_ranked_by_distance_within_radius():
+    for name, (latitude, longitude) in (
+        ("Paris", PARIS),
+        ("Roubaix", ROUBAIX),
+        ("Lille", LILLE),
+    ):
+        baker.make(models.Commune, name=name, latitude=latitude, longitude=longitude)
+    baker.make(models.Commune, name="Inconnue")
+
+    communes = proximity.nearest_communes(*LILLE, radius_km=20)
+
+    assert [c.name for c in communes] == ["Lille", "Roubaix"]
+    assert communes[0].distance == 0
+    assert [c.name for c in proximity.nearest_communes(*LILLE, 300, limit=1)] == [
+        "Lille"
+    ]
+
+
+########################################################################
+# REST API
+########################################################################
+
+
+@pytest.mark.django_db
+def test_commune_list_is_paginated_with_a_cursor(client):
+    baker.make(models.Commune, postal="59000", _quantity=3)
+
+    response = client.get(reverse("communes-list"), {"page_size": 2})
+    page = response.json()
+    assert len(page["results"]) == 2
+
+    response = client.get(page["next"])
+    page = response.json()
+    assert len(page["results"]) == 1
+    assert page["next"] is None
+
+
+@pytest.mark.django_db
+def test_commune_list_renders_only_selected_fields(client):
+    baker.make(models.Commune, postal="59000", name="Lille")
+
+    response = client.get(
+        reverse("communes-list"), {"postal": "59000", "fields": "name,insee"}
+    )
+
+    assert [set(commune) for commune in response.json()["results"]] == [
+        {"name", "insee"}
+    ]
+
+
+@pytest.mark.django_db
+def test_commune_list_of_postal_code_is_read_from_gazetteer(
+    client, django_assert_num_queries
+):
+    baker.make(models.Commune, postal="59000", name="Lille")
+    baker.make(models.Commune, postal="59000", name="Hellemmes")
+    baker.make(models.Commune, postal="62300", name="Lens")
+    gazetteer.get_gazetteer()
+
+    with django_assert_num_queries(0):
+        response = client.get(reverse("communes-list"), {"postal": "59000"})
+
+    page = response.json()
+    assert (page["next"], page["previous"]) == (None, None)
+    assert [c["name"] for c in page["results"]] == ["Hellemmes", "Lille"]
+
+
+@pytest.mark.django_db
+def test_commune_autocomplete_returns_matching_communes(client):
+    department = baker.make(models.Department, code="59", name="Nord")
+    baker.make(models.Commune, name="Lille", postal="59000", department=department)
+    baker.make(models.Commune, name="Lens", postal="62300")
+
+    response = client.get(reverse("communes-autocomplete"), {"q": "lil"})
+
+    assert response.status_code == 200
+    assert response.json() == [
+        {
+            "name": "Lille",
+            "insee": response.json()[0]["insee"],
+            "postal": "59000",
+            "department": {"name": "Nord", "code": "59"},
+        }
+    ]
+
+
+@pytest.mark.django_db
+def test_commune_autocomplete_limits_results(client):
+    baker.make(models.Commune, postal="59000", _quantity=3)
+
+    response = client.get(reverse("communes-autocomplete"), {"q": "59", "limit": 2})
+
+    assert len(response.json()) == 2
+
+
+@pytest.mark.django_db
+def test_commune_nearby_lists_other_communes_by_distance(client):
+    lille = baker.make(models.Commune, latitude=LILLE[0], longitude=LILLE[1])
+    roubaix = baker.make(
+        models.Commune, name="Roubaix", latitude=ROUBAIX[0], longitude=ROUBAIX[1]
+    )
+    baker.make(models.Commune, latitude=PARIS[0], longitude=PARIS[1])
+
+    response = client.get(reverse("communes-nearby", args=[lille.id]))
+
+    assert response.status_code == 200
+    assert [c["name"] for c in response.json()] == [roubaix.name]
+    assert 10 < response.json()[0]["distance"] < 11
+
+
 CSV = """code_commune_INSEE,nom_commune_postal,code_postal,libelle_acheminement,ligne_5,latitude,longitude,code_commune,article,nom_commune,nom_commune_complet,code_departement,nom_departement,code_region,nom_region
 1001,L ABERGEMENT CLEMENCIAT,1400,L ABERGEMENT CLEMENCIAT,,46.1534255214,4.92611354223,1,L',Abergement-Clémenciat,L'Abergement-Clémenciat,1,Ain,84,Auvergne-Rhône-Alpes
 """
 
+CSV_MORE_ROWS = """1002,L ABERGEMENT DE VAREY,1640,L ABERGEMENT DE VAREY,,46.0,5.4,2,L',Abergement-de-Varey,L'Abergement-de-Varey,1,Ain,84,Auvergne-Rhône-Alpes
+1001,L ABERGEMENT CLEMENCIAT,1400,L ABERGEMENT CLEMENCIAT,HAMEAU,46.1534255214,4.92611354223,1,L',Abergement-Clémenciat,L'Abergement-Clémenciat,1,Ain,84,Auvergne-Rhône-Alpes
+1004,AMBERIEU EN BUGEY,1500,AMBERIEU EN BUGEY,,45.9608475114,5.3729257777,4,,Ambérieu-en-Bugey,Ambérieu-en-Bugey,1,Ain,84,Auvergne-Rhône-Alpes
+"""
+
 # eof
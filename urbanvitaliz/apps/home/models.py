@@ -9,10 +9,11 @@ created: 2021-11-15 14:44:55 CET
 
 from django.contrib.auth import models as auth
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_save
 from django.dispatch import receiver
 from phonenumber_field.modelfields import PhoneNumberField
 from urbanvitaliz.apps.addressbook import models as addressbook_models
+from urbanvitaliz import utils
 from urbanvitaliz.apps.geomatics import models as geomatics
 
 
@@ -73,4 +74,18 @@ def create_user_profile(sender, instance, created, **kwargs):
         UserProfile.objects.get_or_create(user=instance)
 
 
+@receiver(m2m_changed, sender=auth.User.groups.through)
+def forget_cached_groups(sender, instance, reverse, **kwargs):
+    """Drop roles memoized on a user whose groups changed"""
+    if not reverse:
+        utils.forget_user_roles(instance)
+
+
+@receiver(m2m_changed, sender=UserProfile.departments.through)
+def forget_cached_departments(sender, instance, reverse, **kwargs):
+    """Drop roles memoized on a user whose profile departments changed"""
+    if not reverse and UserProfile.user.field.is_cached(instance):
+        utils.forget_user_roles(instance.user)
+
+
 # eof
@@ -7,7 +7,6 @@ author  : raphael.marvie@beta.gouv.fr,guillaume.libersat@beta.gouv.fr
 created : 2021-05-26 13:55:23 CEST
 """
 
-
 from csvexport.actions import csvexport
 from django.contrib import admin
 from ordered_model.admin import OrderedInlineModelAdminMixin, OrderedTabularInline
@@ -95,4 +94,24 @@ class DocumentAdmin(admin.ModelAdmin):
     list_display = ["created_on", "description", "the_file"]
 
 
+@admin.register(models.ExportJob)
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ["kind", "requested_by", "status", "created_on", "finished_on"]
+    list_filter = ["status", "kind"]
+    readonly_fields = [
+        "created_on",
+        "started_on",
+        "finished_on",
+        "attempts",
+        "last_error",
+    ]
+    actions = ["requeue"]
+
+    @admin.action(description="Relancer les exports sélectionnés")
+    def requeue(self, request, queryset):
+        queryset.exclude(status=models.ExportJob.RUNNING).update(
+            status=models.ExportJob.PENDING, attempts=0, last_error=""
+        )
+
+
 # eof
@@ -1,10 +1,12 @@
-from django.contrib.contenttypes.models import ContentType
-from django.db.models import Q
-from urbanvitaliz.apps.projects import models as projects_models
 from urbanvitaliz.apps.survey import models as survey_models
 from urbanvitaliz.utils import check_if_switchtender
 
-from .utils import can_administrate_project, can_manage_project, get_active_project
+from .utils import (
+    can_administrate_project,
+    can_manage_project,
+    get_active_project,
+    get_project_notification_counts,
+)
 
 
 def is_switchtender_processor(request):
@@ -24,53 +26,24 @@ def active_project_processor(request):
     }
 
     if active_project:
-        try:
-            survey = survey_models.Survey.objects.get(pk=1)  # XXX Hardcoded survey ID
-            session, created = survey_models.Session.objects.get_or_create(
-                project=active_project, survey=survey
-            )
-        except survey_models.Survey.DoesNotExist:
-            session = None
-
-        # Retrieve notification count
-        project_ct = ContentType.objects.get_for_model(projects_models.Project)
-        project_notifications = request.user.notifications.filter(
-            target_content_type=project_ct.pk,
-            target_object_id=active_project.pk,
-        )
-
-        # Task notifications
-        task_ct = ContentType.objects.get_for_model(projects_models.Task)
-        task_followup_ct = ContentType.objects.get_for_model(
-            projects_models.TaskFollowup
-        )
-        action_notification_count = (
-            project_notifications.filter(
-                Q(action_object_content_type=task_ct)
-                | Q(action_object_content_type=task_followup_ct)
-            )
-            .unread()
-            .count()
+        # XXX Hardcoded survey ID, session only created on first visit
+        session = (
+            survey_models.Session.objects.filter(project=active_project, survey_id=1)
+            .select_related("survey")
+            .first()
         )
+        if session is None:
+            try:
+                survey = survey_models.Survey.objects.get(pk=1)
+                session, created = survey_models.Session.objects.get_or_create(
+                    project=active_project, survey=survey
+                )
+            except survey_models.Survey.DoesNotExist:
+                session = None
 
-        note_ct = ContentType.objects.get_for_model(projects_models.Note)
-        # Conversations notifications
-        conversations_notification_count = (
-            project_notifications.filter(
-                action_object_content_type=note_ct, action_notes__public=True
-            )
-            .unread()
-            .count()
-        )
-
-        # Internal followup notifications
-        followup_notification_count = (
-            project_notifications.filter(
-                action_object_content_type=note_ct, action_notes__public=False
-            )
-            .unread()
-            .count()
-        )
+        # Retrieve notification counts from the counters of the user, in a
+        # single uncached query
+        counts = get_project_notification_counts(request.user, active_project)
 
         context.update(
             {
@@ -81,9 +54,11 @@ def active_project_processor(request):
                     active_project, request.user
                 ),
                 "active_project_survey_session": session,
-                "active_project_action_notification_count": action_notification_count,
-                "active_project_conversations_notification_count": conversations_notification_count,
-                "active_project_followup_notification_count": followup_notification_count,
+                "active_project_action_notification_count": counts["action"],
+                "active_project_conversations_notification_count": counts[
+                    "conversations"
+                ],
+                "active_project_followup_notification_count": counts["followup"],
             }
         )
 
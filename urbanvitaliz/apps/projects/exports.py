@@ -0,0 +1,273 @@
+# encoding: utf-8
+
+"""
+Exports of projects
+
+Projects are read in chunks with their related objects prefetched, so that
+exports run a constant number of queries per chunk and can be streamed
+without holding every project in memory.
+
+Large exports can also be queued as export jobs: a worker claims them with a
+SELECT ... FOR UPDATE SKIP LOCKED, like the outbound email queue, and writes
+the generated file to the exports storage for the requester to download. Jobs
+left running by a crashed worker are claimed again after EXPORT_JOB_TIMEOUT,
+up to EXPORT_JOB_MAX_ATTEMPTS times, and finished jobs are purged with their
+file after EXPORT_JOB_RETENTION.
+
+When the worker runs on another host than the web server, EXPORTS_STORAGE
+must name a storage both can reach, files written to local media by the
+worker could not be downloaded.
+"""
+
+import csv
+import logging
+import tempfile
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import models as auth_models
+from django.core.files import File
+from django.db import transaction
+from django.db.models import Count, IntegerField, OuterRef, Prefetch, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.urls import reverse
+from django.utils import timezone
+from urbanvitaliz.utils import LinkBuilder
+
+from . import models
+from .utils import format_switchtender_identity
+
+CSV_HEADER = [
+    "departement",
+    "commune_insee",
+    "nom_friche",
+    "detail_adresse",
+    "date_contact",
+    "contact_dossier",
+    "mail",
+    "tel",
+    "conseillers",
+    "statut_conseil",
+    "nb_reco",
+    "lien_projet",
+]
+
+EXPORT_CHUNK_SIZE = 500
+
+logger = logging.getLogger(__name__)
+
+
+def projects_for_export(user, filters=None):
+    """
+    Return the projects user can export, most recent first
+
+    filters may restrict them to some statuses and department codes.
+    """
+    filters = filters or {}
+    projects = models.Project.objects.for_user(user).exclude(status="DRAFT")
+    if filters.get("status"):
+        projects = projects.filter(status__in=filters["status"])
+    if filters.get("departments"):
+        projects = projects.filter(commune__department__code__in=filters["departments"])
+    return projects.order_by("-created_on")
+
+
+def iter_projects_for_export(projects, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield the projects of the queryset in its order, fetched by chunks with
+    what the export needs
+
+    prefetch_related is ignored by queryset.iterator(), so ids are read first
+    and each chunk of them is loaded with its own prefetches.
+    """
+    ids = list(projects.values_list("id", flat=True))
+
+    public_tasks = (
+        models.Task.objects.filter(project=OuterRef("pk"), public=True)
+        .order_by()
+        .values("project")
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+    switchtenders = auth_models.User.objects.select_related("profile__organization")
+
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start : start + chunk_size]
+        chunk_projects = (
+            models.Project.objects.filter(pk__in=chunk)
+            .select_related("commune__department")
+            .prefetch_related(
+                Prefetch("switchtenders", queryset=switchtenders), "members"
+            )
+            .annotate(
+                public_task_count=Coalesce(
+                    Subquery(public_tasks, output_field=IntegerField()), 0
+                )
+            )
+            .in_bulk()
+        )
+        for id in chunk:
+            if id in chunk_projects:
+                yield chunk_projects[id]
+
+
+def iter_project_csv_rows(projects, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield the csv header then a row per project of the queryset"""
+    links = LinkBuilder(auto_login=False)
+
+    yield CSV_HEADER
+
+    for project in iter_projects_for_export(projects, chunk_size):
+        yield [
+            project.commune.department.code if project.commune else "??",
+            project.commune.insee if project.commune else "??",
+            project.name,
+            project.location,
+            project.created_on.date(),
+            f"{project.first_name} {project.last_name}",
+            [m.email for m in project.members.all()],
+            project.phone,
+            ", ".join(
+                format_switchtender_identity(user)
+                for user in project.switchtenders.all()
+            ),
+            project.status,
+            project.public_task_count,
+            links.build(reverse("projects-project-detail", args=[project.id])),
+        ]
+
+
+class Echo:
+    """Pseudo buffer handing back what the csv writer writes to it"""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv_lines(rows):
+    """Yield each row formatted as a csv line"""
+    writer = csv.writer(Echo())
+    for row in rows:
+        yield writer.writerow(row)
+
+
+########################################################################
+# export jobs
+########################################################################
+
+
+def export_projects_csv(job):
+    """Return the file name and csv lines of a projects export job"""
+    projects = projects_for_export(job.requested_by, job.filters)
+    today = timezone.localdate()
+    return (
+        f"urbanvitaliz-projects-{today}.csv",
+        iter_csv_lines(iter_project_csv_rows(projects)),
+    )
+
+
+# export job kinds and the function generating their file
+EXPORTS = {
+    "projects_csv": export_projects_csv,
+}
+
+
+def run_export_jobs(batch_size=1, max_attempts=None):
+    """Generate one batch of pending export jobs, return (done, failed) counts"""
+    if max_attempts is None:
+        max_attempts = getattr(settings, "EXPORT_JOB_MAX_ATTEMPTS", 3)
+
+    jobs, dead = claim_export_jobs(batch_size, max_attempts)
+
+    # files are generated out of the claiming transaction, running jobs are
+    # not claimed again by other workers until they time out
+    done = 0
+    failed = len(dead)
+    for job in jobs:
+        if run_export_job(job):
+            done += 1
+        else:
+            failed += 1
+    return done, failed
+
+
+def claim_export_jobs(batch_size, max_attempts):
+    """
+    Claim a batch of pending jobs, and of running ones whose worker crashed,
+    return (claimed, dead) jobs, dead ones being crashed with no attempt left
+    """
+    timeout = timedelta(seconds=getattr(settings, "EXPORT_JOB_TIMEOUT", 3600))
+
+    with transaction.atomic():
+        now = timezone.now()
+        jobs = list(
+            models.ExportJob.objects.filter(
+                Q(status=models.ExportJob.PENDING)
+                | Q(status=models.ExportJob.RUNNING, started_on__lt=now - timeout)
+            )
+            .order_by("created_on", "id")
+            .select_for_update(skip_locked=True)[:batch_size]
+        )
+        claimed, dead = [], []
+        for job in jobs:
+            if job.attempts >= max_attempts:
+                job.status = models.ExportJob.FAILED
+                job.last_error = "export did not finish, no attempt left"
+                job.finished_on = now
+                dead.append(job)
+            else:
+                job.status = models.ExportJob.RUNNING
+                job.started_on = now
+                job.attempts += 1
+                claimed.append(job)
+        models.ExportJob.objects.bulk_update(
+            jobs, ["status", "started_on", "attempts", "last_error", "finished_on"]
+        )
+
+    return claimed, dead
+
+
+def run_export_job(job):
+    """Write the file of a claimed job to storage, return True on success"""
+    try:
+        filename, lines = EXPORTS[job.kind](job)
+        with tempfile.TemporaryFile() as output:
+            for line in lines:
+                output.write(line.encode("utf-8"))
+            output.seek(0)
+            job.file.save(filename, File(output), save=False)
+    except Exception as error:
+        logger.exception("export job %s failed", job.pk)
+        job.status = models.ExportJob.FAILED
+        job.last_error = repr(error)
+    else:
+        job.status = models.ExportJob.DONE
+        job.last_error = ""
+
+    job.finished_on = timezone.now()
+    job.save(update_fields=["status", "file", "last_error", "finished_on"])
+    return job.status == models.ExportJob.DONE
+
+
+def purge_export_jobs(retention=None):
+    """
+    Delete the jobs finished for longer than retention seconds along with
+    their file, return the number of deleted jobs
+    """
+    if retention is None:
+        retention = getattr(settings, "EXPORT_JOB_RETENTION", 7 * 24 * 60 * 60)
+
+    jobs = list(
+        models.ExportJob.objects.filter(
+            status__in=(models.ExportJob.DONE, models.ExportJob.FAILED),
+            finished_on__lt=timezone.now() - timedelta(seconds=retention),
+        )
+    )
+    for job in jobs:
+        if job.file:
+            job.file.delete(save=False)
+    models.ExportJob.objects.filter(pk__in=[job.pk for job in jobs]).delete()
+    return len(jobs)
+
+
+# eof
@@ -288,8 +288,12 @@ class OnboardingWithCaptchaForm(OnboardingForm):
 class SelectCommuneForm(forms.Form):
     def __init__(self, communes, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.fields["commune"] = forms.ModelChoiceField(
-            queryset=communes, widget=forms.RadioSelect, label="Votre commune :"
+        by_id = {str(commune.pk): commune for commune in communes}
+        self.fields["commune"] = forms.TypedChoiceField(
+            choices=[(id, str(commune)) for id, commune in by_id.items()],
+            coerce=by_id.get,
+            widget=forms.RadioSelect,
+            label="Votre commune :",
         )
 
 
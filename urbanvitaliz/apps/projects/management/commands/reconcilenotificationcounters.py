@@ -0,0 +1,28 @@
+# encoding: utf-8
+
+"""
+Management command rebuilding the unread notification counters
+"""
+
+from django.core.management.base import BaseCommand
+from urbanvitaliz.apps.projects import utils
+
+
+class Command(BaseCommand):
+    help = "Rebuild the unread notification counters from the notifications"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "user_ids",
+            nargs="*",
+            type=int,
+            help="Users to reconcile, all users by default",
+        )
+
+    def handle(self, *args, **options):
+        user_ids = options["user_ids"] or None
+        count = utils.rebuild_notification_counters(user_ids=user_ids)
+        self.stdout.write(f"{count} notification counters rebuilt")
+
+
+# eof
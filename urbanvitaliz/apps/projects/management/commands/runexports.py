@@ -0,0 +1,43 @@
+# encoding: utf-8
+
+"""
+Management command generating the queued export jobs
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+from urbanvitaliz.apps.projects import exports
+
+
+class Command(BaseCommand):
+    help = "Generate queued export jobs and purge expired ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=1, help="Jobs claimed per batch"
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep polling the queue instead of exiting once empty",
+        )
+        parser.add_argument(
+            "--sleep", type=float, default=5, help="Seconds between empty polls"
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            done, failed = exports.run_export_jobs(options["batch_size"])
+            if done or failed:
+                print(f"Generated {done} export(s), {failed} failure(s)")
+                continue
+            purged = exports.purge_export_jobs()
+            if purged:
+                print(f"Purged {purged} expired export(s)")
+            if not options["loop"]:
+                break
+            time.sleep(options["sleep"])
+
+
+# eof
@@ -0,0 +1,78 @@
+# Generated by Django 3.2.14 on 2026-10-18 09:39
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import urbanvitaliz.apps.projects.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("projects", "0053_notificationcounter"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ExportJob",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("kind", models.CharField(max_length=40)),
+                ("filters", models.JSONField(blank=True, default=dict)),
+                (
+                    "status",
+                    models.IntegerField(
+                        choices=[
+                            (0, "en attente"),
+                            (1, "en cours"),
+                            (2, "terminé"),
+                            (3, "en échec"),
+                        ],
+                        default=0,
+                    ),
+                ),
+                (
+                    "file",
+                    models.FileField(
+                        blank=True,
+                        null=True,
+                        storage=urbanvitaliz.apps.projects.models.get_exports_storage,
+                        upload_to="exports/%Y/%m/",
+                    ),
+                ),
+                ("last_error", models.TextField(blank=True, default="")),
+                ("created_on", models.DateTimeField(default=django.utils.timezone.now)),
+                ("started_on", models.DateTimeField(blank=True, null=True)),
+                ("finished_on", models.DateTimeField(blank=True, null=True)),
+                ("attempts", models.PositiveSmallIntegerField(default=0)),
+                (
+                    "requested_by",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="export_jobs",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "export",
+                "verbose_name_plural": "exports",
+            },
+        ),
+        migrations.AddIndex(
+            model_name="exportjob",
+            index=models.Index(
+                fields=["status", "created_on"], name="projects_ex_status_65b7b4_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.2.14 on 2026-10-18 10:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("projects", "0054_exportjob"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CountedNotification",
+            fields=[
+                (
+                    "notification_id",
+                    models.PositiveIntegerField(primary_key=True, serialize=False),
+                ),
+                (
+                    "category",
+                    models.CharField(
+                        choices=[
+                            ("action", "Actions"),
+                            ("conversations", "Conversations"),
+                            ("followup", "Suivi interne"),
+                            ("general", "Général"),
+                            ("collaborator", "Activité des collaborateurs"),
+                        ],
+                        max_length=16,
+                    ),
+                ),
+                ("collaborator", models.BooleanField(default=False)),
+            ],
+        ),
+    ]
@@ -9,8 +9,10 @@ created : 2021-05-26 13:33:11 CEST
 
 import uuid
 
+from django.conf import settings
 from django.contrib.auth import models as auth_models
 from django.contrib.contenttypes.fields import GenericRelation
+from django.core.files.storage import get_storage_class
 from django.db import models
 from django.db.models import Q
 from django.urls import reverse
@@ -208,6 +210,70 @@ class ProjectMember(models.Model):
     is_owner = models.BooleanField(default=False)
 
 
+class NotificationCounter(models.Model):
+    """
+    Number of unread notifications of a user on a project, per category
+
+    Denormalized from notifications and the category recorded for each of
+    them, maintained by signal handlers and rebuilt by the
+    reconcilenotificationcounters command. Categories action, conversations,
+    followup and general partition the unread notifications, collaborator
+    counts the ones whose actor was not a switchtender when they were sent.
+    """
+
+    ACTION = "action"
+    CONVERSATIONS = "conversations"
+    FOLLOWUP = "followup"
+    GENERAL = "general"
+    COLLABORATOR = "collaborator"
+
+    CATEGORY_CHOICES = (
+        (ACTION, "Actions"),
+        (CONVERSATIONS, "Conversations"),
+        (FOLLOWUP, "Suivi interne"),
+        (GENERAL, "Général"),
+        (COLLABORATOR, "Activité des collaborateurs"),
+    )
+
+    # categories each unread notification belongs to exactly one of
+    PARTITION = (ACTION, CONVERSATIONS, FOLLOWUP, GENERAL)
+
+    class Meta:
+        unique_together = ("recipient", "project", "category")
+
+    recipient = models.ForeignKey(
+        auth_models.User, on_delete=models.CASCADE, related_name="+"
+    )
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name="+")
+    category = models.CharField(max_length=16, choices=CATEGORY_CHOICES)
+    count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):  # pragma: nocover
+        return f"{self.recipient_id} - {self.project_id} - {self.category}"
+
+
+class CountedNotification(models.Model):
+    """
+    Counter category of a notification on a project, stored when it is created
+
+    Unread toggles and deletions adjust the counters it was first counted in,
+    even once its action object is deleted or its actor changed groups. Keyed
+    by the notification id, without a foreign key, so that it is still there
+    when the notification deletion is handled. Categories of notifications
+    sent before are recorded by the reconcilenotificationcounters command.
+    """
+
+    notification_id = models.PositiveIntegerField(primary_key=True)
+    category = models.CharField(
+        max_length=16, choices=NotificationCounter.CATEGORY_CHOICES
+    )
+    # whether the actor was not a switchtender when the notification was sent
+    collaborator = models.BooleanField(default=False)
+
+    def __str__(self):  # pragma: nocover
+        return f"{self.notification_id} - {self.category}"
+
+
 class NoteManager(models.Manager):
     """Manager for active tasks"""
 
@@ -628,4 +694,56 @@ class Document(models.Model):
         return f"Document {self.id}"
 
 
+def get_exports_storage():
+    """
+    Return the storage of generated exports, EXPORTS_STORAGE or the default
+    one, shared by the web and worker hosts
+    """
+    return get_storage_class(getattr(settings, "EXPORTS_STORAGE", None))()
+
+
+class ExportJob(models.Model):
+    """An export requested by a user, generated by the export worker"""
+
+    PENDING = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+
+    STATUS_CHOICES = (
+        (PENDING, "en attente"),
+        (RUNNING, "en cours"),
+        (DONE, "terminé"),
+        (FAILED, "en échec"),
+    )
+
+    kind = models.CharField(max_length=40)
+    filters = models.JSONField(default=dict, blank=True)
+    requested_by = models.ForeignKey(
+        auth_models.User, on_delete=models.CASCADE, related_name="export_jobs"
+    )
+
+    status = models.IntegerField(choices=STATUS_CHOICES, default=PENDING)
+    file = models.FileField(
+        upload_to="exports/%Y/%m/",
+        storage=get_exports_storage,
+        null=True,
+        blank=True,
+    )
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(default="", blank=True)
+
+    created_on = models.DateTimeField(default=timezone.now)
+    started_on = models.DateTimeField(null=True, blank=True)
+    finished_on = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "export"
+        verbose_name_plural = "exports"
+        indexes = [models.Index(fields=["status", "created_on"])]
+
+    def __str__(self):  # pragma: nocover
+        return f"{self.kind} - {self.get_status_display()}"
+
+
 # eof
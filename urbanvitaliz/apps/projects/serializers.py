@@ -8,12 +8,17 @@ from urbanvitaliz.apps.geomatics.serializers import CommuneSerializer
 from urbanvitaliz.apps.home.serializers import UserSerializer
 from urbanvitaliz.apps.reminders import models as reminders_models
 from urbanvitaliz.apps.reminders.serializers import ReminderSerializer
+from urbanvitaliz.utils import SparseFieldsetMixin
 
-from .models import Project, Task, TaskFollowup
-from .utils import create_reminder
+from .models import NotificationCounter, Project, Task, TaskFollowup
+from .utils import (
+    create_reminder,
+    get_notification_counters,
+    get_project_notification_counts,
+)
 
 
-class ProjectSerializer(serializers.HyperlinkedModelSerializer):
+class ProjectSerializer(SparseFieldsetMixin, serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Project
         fields = [
@@ -42,24 +47,26 @@ class ProjectSerializer(serializers.HyperlinkedModelSerializer):
 
     def get_notifications(self, obj):
         request = self.context.get("request")
-        notifications = request.user.notifications
+        # counters of the user are read once for the whole list
+        if "notification_counters" not in self.context:
+            self.context["notification_counters"] = get_notification_counters(
+                request.user
+            )
+        counts = get_project_notification_counts(
+            request.user, obj, self.context["notification_counters"]
+        )
 
-        project_ct = ContentType.objects.get_for_model(obj)
+        return {
+            "count": counts["total"],
+            "has_collaborator_activity": counts[NotificationCounter.COLLABORATOR] > 0,
+        }
 
-        switchtender_group = auth_models.Group.objects.get(name="switchtender")
-        switchtenders = switchtender_group.user_set.values_list("id", flat=True)
-        switchtenders = [int(switchtender) for switchtender in switchtenders]
 
-        unread_notifications = notifications.filter(
-            target_content_type=project_ct.pk, target_object_id=obj.pk
-        ).unread()
+class NearbyProjectSerializer(ProjectSerializer):
+    class Meta(ProjectSerializer.Meta):
+        fields = ProjectSerializer.Meta.fields + ["distance"]
 
-        return {
-            "count": unread_notifications.count(),
-            "has_collaborator_activity": unread_notifications.exclude(
-                actor_object_id__in=switchtenders
-            ).exists(),
-        }
+    distance = serializers.FloatField(read_only=True)
 
 
 class TaskFollowupSerializer(serializers.HyperlinkedModelSerializer):
@@ -107,7 +114,9 @@ class TaskFollowupSerializer(serializers.HyperlinkedModelSerializer):
         return followup
 
 
-class TaskSerializer(serializers.HyperlinkedModelSerializer, OrderedModelSerializer):
+class TaskSerializer(
+    SparseFieldsetMixin, serializers.HyperlinkedModelSerializer, OrderedModelSerializer
+):
     class Meta:
         model = Task
         fields = [
@@ -136,26 +145,40 @@ class TaskSerializer(serializers.HyperlinkedModelSerializer, OrderedModelSeriali
     followups_count = serializers.SerializerMethodField()
     comments_count = serializers.SerializerMethodField()
 
-    def get_notifications(self, obj):
-        request = self.context.get("request")
-
-        followup_ct = ContentType.objects.get_for_model(TaskFollowup)
+    # counts are read from annotations when the queryset provides them
 
-        followup_ids = list(obj.followups.all().values_list("id", flat=True))
-        unread_notifications = request.user.notifications.filter(
-            action_object_content_type=followup_ct.pk,
-            action_object_object_id__in=followup_ids,
-        ).unread()
+    def get_notifications(self, obj):
+        count = getattr(obj, "notifications_count", None)
+        if count is None:
+            request = self.context.get("request")
+
+            followup_ct = ContentType.objects.get_for_model(TaskFollowup)
+
+            followup_ids = list(obj.followups.all().values_list("id", flat=True))
+            count = (
+                request.user.notifications.filter(
+                    action_object_content_type=followup_ct.pk,
+                    action_object_object_id__in=followup_ids,
+                )
+                .unread()
+                .count()
+            )
 
         return {
-            "count": unread_notifications.count(),
+            "count": count,
         }
 
     def get_followups_count(self, obj):
-        return obj.followups.count()
+        count = getattr(obj, "followups_count", None)
+        if count is None:
+            count = obj.followups.count()
+        return count
 
     def get_comments_count(self, obj):
-        return obj.followups.exclude(comment="").count()
+        count = getattr(obj, "comments_count", None)
+        if count is None:
+            count = obj.followups.exclude(comment="").count()
+        return count
 
     # FIXME : We should not send all the tasks to non switchtender users (filter queryset on current_user)
 
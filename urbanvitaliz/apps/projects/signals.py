@@ -4,26 +4,83 @@ import django.dispatch
 from actstream import action
 from actstream.models import action_object_stream
 from django.contrib.contenttypes.models import ContentType
-from django.db.models.signals import post_save, pre_delete, pre_save
+from django.db.models.signals import (
+    post_delete,
+    post_init,
+    post_save,
+    pre_delete,
+    pre_save,
+)
 from django.dispatch import receiver
 from django.utils import timezone
 from notifications import models as notifications_models
 from notifications.signals import notify
+from urbanvitaliz.apps.communication import digests
 from urbanvitaliz.apps.reminders import api as reminders_api
 from urbanvitaliz.apps.reminders import models as reminders_models
 from urbanvitaliz.apps.survey import signals as survey_signals
 
 from . import models
 from .utils import (
+    adjust_notification_counters,
     create_reminder,
+    forget_notification_category,
     get_collaborators_for_project,
     get_notification_recipients_for_project,
     get_project_moderators,
     get_regional_actors_for_project,
     get_switchtenders_for_project,
+    record_notification_category,
     remove_reminder,
 )
 
+
+def notify_with_digest(**kwargs):
+    """Send notifications and store their pre-rendered digest fragment"""
+    return digests.store_digest_fragments(notify.send(**kwargs))
+
+
+########################################################################
+# unread notification counters
+########################################################################
+
+
+@receiver(
+    post_init,
+    sender=notifications_models.Notification,
+    dispatch_uid="notification_remember_unread",
+)
+def remember_notification_unread(sender, instance, **kwargs):
+    """Keep the loaded unread flag to detect when it changes on save"""
+    instance._counted_unread = instance.__dict__.get("unread")
+
+
+@receiver(
+    post_save,
+    sender=notifications_models.Notification,
+    dispatch_uid="notification_update_counters",
+)
+def update_notification_counters_on_save(sender, instance, created, **kwargs):
+    if created:
+        categories = record_notification_category(instance)
+        if instance.unread:
+            adjust_notification_counters(instance, 1, categories)
+    elif instance._counted_unread not in (None, instance.unread):
+        adjust_notification_counters(instance, 1 if instance.unread else -1)
+    instance._counted_unread = instance.unread
+
+
+@receiver(
+    post_delete,
+    sender=notifications_models.Notification,
+    dispatch_uid="notification_delete_counters",
+)
+def update_notification_counters_on_delete(sender, instance, **kwargs):
+    categories = forget_notification_category(instance)
+    if instance.unread:
+        adjust_notification_counters(instance, -1, categories)
+
+
 #####
 # Projects
 #####
@@ -43,7 +100,7 @@ def notify_moderators_project_submitted(sender, submitter, project, **kwargs):
     recipients = get_project_moderators()
 
     # Notify project moderators
-    notify.send(
+    notify_with_digest(
         sender=submitter,
         recipient=recipients,
         verb="a soumis pour modération le projet",
@@ -64,7 +121,7 @@ def log_project_validated(sender, moderator, project, **kwargs):
     if not project.owner:
         return
 
-    notify.send(
+    notify_with_digest(
         sender=project.owner,
         recipient=get_regional_actors_for_project(project),
         verb="a déposé le projet",
@@ -99,7 +156,7 @@ def notify_project_switchtender_joined(sender, project, **kwargs):
     )
 
     # Notify regional actors
-    notify.send(
+    notify_with_digest(
         sender=sender,
         recipient=recipients,
         verb="est devenu·e aiguilleur·se sur le projet",
@@ -181,7 +238,7 @@ def notify_action_created(sender, task, project, user, **kwargs):
 
     recipients = get_notification_recipients_for_project(project).exclude(id=user.id)
 
-    notify.send(
+    notify_with_digest(
         sender=user,
         recipient=recipients,
         verb="a recommandé l'action",
@@ -269,7 +326,7 @@ def notify_action_commented(sender, task, project, user, **kwargs):
         return
 
     recipients = get_notification_recipients_for_project(project).exclude(id=user.id)
-    notify.send(
+    notify_with_digest(
         sender=user,
         recipient=recipients,
         verb="a commenté l'action",
@@ -349,7 +406,7 @@ def notify_note_created(sender, note, project, user, **kwargs):
     if project.status == "DRAFT" or project.muted:
         return
 
-    notify.send(
+    notify_with_digest(
         sender=user,
         recipient=recipients,
         verb="a créé une note de suivi",
@@ -384,7 +441,7 @@ def project_document_uploaded(sender, instance, created, **kwargs):
         id=instance.uploaded_by.id
     )
 
-    notify.send(
+    notify_with_digest(
         sender=instance.uploaded_by,
         recipient=recipients,
         verb="a ajouté un document",
@@ -419,7 +476,7 @@ def log_survey_session_updated(sender, session, request, **kwargs):
     )
 
     recipients = get_switchtenders_for_project(project).exclude(id=user.id)
-    notify.send(
+    notify_with_digest(
         sender=user,
         recipient=recipients,
         verb="a mis à jour le questionnaire",
@@ -10,12 +10,16 @@ created: 2021-06-01 10:11:56 CEST
 import csv
 import datetime
 import io
+import os
 import uuid
 
 import django.core.mail
 import pytest
 from django.contrib.auth import models as auth
+from django.contrib.sites.models import Site
+from django.core.management import call_command
 from django.urls import reverse
+from django.utils import timezone
 from model_bakery import baker
 from model_bakery.recipe import Recipe
 from notifications import notify
@@ -27,7 +31,7 @@ from urbanvitaliz.apps.reminders import models as reminders
 from urbanvitaliz.apps.resources import models as resources
 from urbanvitaliz.utils import login
 
-from .. import models, signals
+from .. import exports, models, signals
 
 # TODO when local authority can see & update her project
 # TODO check that project, note, and task belong to her
@@ -402,6 +406,7 @@ def test_project_list_excludes_project_not_in_switchtender_departments(client):
 # Project details
 ########################################################################
 
+
 # Knowledge
 @pytest.mark.django_db
 def test_project_knowledge_not_available_for_non_switchtender(client):
@@ -1512,7 +1517,7 @@ def test_switchtender_exports_csv(client):
 
     assert response.status_code == 200
 
-    content = response.content.decode("utf-8")
+    content = b"".join(response.streaming_content).decode("utf-8")
     cvs_reader = csv.reader(io.StringIO(content))
     body = list(cvs_reader)
     body.pop(0)
@@ -1520,4 +1525,200 @@ def test_switchtender_exports_csv(client):
     assert len(body) == 1
 
 
+def test_csv_export_reads_projects_by_chunks_with_their_related_objects(
+    django_assert_num_queries,
+):
+    user = Recipe(auth.User, first_name="Jeanne", last_name="Dupont").make()
+    for idx in range(5):
+        project = Recipe(
+            models.Project, name=f"Projet {idx}", commune__insee=f"5900{idx}"
+        ).make()
+        project.switchtenders.add(user)
+        baker.make(models.ProjectMember, project=project, member=baker.make(auth.User))
+        for _ in range(idx):
+            baker.make(models.Task, project=project, public=True)
+        baker.make(models.Task, project=project, public=False)
+    projects = models.Project.objects.order_by("name")
+    Site.objects.clear_cache()
+
+    # ids, site, then per chunk: projects, switchtenders, members
+    with django_assert_num_queries(2 + 3 * 3):
+        header, *rows = exports.iter_project_csv_rows(projects, chunk_size=2)
+
+    assert header == exports.CSV_HEADER
+    assert [row[2] for row in rows] == [f"Projet {idx}" for idx in range(5)]
+    assert [row[10] for row in rows] == list(range(5))
+    assert rows[0][8] == "Jeanne Dupont"
+
+
+########################################################################
+# export jobs
+########################################################################
+
+
+@pytest.fixture
+def media_root(settings, tmp_path):
+    settings.MEDIA_ROOT = tmp_path
+    return tmp_path
+
+
+@pytest.mark.django_db
+def test_export_job_not_available_for_non_switchtender(client):
+    with login(client):
+        response = client.post(reverse("projects-project-list-export-job"))
+
+    assert response.status_code == 403
+    assert models.ExportJob.objects.count() == 0
+
+
+@pytest.mark.django_db
+def test_switchtender_queues_export_job(client):
+    url = reverse("projects-project-list-export-job")
+    with login(client, groups=["switchtender"]) as user:
+        response = client.post(url, {"status": ["READY", "DONE"]})
+
+    assert response.status_code == 202
+    job = models.ExportJob.objects.get()
+    assert (job.kind, job.requested_by, job.status) == (
+        "projects_csv",
+        user,
+        models.ExportJob.PENDING,
+    )
+    assert job.filters == {"status": ["READY", "DONE"]}
+    assert response.json()["status_url"] == reverse(
+        "projects-export-job-status", args=[job.id]
+    )
+    assert response.json()["download_url"] is None
+
+
+@pytest.mark.django_db
+def test_export_worker_writes_file_of_pending_jobs(client, media_root):
+    p1 = Recipe(models.Project, name="Projet 1", status="READY").make()
+    p2 = Recipe(models.Project, name="Projet 2", status="DONE").make()
+
+    with login(client, groups=["switchtender"]) as user:
+        p1.switchtenders.add(user)
+        p2.switchtenders.add(user)
+        client.post(reverse("projects-project-list-export-job"), {"status": "READY"})
+
+        assert exports.run_export_jobs() == (1, 0)
+
+        job = models.ExportJob.objects.get()
+        status = client.get(reverse("projects-export-job-status", args=[job.id]))
+        response = client.get(reverse("projects-export-job-download", args=[job.id]))
+
+    assert job.status == models.ExportJob.DONE
+    assert job.started_on and job.finished_on
+    assert status.json()["download_url"] == reverse(
+        "projects-export-job-download", args=[job.id]
+    )
+    content = b"".join(response.streaming_content).decode("utf-8")
+    header, *rows = csv.reader(io.StringIO(content))
+    assert header == exports.CSV_HEADER
+    assert [row[2] for row in rows] == ["Projet 1"]
+
+
+@pytest.mark.django_db
+def test_export_worker_records_failed_jobs(media_root):
+    job = baker.make(models.ExportJob, kind="unknown")
+
+    assert exports.run_export_jobs() == (0, 1)
+
+    job.refresh_from_db()
+    assert job.status == models.ExportJob.FAILED
+    assert "unknown" in job.last_error
+
+
+@pytest.mark.django_db
+def test_export_worker_reclaims_jobs_of_crashed_workers(media_root):
+    an_hour_ago = timezone.now() - datetime.timedelta(hours=1)
+    stale = baker.make(
+        models.ExportJob,
+        kind="projects_csv",
+        status=models.ExportJob.RUNNING,
+        started_on=an_hour_ago - datetime.timedelta(seconds=1),
+        attempts=1,
+    )
+    baker.make(
+        models.ExportJob,
+        kind="projects_csv",
+        status=models.ExportJob.RUNNING,
+        started_on=an_hour_ago + datetime.timedelta(minutes=1),
+        attempts=1,
+    )
+
+    assert exports.run_export_jobs(batch_size=2) == (1, 0)
+
+    stale.refresh_from_db()
+    assert (stale.status, stale.attempts) == (models.ExportJob.DONE, 2)
+
+
+@pytest.mark.django_db
+def test_export_worker_fails_crashed_jobs_with_no_attempt_left(settings):
+    settings.EXPORT_JOB_MAX_ATTEMPTS = 2
+    job = baker.make(
+        models.ExportJob,
+        kind="projects_csv",
+        status=models.ExportJob.RUNNING,
+        started_on=timezone.now() - datetime.timedelta(days=1),
+        attempts=2,
+    )
+
+    assert exports.run_export_jobs() == (0, 1)
+
+    job.refresh_from_db()
+    assert job.status == models.ExportJob.FAILED
+    assert job.finished_on and job.last_error
+
+
+@pytest.mark.django_db
+def test_purge_export_jobs_deletes_expired_jobs_and_files(media_root):
+    old, recent = baker.make(models.ExportJob, kind="projects_csv", _quantity=2)
+    assert exports.run_export_jobs(batch_size=2) == (2, 0)
+    old.refresh_from_db()
+    path = old.file.path
+    models.ExportJob.objects.filter(pk=old.pk).update(
+        finished_on=timezone.now() - datetime.timedelta(days=8)
+    )
+
+    assert exports.purge_export_jobs() == 1
+
+    assert list(models.ExportJob.objects.all()) == [recent]
+    assert not os.path.exists(path)
+
+
+@pytest.mark.django_db
+def test_export_job_status_is_restricted_to_requester(client):
+    job = baker.make(models.ExportJob, kind="projects_csv")
+
+    with login(client, groups=["switchtender"]):
+        status = client.get(reverse("projects-export-job-status", args=[job.id]))
+        download = client.get(reverse("projects-export-job-download", args=[job.id]))
+
+    assert status.status_code == 404
+    assert download.status_code == 404
+
+
+@pytest.mark.django_db
+def test_export_job_cannot_be_downloaded_before_done(client):
+    with login(client, groups=["switchtender"]) as user:
+        job = baker.make(models.ExportJob, kind="projects_csv", requested_by=user)
+        response = client.get(reverse("projects-export-job-download", args=[job.id]))
+
+    assert response.status_code == 404
+
+
+@pytest.mark.django_db
+def test_runexports_command_drains_queue(mocker):
+    mocker.patch(
+        "urbanvitaliz.apps.projects.exports.run_export_jobs",
+        side_effect=[(1, 0), (0, 0)],
+    )
+
+    call_command("runexports", "--batch-size", "3")
+
+    assert exports.run_export_jobs.call_count == 2
+    exports.run_export_jobs.assert_called_with(3)
+
+
 # eof
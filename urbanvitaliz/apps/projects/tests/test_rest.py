@@ -7,11 +7,19 @@ authors: raphael.marvie@beta.gouv.fr, guillaume.libersat@beta.gouv.fr
 created: 2021-06-01 10:11:56 CEST
 """
 
+import datetime
 
 import pytest
+from django.contrib.auth import models as auth
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+from model_bakery import baker
 from model_bakery.recipe import Recipe
+from notifications.signals import notify
 from pytest_django.asserts import assertContains
+from urbanvitaliz.apps.geomatics import models as geomatics
 from urbanvitaliz.utils import login
 
 from .. import models
@@ -46,6 +54,32 @@ def test_project_list_includes_project_for_switchtender(client):
     assertContains(response, project.name)
 
 
+def make_switchtended_projects(user, count):
+    for _ in range(count):
+        project = Recipe(models.Project, commune__department__code="01").make()
+        project.switchtenders.add(user, baker.make(auth.User))
+
+
+@pytest.mark.django_db
+def test_project_list_runs_a_constant_number_of_queries(client):
+    url = reverse("projects-list")
+    with login(client, groups=["switchtender"]) as user:
+        make_switchtended_projects(user, 2)
+        client.get(url)  # warm up the content types cache
+        with CaptureQueriesContext(connection) as few:
+            response = client.get(url)
+        assert len(response.json()) == 2
+
+        make_switchtended_projects(user, 5)
+        with CaptureQueriesContext(connection) as many:
+            response = client.get(url)
+        assert len(response.json()) == 7
+
+    assert len(many.captured_queries) == len(few.captured_queries)
+    assert all(project["is_switchtender"] for project in response.json())
+    assert len(response.json()[0]["switchtenders"]) == 2
+
+
 @pytest.mark.django_db
 def test_project_list_includes_project_in_switchtender_departments(client):
     project = Recipe(models.Project, commune__department__code="01").make()
@@ -55,3 +89,146 @@ def test_project_list_includes_project_in_switchtender_departments(client):
         response = client.get(url)
 
     assertContains(response, project.name)
+
+
+@pytest.mark.django_db
+def test_project_nearby_lists_closest_visible_projects(client):
+    department = baker.make(geomatics.Department, code="59")
+    lille, roubaix, tourcoing, paris = (
+        baker.make(
+            geomatics.Commune,
+            department=department,
+            latitude=latitude,
+            longitude=longitude,
+        )
+        for latitude, longitude in (
+            (50.6292, 3.0573),
+            (50.6942, 3.1746),
+            (50.7239, 3.1612),
+            (48.8566, 2.3522),
+        )
+    )
+    project = Recipe(models.Project, commune=lille).make()
+    Recipe(models.Project, name="Tourcoing", commune=tourcoing, status="READY").make()
+    Recipe(models.Project, name="Roubaix", commune=roubaix, status="READY").make()
+    Recipe(models.Project, name="Paris", commune=paris, status="READY").make()
+    Recipe(models.Project, name="Draft", commune=roubaix, status="DRAFT").make()
+
+    url = reverse("projects-nearby", args=[project.id])
+    with login(client, groups=["switchtender"]) as user:
+        user.profile.departments.add(department)
+        response = client.get(url, {"radius": 20})
+
+    assert response.status_code == 200
+    assert [p["name"] for p in response.json()] == ["Roubaix", "Tourcoing"]
+    assert 10 < response.json()[0]["distance"] < 11
+
+
+@pytest.mark.django_db
+def test_project_list_is_paginated_on_demand(client):
+    url = reverse("projects-list")
+    with login(client, groups=["switchtender"]) as user:
+        make_switchtended_projects(user, 3)
+        assert len(client.get(url).json()) == 3
+
+        page = client.get(url, {"page_size": 2, "fields": "id,name"}).json()
+        assert [set(project) for project in page["results"]] == [{"id", "name"}] * 2
+        page = client.get(page["next"]).json()
+
+    assert len(page["results"]) == 1
+
+
+########################################################################
+# conditional requests
+########################################################################
+
+
+@pytest.mark.django_db
+def test_project_list_is_not_modified_until_a_project_changes(client):
+    url = reverse("projects-list")
+    with login(client, groups=["switchtender"]) as user:
+        make_switchtended_projects(user, 2)
+        client.get(url)  # warm up the content types cache
+        with CaptureQueriesContext(connection) as full:
+            response = client.get(url)
+        etag = response["ETag"]
+
+        # answered from the version queries, projects are not serialized
+        with CaptureQueriesContext(connection) as not_modified:
+            response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+        assert len(not_modified) < len(full)
+
+        response = client.get(url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])
+        assert response.status_code == 304
+
+        # as project edition views do
+        models.Project.objects.filter(pk=models.Project.objects.first().pk).update(
+            name="renamed", updated_on=timezone.now() + datetime.timedelta(seconds=1)
+        )
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    assert response.status_code == 200
+    assert response["ETag"] != etag
+
+
+@pytest.mark.django_db
+def test_project_list_is_modified_by_deletions_and_switchtenders(client):
+    url = reverse("projects-list")
+    with login(client, groups=["switchtender"]) as user:
+        make_switchtended_projects(user, 2)
+        first, second = models.Project.objects.all()
+        etag = client.get(url)["ETag"]
+
+        second.switchtenders.add(baker.make(auth.User))
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        etag = response["ETag"]
+
+        models.Project.objects.filter(pk=first.pk).delete()
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    assert response.status_code == 200
+    assert len(response.json()) == 1
+
+
+@pytest.mark.django_db
+def test_project_list_etag_depends_on_query_and_user(client):
+    url = reverse("projects-list")
+    with login(client, groups=["switchtender"]) as user:
+        make_switchtended_projects(user, 1)
+        etag = client.get(url)["ETag"]
+        response = client.get(url, {"fields": "id"}, HTTP_IF_NONE_MATCH=etag)
+
+    assert response.status_code == 200
+
+    with login(client, username="other", groups=["switchtender"]):
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    assert response.status_code == 200
+
+
+@pytest.mark.django_db
+def test_task_list_is_modified_by_followups_and_read_notifications(client):
+    task = Recipe(models.Task).make()
+    url = reverse("project-tasks-list", args=[task.project.id])
+    with login(client, groups=["switchtender"]) as user:
+        etag = client.get(url)["ETag"]
+        assert client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == 304
+
+        followup = baker.make(models.TaskFollowup, task=task, comment="")
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        etag = response["ETag"]
+
+        notify.send(
+            sender=baker.make(auth.User),
+            recipient=user,
+            verb="a commenté l'action",
+            action_object=followup,
+            target=task.project,
+        )
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    assert response.status_code == 200
+    assert response.json()[0]["notifications"]["count"] == 1
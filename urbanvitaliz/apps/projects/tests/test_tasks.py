@@ -7,9 +7,10 @@ authors: raphael.marvie@beta.gouv.fr, guillaume.libersat@beta.gouv.fr
 created: 2021-06-01 10:11:56 CEST
 """
 
-
 import pytest
 from django.contrib.auth import models as auth
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from model_bakery import baker
@@ -792,3 +793,49 @@ def test_unassigned_user_should_not_see_recommendations():
         response = client.get(url)
 
     assert response.status_code == 403
+
+
+def make_followed_up_task(project, user):
+    task = Recipe(models.Task, project=project).make()
+    baker.make(reminders_models.Reminder, related=task, deadline=timezone.now())
+    baker.make(models.TaskFollowup, task=task, comment="")
+    followup = baker.make(models.TaskFollowup, task=task, comment="un commentaire")
+    notify.send(
+        sender=baker.make(auth.User),
+        recipient=user,
+        verb="a commenté l'action",
+        action_object=followup,
+        target=project,
+    )
+    return task
+
+
+@pytest.mark.django_db
+def test_task_list_annotates_counts_with_a_constant_number_of_queries():
+    project = Recipe(models.Project).make()
+    client = APIClient()
+
+    with login(client, groups=["switchtender"]) as user:
+        url = reverse("project-tasks-list", args=[project.id])
+        make_followed_up_task(project, user)
+        client.get(url)  # warm up cached roles
+        with CaptureQueriesContext(connection) as few:
+            client.get(url)
+
+        for _ in range(4):
+            make_followed_up_task(project, user)
+        with CaptureQueriesContext(connection) as many:
+            response = client.get(url)
+
+    assert len(many.captured_queries) == len(few.captured_queries)
+    tasks = response.json()
+    assert len(tasks) == 5
+    assert {
+        (
+            task["followups_count"],
+            task["comments_count"],
+            task["notifications"]["count"],
+            len(task["reminders"]),
+        )
+        for task in tasks
+    } == {(2, 1, 1, 1)}
@@ -7,11 +7,14 @@ authors: raphael.marvie@beta.gouv.fr, guillaume.libersat@beta.gouv.fr
 created: 2022-01-18 10:11:56 CEST
 """
 
-
 import pytest
 from django.contrib.auth import models as auth
+from django.core.management import call_command
+from django.urls import reverse
 from model_bakery import baker
 from model_bakery.recipe import Recipe
+from notifications.signals import notify
+from urbanvitaliz import utils as uv_utils
 from urbanvitaliz.apps.geomatics import models as geomatics
 
 from .. import models, utils
@@ -95,3 +98,290 @@ def test_check_if_switchtends_any_project(client):
 
     assert utils.can_administrate_project(project=None, user=userA)
     assert not utils.can_administrate_project(project=None, user=userB)
+
+
+########################################################################
+# project access
+########################################################################
+
+
+@pytest.mark.django_db
+def test_project_access_resolves_roles_in_a_single_query(
+    client, django_assert_num_queries
+):
+    group = auth.Group.objects.get(name="switchtender")
+    dept62 = baker.make(geomatics.Department, code="62")
+    switchtender = baker.make(auth.User, groups=[group])
+    switchtender.profile.departments.set([dept62])
+    project = baker.make(models.Project, status="READY", commune__department=dept62)
+    project.switchtenders.add(switchtender)
+    project = models.Project.objects.select_related("commune").get(pk=project.pk)
+
+    # groups and departments are cached on the user
+    uv_utils.get_group_names(switchtender)
+    uv_utils.get_department_codes(switchtender)
+
+    access = utils.ProjectAccess(project, switchtender)
+    with django_assert_num_queries(1):
+        assert not access.is_member
+        assert not access.is_owner
+        assert access.is_switchtender
+        assert not access.is_national_actor
+        assert access.is_regional_actor()
+        assert access.can_administrate
+        assert access.can_manage()
+
+
+@pytest.mark.django_db
+def test_project_access_of_members(client):
+    membership = baker.make(models.ProjectMember, is_owner=True)
+    project = Recipe(
+        models.Project, projectmember_set=[membership], status="DRAFT"
+    ).make()
+
+    access = utils.ProjectAccess(project, membership.member)
+
+    assert access.is_member
+    assert access.is_owner
+    assert not access.is_switchtender
+    assert not access.can_manage()
+    assert access.can_manage(allow_draft=True)
+
+
+@pytest.mark.django_db
+def test_project_access_of_national_actor(client):
+    group = auth.Group.objects.get(name="switchtender")
+    switchtender = baker.make(auth.User, groups=[group])
+    project = baker.make(models.Project, status="READY", commune__department__code="62")
+
+    access = utils.ProjectAccess(project, switchtender)
+
+    assert access.is_national_actor
+    assert not access.is_regional_actor()
+    assert access.is_regional_actor(allow_national=True)
+    assert utils.check_if_national_actor(switchtender)
+
+
+@pytest.mark.django_db
+def test_project_access_is_computed_once_per_request(
+    client, rf, django_assert_num_queries
+):
+    membership = baker.make(models.ProjectMember, is_owner=True)
+    project = Recipe(
+        models.Project, projectmember_set=[membership], status="READY"
+    ).make()
+    request = rf.get("/")
+    request.user = membership.member
+
+    access = utils.get_request_project_access(request, project)
+    assert access.can_manage()
+
+    with django_assert_num_queries(0):
+        assert utils.get_request_project_access(request, project) is access
+        assert utils.can_manage_project(project, request.user)
+        assert utils.is_member(request.user, project, allow_draft=False)
+
+
+########################################################################
+# notification counters
+########################################################################
+
+
+def notify_on_project(user, project, action_object, sender=None):
+    notify.send(
+        sender=sender or baker.make(auth.User),
+        recipient=user,
+        verb="a fait quelque chose",
+        action_object=action_object,
+        target=project,
+    )
+
+
+@pytest.mark.django_db
+def test_project_notification_counts_in_a_single_query(django_assert_num_queries):
+    user = baker.make(auth.User)
+    project = baker.make(models.Project)
+    notify_on_project(user, project, baker.make(models.Task, project=project))
+    notify_on_project(user, project, baker.make(models.Note, public=True))
+    notify_on_project(user, project, baker.make(models.Note, public=False))
+    notify_on_project(user, project, baker.make(models.Note, public=False))
+    notify_on_project(user, baker.make(models.Project), baker.make(models.Note))
+
+    with django_assert_num_queries(1):
+        counts = utils.get_project_notification_counts(user, project)
+
+    assert counts == {
+        "action": 1,
+        "conversations": 1,
+        "followup": 2,
+        "general": 0,
+        "collaborator": 4,
+        "total": 4,
+    }
+
+
+@pytest.mark.django_db
+def test_project_notification_counts_follow_new_notifications():
+    user = baker.make(auth.User)
+    project = baker.make(models.Project)
+
+    assert utils.get_project_notification_counts(user, project)["action"] == 0
+
+    notify_on_project(user, project, baker.make(models.Task, project=project))
+
+    assert utils.get_project_notification_counts(user, project)["action"] == 1
+
+
+@pytest.mark.django_db
+def test_project_notification_counts_follow_mark_as_read(client):
+    membership = baker.make(models.ProjectMember, is_owner=True)
+    project = Recipe(
+        models.Project, projectmember_set=[membership], status="READY"
+    ).make()
+    user = membership.member
+    notify_on_project(user, project, baker.make(models.Note, public=True))
+    assert utils.get_project_notification_counts(user, project)["conversations"] == 1
+
+    with uv_utils.login(client, user=user):
+        client.get(reverse("projects-project-detail-conversations", args=[project.id]))
+
+    assert utils.get_project_notification_counts(user, project)["conversations"] == 0
+
+
+@pytest.mark.django_db
+def test_mark_notifications_as_read_decrements_counters_of_updated_ones():
+    user = baker.make(auth.User)
+    project = baker.make(models.Project)
+    notify_on_project(user, project, baker.make(models.Note, public=True))
+    notify_on_project(user, project, baker.make(models.Note, public=True))
+    notify_on_project(user, project, baker.make(models.Task, project=project))
+    notes = user.notifications.filter(action_object_content_type__model="note")
+
+    assert utils.mark_notifications_as_read(notes) == 2
+
+    counts = utils.get_project_notification_counts(user, project)
+    assert (counts["conversations"], counts["action"], counts["total"]) == (0, 1, 1)
+    assert utils.mark_notifications_as_read(user.notifications.all()) == 1
+    assert utils.get_project_notification_counts(user, project)["total"] == 0
+
+
+@pytest.mark.django_db
+def test_mark_notifications_as_read_does_not_write_when_all_read(
+    django_assert_num_queries,
+):
+    user = baker.make(auth.User)
+    project = baker.make(models.Project)
+    notify_on_project(user, project, project)
+    user.notifications.mark_all_as_read()
+
+    # savepoint, lookup of the unread ones and release
+    with django_assert_num_queries(3):
+        assert utils.mark_notifications_as_read(user.notifications.all()) == 0
+
+
+@pytest.mark.django_db
+def test_notification_counters_follow_read_and_deleted_notifications():
+    user = baker.make(auth.User)
+    project = baker.make(models.Project)
+    for _ in range(3):
+        notify_on_project(user, project, project)
+    first, second, _ = user.notifications.all()
+
+    first.mark_as_read()
+    first.mark_as_read()
+    second.delete()
+    first.delete()
+
+    counts = utils.get_project_notification_counts(user, project)
+    assert (counts["general"], counts["total"]) == (1, 1)
+
+
+@pytest.mark.django_db
+def test_notification_counters_skip_switchtender_activity():
+    group = auth.Group.objects.get(name="switchtender")
+    switchtender = baker.make(auth.User, groups=[group])
+    user = baker.make(auth.User)
+    project = baker.make(models.Project)
+
+    notify_on_project(user, project, project, sender=switchtender)
+
+    counts = utils.get_project_notification_counts(user, project)
+    assert (counts["total"], counts["collaborator"]) == (1, 0)
+
+
+@pytest.mark.django_db
+def test_notification_counters_keep_category_of_changed_note():
+    user = baker.make(auth.User)
+    project = baker.make(models.Project)
+    note = baker.make(models.Note, public=True)
+    notify_on_project(user, project, note)
+
+    note.public = False
+    note.save()
+    user.notifications.get().delete()
+
+    counts = utils.get_project_notification_counts(user, project)
+    assert (counts["conversations"], counts["followup"]) == (0, 0)
+    assert not models.CountedNotification.objects.exists()
+
+
+@pytest.mark.django_db
+def test_notification_counters_follow_deleted_note():
+    user = baker.make(auth.User)
+    project = baker.make(models.Project)
+    note = baker.make(models.Note, public=True)
+    notify_on_project(user, project, note)
+
+    note.delete()
+
+    counts = utils.get_project_notification_counts(user, project)
+    assert (counts["conversations"], counts["total"]) == (0, 0)
+    assert not models.CountedNotification.objects.exists()
+
+
+@pytest.mark.django_db
+def test_notification_counters_keep_collaborator_after_group_change():
+    group = auth.Group.objects.get(name="switchtender")
+    actor = baker.make(auth.User)
+    user = baker.make(auth.User)
+    project = baker.make(models.Project)
+    notify_on_project(user, project, project, sender=actor)
+
+    actor.groups.add(group)
+    user.notifications.get().mark_as_read()
+
+    counts = utils.get_project_notification_counts(user, project)
+    assert (counts["total"], counts["collaborator"]) == (0, 0)
+
+
+@pytest.mark.django_db
+def test_rebuild_notification_counters_records_missing_categories():
+    user = baker.make(auth.User)
+    project = baker.make(models.Project)
+    notify_on_project(user, project, baker.make(models.Note, public=False))
+    models.CountedNotification.objects.all().delete()
+
+    utils.rebuild_notification_counters()
+
+    counted = models.CountedNotification.objects.get()
+    assert (counted.category, counted.collaborator) == ("followup", True)
+    assert utils.get_project_notification_counts(user, project)["followup"] == 1
+
+
+@pytest.mark.django_db
+def test_rebuild_notification_counters_matches_maintained_ones():
+    group = auth.Group.objects.get(name="switchtender")
+    switchtender = baker.make(auth.User, groups=[group])
+    user = baker.make(auth.User)
+    project = baker.make(models.Project)
+    notify_on_project(user, project, baker.make(models.Task, project=project))
+    notify_on_project(user, project, baker.make(models.Note, public=True))
+    notify_on_project(user, project, baker.make(models.Note, public=False))
+    notify_on_project(user, project, project, sender=switchtender)
+    user.notifications.first().mark_as_read()
+    maintained = utils.get_project_notification_counts(user, project)
+    models.NotificationCounter.objects.update(count=42)
+
+    call_command("reconcilenotificationcounters")
+
+    assert utils.get_project_notification_counts(user, project) == maintained
@@ -7,7 +7,6 @@ author  : raphael.marvie@beta.gouv.fr,guillaume.libersat@beta.gouv.fr
 created : 2021-05-26 15:54:25 CEST
 """
 
-
 from django.urls import path
 
 from . import views
@@ -32,6 +31,21 @@ urlpatterns = [
         views.project_list_export_csv,
         name="projects-project-list-export-csv",
     ),
+    path(
+        r"projects/exports/",
+        views.project_list_export_job,
+        name="projects-project-list-export-job",
+    ),
+    path(
+        r"exports/<int:job_id>/",
+        views.export_job_status,
+        name="projects-export-job-status",
+    ),
+    path(
+        r"exports/<int:job_id>/download",
+        views.export_job_download,
+        name="projects-export-job-download",
+    ),
     path("projects/feed/", feeds.LatestProjectsFeed(), name="projects-feed"),
     path(
         r"project/<int:project_id>/",
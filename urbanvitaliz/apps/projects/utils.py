@@ -9,12 +9,29 @@ created: <2021-09-13 lun. 15:38>
 """
 
 import uuid
+from collections import defaultdict
+from functools import cached_property
 
 from django.contrib.auth import models as auth_models
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import PermissionDenied
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import (
+    Case,
+    CharField,
+    Count,
+    Exists,
+    F,
+    OuterRef,
+    Q,
+    Subquery,
+    Value,
+    When,
+)
+from django.db.models.functions import Cast, Greatest
 from django.urls import reverse
 from django.utils import timezone
+from notifications import models as notifications_models
 from urbanvitaliz import utils as uv_utils
 from urbanvitaliz.apps.communication.digests import (
     make_action_digest,
@@ -24,6 +41,112 @@ from urbanvitaliz.apps.reminders import api
 
 from . import models
 
+########################################################################
+# project access
+########################################################################
+
+
+class ProjectAccess:
+    """
+    Roles of a user regarding a project, resolved with a single query
+
+    Membership, ownership and switchtender assignment on the project are
+    fetched lazily at once, groups and departments come from the cached
+    roles of the user.
+    """
+
+    def __init__(self, project, user):
+        self.project = project
+        self.user = user
+
+    @cached_property
+    def roles(self):
+        """Return the roles of user on project as a dict of booleans"""
+        if self.user.is_anonymous or not self.project:
+            return defaultdict(bool)
+
+        memberships = models.ProjectMember.objects.filter(
+            project_id=self.project.pk, member=OuterRef("pk")
+        )
+        assignments = models.Project.switchtenders.through.objects.filter(
+            project_id=self.project.pk, user=OuterRef("pk")
+        )
+        return defaultdict(
+            bool,
+            auth_models.User.objects.filter(pk=self.user.pk)
+            .values(
+                is_member=Exists(memberships),
+                is_owner=Exists(memberships.filter(is_owner=True)),
+                is_assigned=Exists(assignments),
+            )
+            .get(),
+        )
+
+    @property
+    def is_member(self):
+        return self.roles["is_member"]
+
+    @property
+    def is_owner(self):
+        return self.roles["is_owner"]
+
+    @property
+    def is_switchtender(self):
+        return uv_utils.check_if_switchtender(self.user)
+
+    @property
+    def is_national_actor(self):
+        return self.is_switchtender and not uv_utils.get_department_codes(self.user)
+
+    def is_regional_actor(self, allow_national=False):
+        commune = self.project and self.project.commune
+        if not commune or not commune.department_id:
+            return False
+        if allow_national and self.is_national_actor:
+            return True
+        return (
+            self.is_switchtender
+            and commune.department_id in uv_utils.get_department_codes(self.user)
+        )
+
+    @property
+    def can_administrate(self):
+        if self.user.is_anonymous:
+            return False
+        return self.user.is_superuser or self.roles["is_assigned"]
+
+    def can_manage(self, allow_draft=False):
+        if self.user.is_anonymous:
+            return False
+        if self.is_member and (self.project.status != "DRAFT" or allow_draft):
+            return True
+        return self.can_administrate
+
+
+def get_project_access(project, user):
+    """Return the access of user to project, the one of the request if any"""
+    accesses = getattr(user, "_project_access_cache", {})
+    key = project and project.pk
+    return accesses.get(key) or ProjectAccess(project, user)
+
+
+def get_request_project_access(request, project):
+    """Return the access of request user to project, computed once per request"""
+    user = request.user
+    accesses = getattr(user, "_project_access_cache", None)
+    if accesses is None:
+        accesses = {}
+        setattr(user, "_project_access_cache", accesses)
+    key = project and project.pk
+    if key not in accesses:
+        accesses[key] = ProjectAccess(project, user)
+    return accesses[key]
+
+
+########################################################################
+# permission predicates
+########################################################################
+
 
 def can_manage_project(project, user, allow_draft=False):
     """
@@ -31,16 +154,7 @@ def can_manage_project(project, user, allow_draft=False):
     Managing means editing most things, except internal data.
     Project managers are mostly team members of the project.
     """
-    if user.is_anonymous:
-        return False
-
-    if is_member(user, project, allow_draft):
-        return True
-
-    if can_administrate_project(project, user):
-        return True
-
-    return False
+    return get_project_access(project, user).can_manage(allow_draft)
 
 
 def can_administrate_project(project, user):
@@ -56,7 +170,7 @@ def can_administrate_project(project, user):
         return True
 
     if project:
-        return user in project.switchtenders.all()
+        return get_project_access(project, user).can_administrate
     else:
         return models.Project.objects.filter(switchtenders=user).count() > 0
 
@@ -71,14 +185,14 @@ def can_administrate_or_403(project, user):
 
 def is_member(user, project, allow_draft):
     """return true if user is member of the project"""
-    return (user in project.members.all()) and (
+    return get_project_access(project, user).is_member and (
         (project.status != "DRAFT") or allow_draft
-    )  # noqa: F841
+    )
 
 
 def in_allowed_departments(user, project):
     """return true if project is in allowed departments for user"""
-    allowed = user.profile.departments.values_list("code", flat=True)
+    allowed = uv_utils.get_department_codes(user)
     if not allowed:  # empty list means full access
         return True
     return project.commune and (project.commune.department_id in allowed)
@@ -101,7 +215,8 @@ def get_project_moderators():
 
 def is_project_moderator(user):
     """Check if this user is allowed to moderate new projects"""
-    return (user in get_project_moderators()) or user.is_superuser
+    groups = uv_utils.get_group_names(user)
+    return {"project_moderator", "switchtender"} <= groups or user.is_superuser
 
 
 def is_project_moderator_or_403(user):
@@ -136,12 +251,12 @@ def get_national_actors():
 
 def is_regional_actor_for_project(project, user, allow_national=False):
     """Check if this user is a regional actor for a given project"""
-    return user in get_regional_actors_for_project(project, allow_national)
+    return get_project_access(project, user).is_regional_actor(allow_national)
 
 
 def check_if_national_actor(user):
     """Check if this user is a national actor"""
-    return user in get_national_actors()
+    return get_project_access(None, user).is_national_actor
 
 
 def is_regional_actor_for_project_or_403(project, user, allow_national=False):
@@ -167,6 +282,349 @@ def get_notification_recipients_for_project(project):
     ).distinct()
 
 
+########################################################################
+# notification counters
+########################################################################
+
+
+def get_project_notification_counts(user, project, counters=None):
+    """
+    Return the unread notification counts of user on project, per counter
+    category along with their total
+
+    counters of the user, from get_notification_counters, spare the query
+    when counts of many projects are needed.
+    """
+    if counters is None:
+        counters = get_notification_counters(user)
+    counts = counters.get(project.pk, {})
+    counts = {
+        category: counts.get(category, 0)
+        for category, _ in models.NotificationCounter.CATEGORY_CHOICES
+    }
+    counts["total"] = sum(
+        counts[category] for category in models.NotificationCounter.PARTITION
+    )
+    return counts
+
+
+def get_notification_counters(user):
+    """
+    Return the unread notification counts of user as {project_id: {category: count}}
+
+    Read from the denormalized counters with a single query, never cached so
+    that every process sees a mark as read at once.
+    """
+    counters = {}
+    rows = models.NotificationCounter.objects.filter(
+        recipient_id=user.id, count__gt=0
+    ).values_list("project_id", "category", "count")
+    for project_id, category, count in rows:
+        counters.setdefault(project_id, {})[category] = count
+    return counters
+
+
+def _counted_content_types():
+    return ContentType.objects.get_for_models(
+        models.Project,
+        models.Task,
+        models.TaskFollowup,
+        models.Note,
+        auth_models.User,
+    )
+
+
+def _is_on_project(notification):
+    content_types = _counted_content_types()
+    return notification.target_content_type_id == content_types[models.Project].id
+
+
+def _counter_categories(category, collaborator):
+    if collaborator:
+        return [category, models.NotificationCounter.COLLABORATOR]
+    return [category]
+
+
+def compute_notification_category(notification):
+    """
+    Return the category of a notification on a project and whether its actor
+    is not a switchtender, from its action object and actor as they are now
+    """
+    content_types = _counted_content_types()
+    action_ct_id = notification.action_object_content_type_id
+    if action_ct_id in (
+        content_types[models.Task].id,
+        content_types[models.TaskFollowup].id,
+    ):
+        category = models.NotificationCounter.ACTION
+    elif action_ct_id == content_types[models.Note].id and notification.action_object:
+        category = (
+            models.NotificationCounter.CONVERSATIONS
+            if notification.action_object.public
+            else models.NotificationCounter.FOLLOWUP
+        )
+    else:
+        category = models.NotificationCounter.GENERAL
+
+    collaborator = not (
+        notification.actor_content_type_id == content_types[auth_models.User].id
+        and uv_utils.check_if_switchtender(notification.actor)
+    )
+    return category, collaborator
+
+
+def record_notification_category(notification):
+    """
+    Record the category of a new notification and return its counter
+    categories, none if not on a project
+    """
+    if not _is_on_project(notification):
+        return []
+
+    category, collaborator = compute_notification_category(notification)
+    models.CountedNotification.objects.bulk_create(
+        [
+            models.CountedNotification(
+                notification_id=notification.id,
+                category=category,
+                collaborator=collaborator,
+            )
+        ],
+        ignore_conflicts=True,
+    )
+    return _counter_categories(category, collaborator)
+
+
+def get_notification_categories(notification):
+    """
+    Return the counter categories of notification, none if not on a project,
+    from the category recorded when it was created
+    """
+    if not _is_on_project(notification):
+        return []
+
+    recorded = (
+        models.CountedNotification.objects.filter(notification_id=notification.id)
+        .values_list("category", "collaborator")
+        .first()
+    )
+    if recorded is None:
+        # not recorded yet, until the counters are rebuilt
+        recorded = compute_notification_category(notification)
+    return _counter_categories(*recorded)
+
+
+def forget_notification_category(notification):
+    """Drop the category of a deleted notification and return its categories"""
+    categories = get_notification_categories(notification)
+    if categories:
+        models.CountedNotification.objects.filter(
+            notification_id=notification.id
+        ).delete()
+    return categories
+
+
+def adjust_notification_counters(notification, delta, categories=None):
+    """Add delta to the counters notification belongs to"""
+    if categories is None:
+        categories = get_notification_categories(notification)
+    if not categories:
+        return
+
+    recipient_id = notification.recipient_id
+    project_id = int(notification.target_object_id)
+    counters = models.NotificationCounter.objects.filter(
+        recipient_id=recipient_id, project_id=project_id, category__in=categories
+    )
+    if delta > 0:
+        models.NotificationCounter.objects.bulk_create(
+            [
+                models.NotificationCounter(
+                    recipient_id=recipient_id, project_id=project_id, category=category
+                )
+                for category in categories
+            ],
+            ignore_conflicts=True,
+        )
+    else:
+        counters = counters.filter(count__gte=-delta)
+    counters.update(count=F("count") + delta)
+
+
+def record_notification_categories(notifications):
+    """
+    Record the category of the notifications on projects among notifications
+    that have none, computed by the database, and return how many were recorded
+    """
+    content_types = _counted_content_types()
+    note_ct = content_types[models.Note]
+    missing = notifications.filter(
+        ~Exists(
+            models.CountedNotification.objects.filter(notification_id=OuterRef("id"))
+        ),
+        target_content_type=content_types[models.Project],
+    ).order_by()
+
+    categories = missing.annotate(
+        category=Case(
+            When(
+                action_object_content_type__in=[
+                    content_types[models.Task],
+                    content_types[models.TaskFollowup],
+                ],
+                then=Value(models.NotificationCounter.ACTION),
+            ),
+            When(
+                action_object_content_type=note_ct,
+                action_notes__public=True,
+                then=Value(models.NotificationCounter.CONVERSATIONS),
+            ),
+            When(
+                action_object_content_type=note_ct,
+                action_notes__public=False,
+                then=Value(models.NotificationCounter.FOLLOWUP),
+            ),
+            default=Value(models.NotificationCounter.GENERAL),
+            output_field=CharField(),
+        )
+    ).values_list("id", "category")
+
+    switchtender_ids = (
+        auth_models.User.objects.filter(groups__name="switchtender")
+        .annotate(object_id=Cast("id", output_field=CharField()))
+        .values("object_id")
+    )
+    by_switchtenders = set(
+        missing.filter(
+            actor_content_type=content_types[auth_models.User],
+            actor_object_id__in=switchtender_ids,
+        ).values_list("id", flat=True)
+    )
+
+    created = models.CountedNotification.objects.bulk_create(
+        (
+            models.CountedNotification(
+                notification_id=id,
+                category=category,
+                collaborator=id not in by_switchtenders,
+            )
+            for id, category in categories.iterator()
+        ),
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+    return len(created)
+
+
+def count_unread_notifications(notifications):
+    """
+    Return the counts of unread notifications on projects among notifications
+    as {(recipient_id, project_id): {category: count}}, from their recorded
+    categories
+    """
+    content_types = _counted_content_types()
+    recorded = models.CountedNotification.objects.filter(notification_id=OuterRef("id"))
+    unread = notifications.filter(
+        unread=True, target_content_type=content_types[models.Project]
+    ).order_by()
+
+    by_category = (
+        unread.annotate(category=Subquery(recorded.values("category")))
+        .exclude(category=None)
+        .values_list("recipient_id", "target_object_id", "category")
+        .annotate(count=Count("id"))
+    )
+    by_collaborator = (
+        unread.filter(Exists(recorded.filter(collaborator=True)))
+        .annotate(category=Value(models.NotificationCounter.COLLABORATOR))
+        .values_list("recipient_id", "target_object_id", "category")
+        .annotate(count=Count("id"))
+    )
+
+    counts = defaultdict(dict)
+    for rows in (by_category, by_collaborator):
+        for recipient_id, project_id, category, count in rows:
+            counts[(recipient_id, int(project_id))][category] = count
+    return counts
+
+
+def mark_notifications_as_read(notifications):
+    """
+    Mark the unread notifications among notifications as read and decrement
+    their counters by the ones actually updated, return how many were
+    """
+    with transaction.atomic():
+        ids = list(
+            notifications_models.Notification.objects.filter(
+                id__in=notifications.filter(unread=True).values("id"), unread=True
+            )
+            .select_for_update()
+            .values_list("id", flat=True)
+        )
+        if not ids:
+            return 0
+
+        marked = notifications_models.Notification.objects.filter(id__in=ids)
+        counts = count_unread_notifications(marked)
+        updated = marked.update(unread=False)
+        for (recipient_id, project_id), categories in counts.items():
+            for category, count in categories.items():
+                models.NotificationCounter.objects.filter(
+                    recipient_id=recipient_id, project_id=project_id, category=category
+                ).update(count=Greatest(F("count") - count, 0))
+    return updated
+
+
+def rebuild_notification_counters(user_ids=None, project_ids=None):
+    """
+    Rebuild the counters of given users and projects, all of them by default,
+    from the notifications and their recorded categories, recording the
+    missing ones, and return the number of counters written
+    """
+    notifications = notifications_models.Notification.objects.all()
+    counters = models.NotificationCounter.objects.all()
+    if user_ids is not None:
+        notifications = notifications.filter(recipient_id__in=user_ids)
+        counters = counters.filter(recipient_id__in=user_ids)
+    if project_ids is not None:
+        notifications = notifications.filter(
+            target_object_id__in=[str(id) for id in project_ids]
+        )
+        counters = counters.filter(project_id__in=project_ids)
+
+    if user_ids is None and project_ids is None:
+        models.CountedNotification.objects.exclude(
+            notification_id__in=notifications_models.Notification.objects.values("id")
+        ).delete()
+    record_notification_categories(notifications)
+
+    counts = count_unread_notifications(notifications)
+    existing_project_ids = set(
+        models.Project._base_manager.filter(
+            pk__in={project_id for _, project_id in counts}
+        ).values_list("id", flat=True)
+    )
+
+    with transaction.atomic():
+        counters.delete()
+        created = models.NotificationCounter.objects.bulk_create(
+            [
+                models.NotificationCounter(
+                    recipient_id=recipient_id,
+                    project_id=project_id,
+                    category=category,
+                    count=count,
+                )
+                for (recipient_id, project_id), categories in counts.items()
+                if project_id in existing_project_ids
+                for category, count in categories.items()
+            ],
+            batch_size=1000,
+        )
+
+    return len(created)
+
+
 def generate_ro_key():
     """Generate the ReadOnly key for sharing"""
     return uuid.uuid4().hex
@@ -198,8 +656,9 @@ def get_active_project(request):
                 Q(is_owner=True) | Q(~Q(project__status="DRAFT"), is_owner=False),
             )
 
-            if memberships.first():
-                project = memberships.first().project
+            membership = memberships.select_related("project").first()
+            if membership:
+                project = membership.project
 
             # project = (
             #     models.Project.objects.filter(deleted=None)
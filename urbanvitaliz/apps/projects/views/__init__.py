@@ -9,8 +9,8 @@ author  : raphael.marvie@beta.gouv.fr,guillaume.libersat@beta.gouv.fr
 created : 2021-05-26 15:56:20 CEST
 """
 
-import csv
 import datetime
+import os
 
 from django.contrib import messages
 from django.contrib.auth import login as log_user
@@ -19,22 +19,24 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.signals import user_logged_in
 from django.core.exceptions import PermissionDenied
 from django.dispatch import receiver
-from django.http import Http404, HttpResponse
+from django.http import FileResponse, Http404, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
 from django.utils import timezone
 from django.views.decorators.csrf import ensure_csrf_cookie
+from django.views.decorators.http import require_POST
 from urbanvitaliz.apps.communication import digests
 from urbanvitaliz.apps.communication.api import send_email
 from urbanvitaliz.apps.geomatics import models as geomatics
+from urbanvitaliz.apps.geomatics.gazetteer import get_gazetteer
 from urbanvitaliz.utils import (
-    build_absolute_url,
     check_if_switchtender,
     is_staff_or_403,
     is_switchtender_or_403,
 )
 
 from .. import models, signals
+from ..exports import iter_csv_lines, iter_project_csv_rows, projects_for_export
 from ..forms import (
     OnboardingForm,
     OnboardingWithCaptchaForm,
@@ -45,10 +47,8 @@ from ..utils import (
     can_administrate_or_403,
     can_administrate_project,
     can_manage_project,
-    format_switchtender_identity,
     generate_ro_key,
     get_active_project,
-    get_switchtenders_for_project,
     is_project_moderator,
     is_project_moderator_or_403,
     is_regional_actor_for_project_or_403,
@@ -110,10 +110,7 @@ def onboarding(request):
 
             # NOTE check if commune is unique for code postal
             if not insee and project.commune:
-                communes = geomatics.Commune.objects.filter(
-                    postal=project.commune.postal
-                )
-                if communes.count() > 1:
+                if get_gazetteer().count_postal(project.commune.postal) > 1:
                     url = reverse(
                         "projects-onboarding-select-commune", args=[project.id]
                     )
@@ -185,10 +182,7 @@ def create_project_prefilled(request):
 
             # NOTE check if commune is unique for code postal
             if project.commune:
-                communes = geomatics.Commune.objects.filter(
-                    postal=project.commune.postal
-                )
-                if communes.count() > 1:
+                if get_gazetteer().count_postal(project.commune.postal) > 1:
                     url = reverse(
                         "projects-onboarding-select-commune", args=[project.id]
                     )
@@ -210,7 +204,7 @@ def select_commune(request, project_id=None):
     response["Location"] += "?first_time=1"
     if not project.commune:
         return response
-    communes = geomatics.Commune.objects.filter(postal=project.commune.postal)
+    communes = get_gazetteer().filter_postal(project.commune.postal)
     if request.method == "POST":
         form = SelectCommuneForm(communes, request.POST)
         if form.is_valid():
@@ -233,65 +227,76 @@ def project_list_export_csv(request):
     """Export the projects for the switchtender as CSV"""
     is_switchtender_or_403(request.user)
 
-    projects = (
-        models.Project.objects.for_user(request.user)
-        .exclude(status="DRAFT")
-        .order_by("-created_on")
-    )
+    projects = projects_for_export(request.user)
 
     today = datetime.datetime.today().date()
 
-    response = HttpResponse(
+    # streamed while projects are read by chunks, to bound time to first byte
+    # and memory whatever the number of projects
+    return StreamingHttpResponse(
+        iter_csv_lines(iter_project_csv_rows(projects)),
         content_type="text/csv",
         headers={
             "Content-Disposition": f'attachment; filename="urbanvitaliz-projects-{today}.csv"'
         },
     )
 
-    writer = csv.writer(response)
-    writer.writerow(
-        [
-            "departement",
-            "commune_insee",
-            "nom_friche",
-            "detail_adresse",
-            "date_contact",
-            "contact_dossier",
-            "mail",
-            "tel",
-            "conseillers",
-            "statut_conseil",
-            "nb_reco",
-            "lien_projet",
-        ]
+
+@login_required
+@require_POST
+def project_list_export_job(request):
+    """Queue a CSV export of the projects for the switchtender"""
+    is_switchtender_or_403(request.user)
+
+    filters = {
+        name: request.POST.getlist(name)
+        for name in ("status", "departments")
+        if request.POST.getlist(name)
+    }
+    job = models.ExportJob.objects.create(
+        kind="projects_csv", filters=filters, requested_by=request.user
     )
 
-    for project in projects:
-        switchtenders = get_switchtenders_for_project(project)
-        switchtenders_txt = ", ".join(
-            [format_switchtender_identity(u) for u in switchtenders]
-        )
+    return JsonResponse(export_job_status_data(job), status=202)
+
+
+@login_required
+def export_job_status(request, job_id):
+    """Return the status of an export job of the user"""
+    job = get_object_or_404(models.ExportJob, pk=job_id, requested_by=request.user)
+    return JsonResponse(export_job_status_data(job))
+
+
+@login_required
+def export_job_download(request, job_id):
+    """Send the generated file of an export job of the user"""
+    job = get_object_or_404(
+        models.ExportJob,
+        pk=job_id,
+        requested_by=request.user,
+        status=models.ExportJob.DONE,
+    )
+    return FileResponse(
+        job.file.open("rb"),
+        as_attachment=True,
+        filename=os.path.basename(job.file.name),
+    )
 
-        writer.writerow(
-            [
-                project.commune.department.code if project.commune else "??",
-                project.commune.insee if project.commune else "??",
-                project.name,
-                project.location,
-                project.created_on.date(),
-                f"{project.first_name} {project.last_name}",
-                [m.email for m in project.members.all()],
-                project.phone,
-                switchtenders_txt,
-                project.status,
-                project.tasks.exclude(public=False).count(),
-                build_absolute_url(
-                    reverse("projects-project-detail", args=[project.id])
-                ),
-            ]
-        )
 
-    return response
+def export_job_status_data(job):
+    """Return the json representation of an export job"""
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "status_display": job.get_status_display(),
+        "status_url": reverse("projects-export-job-status", args=[job.id]),
+        "download_url": (
+            reverse("projects-export-job-download", args=[job.id])
+            if job.status == models.ExportJob.DONE
+            else None
+        ),
+    }
 
 
 @login_required
@@ -12,14 +12,16 @@ from django.contrib.contenttypes.models import ContentType
 from django.db.models import Q
 from django.shortcuts import get_object_or_404, redirect, render, reverse
 from urbanvitaliz.apps.survey import models as survey_models
-from urbanvitaliz.utils import check_if_switchtender
 
 from .. import models
 from ..forms import PrivateNoteForm, PublicNoteForm
-from ..utils import (can_administrate_project, can_manage_or_403,
-                     can_manage_project, check_if_national_actor,
-                     get_notification_recipients_for_project,
-                     is_regional_actor_for_project, set_active_project_id)
+from ..utils import (
+    can_manage_or_403,
+    get_notification_recipients_for_project,
+    get_request_project_access,
+    mark_notifications_as_read,
+    set_active_project_id,
+)
 
 
 @login_required
@@ -31,21 +33,22 @@ def project_detail(request, project_id=None):
 @login_required
 def project_knowledge(request, project_id=None):
     """Return the details of given project for switchtender"""
-    project = get_object_or_404(models.Project, pk=project_id)
-
-    # compute permissions
-    can_manage = can_manage_project(project, request.user)
-    can_manage_draft = can_manage_project(project, request.user, allow_draft=True)
-    is_national_actor = check_if_national_actor(request.user)
-    is_regional_actor = is_regional_actor_for_project(
-        project, request.user, allow_national=True
+    project = get_object_or_404(
+        models.Project.objects.select_related("commune"), pk=project_id
     )
-    can_administrate = can_administrate_project(project, request.user)
+
+    # compute permissions, resolved once for the request
+    access = get_request_project_access(request, project)
+    can_manage = access.can_manage()
+    can_manage_draft = access.can_manage(allow_draft=True)
+    is_national_actor = access.is_national_actor
+    is_regional_actor = access.is_regional_actor(allow_national=True)
+    can_administrate = access.can_administrate
 
     # check user can administrate project (member or switchtender)
-    if request.user != project.members.filter(projectmember__is_owner=True).first():
+    if not access.is_owner:
         # bypass if user is switchtender, all are allowed to view at least
-        if not check_if_switchtender(request.user):
+        if not access.is_switchtender:
             can_manage_or_403(project, request.user)
 
     # Set this project as active
@@ -72,7 +75,7 @@ def project_knowledge(request, project_id=None):
         target_object_id=project.pk,
     )
 
-    general_notifications.mark_all_as_read()
+    mark_notifications_as_read(general_notifications)
 
     return render(request, "projects/project/knowledge.html", locals())
 
@@ -80,21 +83,22 @@ def project_knowledge(request, project_id=None):
 @login_required
 def project_actions(request, project_id=None):
     """Action page for given project"""
-    project = get_object_or_404(models.Project, pk=project_id)
-
-    # compute permissions
-    can_manage = can_manage_project(project, request.user)
-    can_manage_draft = can_manage_project(project, request.user, allow_draft=True)
-    is_national_actor = check_if_national_actor(request.user)
-    is_regional_actor = is_regional_actor_for_project(
-        project, request.user, allow_national=True
+    project = get_object_or_404(
+        models.Project.objects.select_related("commune"), pk=project_id
     )
-    can_administrate = can_administrate_project(project, request.user)
+
+    # compute permissions, resolved once for the request
+    access = get_request_project_access(request, project)
+    can_manage = access.can_manage()
+    can_manage_draft = access.can_manage(allow_draft=True)
+    is_national_actor = access.is_national_actor
+    is_regional_actor = access.is_regional_actor(allow_national=True)
+    can_administrate = access.can_administrate
 
     # check user can administrate project (member or switchtender)
-    if request.user != project.members.filter(projectmember__is_owner=True).first():
+    if not access.is_owner:
         # bypass if user is switchtender, all are allowed to view at least
-        if not check_if_switchtender(request.user):
+        if not access.is_switchtender:
             can_manage_or_403(project, request.user)
 
     # Set this project as active
@@ -115,21 +119,22 @@ def project_actions(request, project_id=None):
 @login_required
 def project_conversations(request, project_id=None):
     """Action page for given project"""
-    project = get_object_or_404(models.Project, pk=project_id)
-
-    # compute permissions
-    can_manage = can_manage_project(project, request.user)
-    can_manage_draft = can_manage_project(project, request.user, allow_draft=True)
-    is_national_actor = check_if_national_actor(request.user)
-    is_regional_actor = is_regional_actor_for_project(
-        project, request.user, allow_national=True
+    project = get_object_or_404(
+        models.Project.objects.select_related("commune"), pk=project_id
     )
-    can_administrate = can_administrate_project(project, request.user)
+
+    # compute permissions, resolved once for the request
+    access = get_request_project_access(request, project)
+    can_manage = access.can_manage()
+    can_manage_draft = access.can_manage(allow_draft=True)
+    is_national_actor = access.is_national_actor
+    is_regional_actor = access.is_regional_actor(allow_national=True)
+    can_administrate = access.can_administrate
 
     # check user can administrate project (member or switchtender)
-    if request.user != project.members.filter(projectmember__is_owner=True).first():
+    if not access.is_owner:
         # bypass if user is switchtender, all are allowed to view at least
-        if not check_if_switchtender(request.user):
+        if not access.is_switchtender:
             can_manage_or_403(project, request.user)
 
     # Set this project as active
@@ -142,12 +147,14 @@ def project_conversations(request, project_id=None):
     # Mark this project notifications as read
     project_ct = ContentType.objects.get_for_model(project)
     note_ct = ContentType.objects.get_for_model(models.Note)
-    request.user.notifications.unread().filter(
-        action_object_content_type=note_ct,
-        action_notes__public=True,
-        target_content_type=project_ct.pk,
-        target_object_id=project.pk,
-    ).mark_all_as_read()
+    mark_notifications_as_read(
+        request.user.notifications.unread().filter(
+            action_object_content_type=note_ct,
+            action_notes__public=True,
+            target_content_type=project_ct.pk,
+            target_object_id=project.pk,
+        )
+    )
 
     return render(request, "projects/project/conversations.html", locals())
 
@@ -155,21 +162,22 @@ def project_conversations(request, project_id=None):
 @login_required
 def project_internal_followup(request, project_id=None):
     """Action page for given project"""
-    project = get_object_or_404(models.Project, pk=project_id)
-
-    # compute permissions
-    can_manage = can_manage_project(project, request.user)
-    can_manage_draft = can_manage_project(project, request.user, allow_draft=True)
-    is_regional_actor = is_regional_actor_for_project(
-        project, request.user, allow_national=True
+    project = get_object_or_404(
+        models.Project.objects.select_related("commune"), pk=project_id
     )
-    is_national_actor = check_if_national_actor(request.user)
-    can_administrate = can_administrate_project(project, request.user)
+
+    # compute permissions, resolved once for the request
+    access = get_request_project_access(request, project)
+    can_manage = access.can_manage()
+    can_manage_draft = access.can_manage(allow_draft=True)
+    is_national_actor = access.is_national_actor
+    is_regional_actor = access.is_regional_actor(allow_national=True)
+    can_administrate = access.can_administrate
 
     # check user can administrate project (member or switchtender)
-    if request.user != project.members.filter(projectmember__is_owner=True).first():
+    if not access.is_owner:
         # bypass if user is switchtender, all are allowed to view at least
-        if not check_if_switchtender(request.user):
+        if not access.is_switchtender:
             can_manage_or_403(project, request.user)
 
     # Set this project as active
@@ -178,12 +186,14 @@ def project_internal_followup(request, project_id=None):
     # Mark this project notifications as read
     project_ct = ContentType.objects.get_for_model(project)
     note_ct = ContentType.objects.get_for_model(models.Note)
-    request.user.notifications.unread().filter(
-        action_object_content_type=note_ct,
-        action_notes__public=False,
-        target_content_type=project_ct.pk,
-        target_object_id=project.pk,
-    ).mark_all_as_read()
+    mark_notifications_as_read(
+        request.user.notifications.unread().filter(
+            action_object_content_type=note_ct,
+            action_notes__public=False,
+            target_content_type=project_ct.pk,
+            target_object_id=project.pk,
+        )
+    )
 
     private_note_form = PrivateNoteForm()
 
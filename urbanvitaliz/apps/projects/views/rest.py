@@ -7,38 +7,179 @@ author  : raphael.marvie@beta.gouv.fr,guillaume.libersat@beta.gouv.fr
 created : 2021-05-26 15:56:20 CEST
 """
 
+import hashlib
+import math
+
+from django.contrib.auth import models as auth_models
 from django.contrib.contenttypes.models import ContentType
+from django.db.models import (
+    CharField,
+    Count,
+    F,
+    Max,
+    OuterRef,
+    Prefetch,
+    Q,
+    Subquery,
+    Sum,
+)
+from django.db.models.functions import Cast, Coalesce
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from notifications import models as notifications_models
 from rest_framework import mixins, permissions, status, viewsets
 from rest_framework.decorators import action
 from rest_framework.exceptions import PermissionDenied
 from rest_framework.response import Response
-from urbanvitaliz.utils import check_if_switchtender
+from urbanvitaliz.apps.geomatics import proximity
+from urbanvitaliz.apps.geomatics.rest import get_nearby_params
+from urbanvitaliz.utils import CursorPagination, check_if_switchtender
 
 from .. import models
 from ..serializers import (
+    NearbyProjectSerializer,
     ProjectSerializer,
     TaskFollowupSerializer,
     TaskNotificationSerializer,
     TaskSerializer,
 )
+from ..utils import get_notification_counters, mark_notifications_as_read
 
 
 ########################################################################
 # REST API
 ########################################################################
-class ProjectViewSet(viewsets.ModelViewSet):
+class ConditionalGetMixin:
+    """
+    Answer list and retrieve requests with 304 Not Modified when the client
+    already has the current version of the resource, before serializing it
+
+    The version is read from the database with a small aggregate query over
+    the requested objects, see get_version_aggregates, completed by
+    get_version_extra. The ETag covers it along with the user and the full
+    path. Last-Modified is the latest update date of the objects, it misses
+    deletions, ETags are exact.
+    """
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(request, super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(request, super().retrieve, *args, **kwargs)
+
+    def get_version_aggregates(self):
+        """Return the aggregates of the requested objects making their version"""
+        return {
+            "count": Count("pk", distinct=True),
+            "last_id": Max("pk"),
+            "updated_on": Max("updated_on"),
+        }
+
+    def get_version_extra(self):
+        """Return what else, out of the requested objects, the response shows"""
+        return None
+
+    def get_version(self):
+        queryset = self.filter_queryset(self.get_queryset())
+        if self.action == "retrieve":
+            lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+            queryset = queryset.filter(
+                **{self.lookup_field: self.kwargs[lookup_url_kwarg]}
+            )
+        return queryset.order_by().aggregate(**self.get_version_aggregates())
+
+    def conditional_response(self, request, view, *args, **kwargs):
+        version = self.get_version()
+        token = repr(
+            (
+                request.user.id,
+                request.get_full_path(),
+                sorted(version.items()),
+                self.get_version_extra(),
+            )
+        )
+        digest = hashlib.md5(token.encode(), usedforsecurity=False).hexdigest()
+        etag = quote_etag(digest)
+        updated_on = version["updated_on"]
+        last_modified = updated_on and math.ceil(updated_on.timestamp())
+
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = view(request, *args, **kwargs)
+        if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            response["ETag"] = etag
+            if last_modified:
+                response["Last-Modified"] = http_date(last_modified)
+        return response
+
+
+class ProjectPagination(CursorPagination):
+    ordering = ("-created_on", "-id")
+
+
+class ProjectViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows projects to be viewed or edited.
     """
 
     def get_queryset(self):
-        return models.Project.objects.for_user(self.request.user).order_by(
-            "-created_on", "-updated_on"
+        # related rows of every serialized field are fetched upfront so the
+        # number of queries does not depend on the number of projects
+        switchtenders = auth_models.User.objects.select_related("profile__organization")
+        return (
+            models.Project.objects.for_user(self.request.user)
+            .select_related("commune__department")
+            .prefetch_related(Prefetch("switchtenders", queryset=switchtenders))
+            .order_by("-created_on", "-updated_on")
         )
 
+    def get_version_aggregates(self):
+        return {
+            **super().get_version_aggregates(),
+            "switchtender_count": Count("switchtenders"),
+            "switchtender_ids": Sum("switchtenders__id"),
+        }
+
+    def get_version_extra(self):
+        # the counters are read once, for the version and the serializer
+        self.notification_counters = get_notification_counters(self.request.user)
+        return sorted(
+            (project_id, sorted(counts.items()))
+            for project_id, counts in self.notification_counters.items()
+        )
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if hasattr(self, "notification_counters"):
+            context["notification_counters"] = self.notification_counters
+        return context
+
     serializer_class = ProjectSerializer
+    pagination_class = ProjectPagination
     permission_classes = [permissions.IsAuthenticated]
 
+    @action(detail=True, pagination_class=None)
+    def nearby(self, request, pk=None):
+        """Return the nearest other projects visible to the user, drafts apart"""
+        project = self.get_object()
+        radius, limit = get_nearby_params(request)
+        commune = project.commune
+        projects = []
+        if commune and commune.grid_cell is not None:
+            projects = proximity.nearest_projects(
+                self.get_queryset().exclude(pk=project.pk).exclude(status="DRAFT"),
+                commune.latitude,
+                commune.longitude,
+                radius,
+                limit,
+            )
+        serializer = NearbyProjectSerializer(
+            projects, many=True, context=self.get_serializer_context()
+        )
+        return Response(serializer.data)
+
 
 class TaskFollowupViewSet(viewsets.ModelViewSet):
     """
@@ -81,7 +222,11 @@ class TaskFollowupViewSet(viewsets.ModelViewSet):
         )
 
 
-class TaskViewSet(viewsets.ModelViewSet):
+class TaskPagination(CursorPagination):
+    ordering = ("-created_on", "-id")
+
+
+class TaskViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """
     API endpoint for project tasks
     """
@@ -118,28 +263,81 @@ class TaskViewSet(viewsets.ModelViewSet):
 
         return Response(status=status.HTTP_400_BAD_REQUEST)
 
-    def get_queryset(self):
+    def check_project_access(self):
+        """Return the project id of the request, if the user can access it"""
         project_id = int(self.kwargs["project_id"])
 
-        user_projects = list(
-            models.Project.objects.for_user(self.request.user).values_list(flat=True)
-        )
+        if self.request.method == "GET" and check_if_switchtender(self.request.user):
+            return project_id
 
-        if project_id not in user_projects:
-            if not (
-                self.request.method == "GET"
-                and check_if_switchtender(self.request.user)
-            ):
-                raise PermissionDenied()
+        user_projects = models.Project.objects.for_user(self.request.user)
+        if not user_projects.filter(pk=project_id).exists():
+            raise PermissionDenied()
+
+        return project_id
 
-        return models.Task.objects.filter(project_id=project_id).order_by(
-            "-created_on", "-updated_on"
+    def get_queryset(self):
+        project_id = self.check_project_access()
+
+        return with_task_counts(
+            models.Task.objects.filter(project_id=project_id), self.request.user
+        ).order_by("-created_on", "-updated_on")
+
+    def get_version_aggregates(self):
+        return {
+            **super().get_version_aggregates(),
+            # moves renumber tasks without changing their update date
+            "orders": Sum(F("order") * F("id"), distinct=True),
+            "followup_count": Count("followups", distinct=True),
+            "last_followup_id": Max("followups__id"),
+            "reminder_count": Count("reminders", distinct=True),
+            "last_reminder_id": Max("reminders__id"),
+        }
+
+    def get_version_extra(self):
+        return sorted(
+            models.NotificationCounter.objects.filter(
+                recipient=self.request.user, project_id=self.kwargs["project_id"]
+            ).values_list("category", "count")
         )
 
     serializer_class = TaskSerializer
+    pagination_class = TaskPagination
     permission_classes = [permissions.IsAuthenticated]
 
 
+def with_task_counts(tasks, user):
+    """
+    Annotate tasks with the counts their serializer needs and prefetch their
+    related objects, for a constant number of queries whatever the tasks
+    """
+    followup_ct = ContentType.objects.get_for_model(models.TaskFollowup)
+    followup_ids = (
+        models.TaskFollowup.objects.filter(task=OuterRef(OuterRef("pk")))
+        .annotate(object_id=Cast("id", output_field=CharField()))
+        .values("object_id")
+    )
+    unread_notifications = (
+        notifications_models.Notification.objects.filter(
+            recipient=user,
+            unread=True,
+            action_object_content_type=followup_ct,
+            action_object_object_id__in=followup_ids,
+        )
+        .order_by()
+        .values("recipient")
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+    created_by = auth_models.User.objects.select_related("profile__organization")
+
+    return tasks.annotate(
+        followups_count=Count("followups"),
+        comments_count=Count("followups", filter=~Q(followups__comment="")),
+        notifications_count=Coalesce(Subquery(unread_notifications), 0),
+    ).prefetch_related("reminders", Prefetch("created_by", queryset=created_by))
+
+
 class TaskNotificationViewSet(
     mixins.DestroyModelMixin,
     mixins.ListModelMixin,
@@ -178,7 +376,7 @@ class TaskNotificationViewSet(
         detail=False,
     )
     def mark_all_as_read(self, request, project_id, task_id):
-        self.get_queryset().mark_all_as_read(request.user)
+        mark_notifications_as_read(self.get_queryset())
         return Response({}, status=status.HTTP_200_OK)
 
     serializer_class = TaskNotificationSerializer
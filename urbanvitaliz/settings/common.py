@@ -216,6 +216,27 @@ TEAM_EMAILS = ["friches@beta.gouv.fr"]
 
 # SENDINBLUE
 SENDINBLUE_API_KEY = "NO-API-KEY-DEFINED"
+SENDINBLUE_DISPATCH_WORKERS = 4
+SENDINBLUE_DISPATCH_RATE_LIMIT = 10  # max requests per second
+SENDINBLUE_DISPATCH_MAX_RETRIES = 3
+SENDINBLUE_DISPATCH_BACKOFF = 1.0  # seconds, doubled on each retry
+SENDINBLUE_BATCH_MAX_SIZE = 50  # message versions per api call
+# queue emails sent from views, requires running the sendemails worker
+SENDINBLUE_QUEUE_EMAILS = False
+SENDINBLUE_QUEUE_MAX_ATTEMPTS = 5
+# seconds a worker holds queued emails it claimed before others may retry them
+SENDINBLUE_QUEUE_LEASE = 600
+
+# exports generated by the runexports worker, written to EXPORTS_STORAGE, a
+# storage class path, or the default storage when None. It must be shared by
+# the web and worker hosts when they are distinct, local media are not.
+EXPORTS_STORAGE = None
+EXPORT_JOB_TIMEOUT = 3600  # seconds before a running job is deemed crashed
+EXPORT_JOB_MAX_ATTEMPTS = 3
+EXPORT_JOB_RETENTION = 7 * 24 * 60 * 60  # seconds finished jobs are kept
+
+# seconds between checks that the in memory communes gazetteer is current
+GAZETTEER_CHECK_INTERVAL = 60
 
 
 # IFrames
@@ -1,5 +1,6 @@
 from django.contrib.auth import models as auth
 from model_bakery.recipe import Recipe
+from urbanvitaliz.apps.geomatics import models as geomatics
 
 from . import utils
 
@@ -28,3 +29,71 @@ def test_build_absolute_url_with_empty_auto_login():
     assert url.startswith("https://")
     assert "/somewhere" in url
     assert "?sesame=" not in url
+
+
+def test_cached_links_sign_auto_login_once_per_user(mocker):
+    user = Recipe(auth.User, username="owner", email="owner@example.com").make()
+    signer = mocker.patch(
+        "urbanvitaliz.utils.get_query_string", return_value="?sesame=token"
+    )
+
+    with utils.cached_links():
+        first = utils.build_absolute_url("/somewhere", user)
+        second = utils.build_absolute_url("/elsewhere", auto_login_user=user)
+
+    assert first.endswith("/somewhere?sesame=token")
+    assert second.endswith("/elsewhere?sesame=token")
+    signer.assert_called_once_with(user)
+
+
+def test_cached_links_do_not_outlive_their_block(mocker):
+    user = Recipe(auth.User, username="owner", email="owner@example.com").make()
+    signer = mocker.patch(
+        "urbanvitaliz.utils.get_query_string", return_value="?sesame=token"
+    )
+
+    with utils.cached_links():
+        utils.build_absolute_url("/somewhere", user)
+    utils.build_absolute_url("/somewhere", user)
+
+    assert signer.call_count == 2
+
+
+def test_check_if_switchtender_is_memoized_on_user(django_assert_num_queries):
+    user = Recipe(auth.User, username="owner").make()
+    auth.Group.objects.get(name="switchtender").user_set.add(user)
+
+    assert utils.check_if_switchtender(user)
+
+    with django_assert_num_queries(0):
+        assert utils.check_if_switchtender(user)
+
+
+def test_revoked_groups_apply_to_other_user_objects_at_once():
+    user = Recipe(auth.User, username="owner").make()
+    group = auth.Group.objects.get(name="switchtender")
+    user.groups.add(group)
+    assert utils.check_if_switchtender(user)
+
+    group.user_set.remove(user)
+
+    # e.g. the next request, possibly handled by another process
+    assert not utils.check_if_switchtender(auth.User.objects.get(pk=user.pk))
+
+
+def test_memoized_groups_are_dropped_on_change():
+    user = Recipe(auth.User, username="owner").make()
+
+    assert not utils.check_if_switchtender(user)
+    user.groups.add(auth.Group.objects.get(name="switchtender"))
+
+    assert utils.check_if_switchtender(user)
+
+
+def test_memoized_departments_are_dropped_on_change():
+    user = Recipe(auth.User, username="owner").make()
+    department = Recipe(geomatics.Department, code="62").make()
+
+    assert utils.get_department_codes(user) == frozenset()
+    user.profile.departments.add(department)
+    assert utils.get_department_codes(user) == {"62"}
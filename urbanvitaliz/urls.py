@@ -17,6 +17,7 @@ from magicauth.urls import urlpatterns as magicauth_urls
 from rest_framework import routers
 
 from urbanvitaliz.apps.addressbook.urls import urlpatterns as addressbook_urls
+from urbanvitaliz.apps.communication.urls import urlpatterns as communication_urls
 from urbanvitaliz.apps.crm.urls import urlpatterns as crm_urls
 from urbanvitaliz.apps.geomatics import rest as geomatics_rest
 from urbanvitaliz.apps.home.urls import urlpatterns as home_urls
@@ -73,6 +74,7 @@ urlpatterns.extend(addressbook_urls)
 urlpatterns.extend(survey_urls)
 urlpatterns.extend(invites_urls)
 urlpatterns.extend(crm_urls)
+urlpatterns.extend(communication_urls)
 
 if settings.DEBUG:
     import debug_toolbar
@@ -8,6 +8,7 @@ created: 2021-06-29 09:16:14 CEST
 """
 
 from contextlib import contextmanager
+from contextvars import ContextVar
 from urllib.parse import urljoin
 
 from django.conf import settings
@@ -20,6 +21,7 @@ from django.core.mail import send_mail
 from django.db import models as db_models
 from django.db.models.functions import Cast
 from django.template import loader
+from rest_framework import pagination, serializers
 from sesame.utils import get_query_string
 
 ########################################################################
@@ -41,7 +43,59 @@ def is_switchtender_or_403(user):
 
 def check_if_switchtender(user):
     """Return true if user is a global switchtender"""
-    return auth.User.objects.filter(pk=user.id, groups__name="switchtender").exists()
+    return "switchtender" in get_group_names(user)
+
+
+########################################################################
+# cached user roles
+########################################################################
+
+USER_ROLE_KINDS = ("groups", "departments")
+
+
+def get_group_names(user):
+    """
+    Return the names of the groups of user
+
+    Memoized on the user object, that is for the request, and dropped when
+    groups of the user change through that object.
+    """
+    return _get_cached_roles(
+        user,
+        "groups",
+        lambda: auth.Group.objects.filter(user=user).values_list("name", flat=True),
+    )
+
+
+def get_department_codes(user):
+    """Return the department codes of user profile, none meaning everywhere"""
+    return _get_cached_roles(
+        user,
+        "departments",
+        lambda: auth.User.objects.filter(
+            pk=user.pk, profile__departments__isnull=False
+        ).values_list("profile__departments__code", flat=True),
+    )
+
+
+def forget_user_roles(user):
+    """Drop the roles memoized on the user object"""
+    for kind in USER_ROLE_KINDS:
+        user.__dict__.pop(f"_cached_{kind}", None)
+
+
+def _get_cached_roles(user, kind, fetch):
+    # roles grant rights, they are never shared across requests or processes
+    # so that a revocation applies at once
+    if not user or user.is_anonymous:
+        return frozenset()
+
+    attname = f"_cached_{kind}"
+    roles = getattr(user, attname, None)
+    if roles is None:
+        roles = frozenset(fetch())
+        setattr(user, attname, roles)
+    return roles
 
 
 def send_email(
@@ -75,6 +129,10 @@ def build_absolute_url(path, auto_login_user=None):
     use this to build the absolute url,
     assuming we're always using https
     """
+    builder = _link_builder.get()
+    if builder:
+        return builder.build(path, auto_login_user)
+
     current_site = Site.objects.get_current()
     base = "https://" + current_site.domain
     url = urljoin(base, path)
@@ -85,6 +143,112 @@ def build_absolute_url(path, auto_login_user=None):
     return url
 
 
+class LinkBuilder:
+    """
+    Build absolute urls like build_absolute_url, caching the site base url
+    and the auto login query string of each user for its lifetime
+    """
+
+    def __init__(self, auto_login=True):
+        self.auto_login = auto_login
+        self.base = None
+        self.query_strings = {}
+
+    def build(self, path, auto_login_user=None):
+        if self.base is None:
+            self.base = "https://" + Site.objects.get_current().domain
+        url = urljoin(self.base, path)
+
+        if auto_login_user and self.auto_login:
+            url = urljoin(url, self.query_string(auto_login_user))
+
+        return url
+
+    def query_string(self, user):
+        """Return the auto login query string of user, signed once"""
+        if user.pk not in self.query_strings:
+            self.query_strings[user.pk] = get_query_string(user)
+        return self.query_strings[user.pk]
+
+
+_link_builder = ContextVar("link_builder", default=None)
+
+
+@contextmanager
+def cached_links(auto_login=True):
+    """Make build_absolute_url use a shared link builder within the block"""
+    builder = _link_builder.get()
+    if builder and builder.auto_login == auto_login:
+        yield builder
+        return
+
+    builder = LinkBuilder(auto_login=auto_login)
+    token = _link_builder.set(builder)
+    try:
+        yield builder
+    finally:
+        _link_builder.reset(token)
+
+
+########################################################################
+# REST helpers
+########################################################################
+
+
+class CursorPagination(pagination.CursorPagination):
+    """
+    Cursor pagination over the ordering of the subclass
+
+    Unless required, results are only paginated when the client asks for it
+    with the cursor or page_size query parameters, so that existing clients
+    loading whole lists keep working.
+    """
+
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+    required = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+        if not self.required and not (
+            self.cursor_query_param in params or self.page_size_query_param in params
+        ):
+            return None
+        return super().paginate_queryset(queryset, request, view)
+
+
+class SparseFieldsetMixin:
+    """
+    Serializer mixin only rendering the fields listed in the fields query
+    parameter of GET requests, e.g. ?fields=id,name
+
+    Only the outermost serializer is restricted, unknown names are ignored.
+    """
+
+    fields_query_param = "fields"
+
+    def get_fields(self):
+        fields = super().get_fields()
+
+        request = self.context.get("request")
+        if request is None or request.method != "GET" or not self.is_root():
+            return fields
+
+        selected = request.query_params.get(self.fields_query_param)
+        if not selected:
+            return fields
+
+        names = {name.strip() for name in selected.split(",")}
+        return {name: field for name, field in fields.items() if name in names}
+
+    def is_root(self):
+        parent = self.parent
+        if isinstance(parent, serializers.ListSerializer):
+            parent = parent.parent
+        return parent is None
+
+
 ########################################################################
 # Test helpers
 ########################################################################